@@ -1,24 +1,45 @@
-import os, certifi, json, re
+import os, certifi, re
+from abc import ABCMeta, abstractmethod
+from itertools import islice
 os.environ["SSL_CERT_FILE"] = certifi.where()
 os.environ["REQUESTS_CA_BUNDLE"] = certifi.where()
 
-from flask import Flask, request, render_template_string, jsonify
+from flask import Flask, request, render_template_string, Response, stream_with_context, flash
 from dotenv import load_dotenv
 from datetime import datetime, timedelta, time as dtime
-from models import db, User, Service, Order, OrderItem, Conversation, Vehicle, ShopSlot
+from models import db, User, Service, Order, OrderItem, Conversation, Vehicle, ShopSlot, SlotOccupancy, CacheVersion
+from sqlalchemy import select, and_, or_
+from sqlalchemy.orm import joinedload, selectinload
 
 from linebot.v3 import WebhookHandler
-from linebot.v3.messaging import (
-    Configuration, ApiClient, MessagingApi,
-    ReplyMessageRequest, TextMessage
-)
 from linebot.v3.webhooks import MessageEvent, TextMessageContent, PostbackEvent
 
 from flex_helper import reply_text, reply_flex
+import flex_helper
+import flex_engine
+import line_client
+import outbound
+import reminders
+import maintenance
+from webhook_worker import pool_from_env, dispatcher_from_env, QueueFull
+from dedup import deduper_from_env
+import uow
+from conv_cache import conv_cache
+from bootstrap import load_user_and_conv
+import bootstrap
+from router import Router, RouteContext
+from availability import iter_available, nearest_available, ACTIVE_STATUSES, COMPLETED_STATUS  # 批次版：整個區間兩次查詢
+import occupancy
+import holds
+import versions
+import order_feed
+import order_actions
+import jobs
+from catalog import current_catalog, catalog_cache
 from flex_templates import (
-    bubble_vehicle_picker, bubble_services_page,
-    bubble_timeslots, bubble_confirm, bubble_orders,
-    bubble_order_detail, carousel_orders_full,
+    bubble_vehicle_picker,
+    bubble_timeslots, bubble_confirm,
+    carousel_orders_full,
     bubble_cancel_confirm, bubble_reschedule_picker,
     carousel_my_vehicles, bubble_settings,
     bubble_new_booking_picker,bubble_booking_success
@@ -32,16 +53,64 @@ app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 db.init_app(app)
 
 CHANNEL_SECRET = os.getenv("LINE_CHANNEL_SECRET")
-CHANNEL_TOKEN  = os.getenv("LINE_CHANNEL_ACCESS_TOKEN")
 handler = WebhookHandler(CHANNEL_SECRET)
-configuration = Configuration(access_token=CHANNEL_TOKEN)
 
 PLATE_RE = re.compile(r"^[A-Z0-9\-]{3,}$")
 
+# ---------- Event dispatch ----------
+# webhookEventId 去重（LINE 重送的事件在進 handler 前就丟掉）
+event_deduper = deduper_from_env()
+
+def dispatch_event(event):
+    """
+    依 WebhookHandler 已註冊的 handler 執行單一事件。
+    查找規則與 WebhookHandler.handle 相同：MessageEvent_<Content> → Event 類別 → default。
+    """
+    key = type(event).__name__
+    func = None
+    if isinstance(event, MessageEvent):
+        func = handler._handlers.get(f"{key}_{type(event.message).__name__}")
+    func = func or handler._handlers.get(key) or handler._default
+    if func is None:
+        print(f"[dispatch] no handler for {key}")
+        return
+    with app.app_context():
+        if not event_deduper.claim(event):
+            print(f"[dispatch] duplicate event {event.webhook_event_id}, skip")
+            return
+        # 整個事件只 commit 一次（handler 內出錯則 rollback）；回覆在 commit 成功後才送出
+        try:
+            with uow.unit_of_work(key):
+                func(event)
+        except Exception:
+            # commit 失敗：handler 的回覆已經丟掉（例如「預約成功」），改回錯誤訊息
+            token = getattr(event, "reply_token", None)
+            if token:
+                try:
+                    reply_text(None, token, "系統忙線或設定有誤，請稍後再試 🙏")
+                except Exception:
+                    pass
+            raise
+
+# WEBHOOK_ASYNC=1 才會建立；None 表示在 request 內處理（依使用者分組平行）
+webhook_pool = pool_from_env(dispatch_event)
+sync_dispatcher = dispatcher_from_env(dispatch_event)
+
 # ---------- Health ----------
 @app.get("/healthz")
 def healthz():
-    return {"ok": True}
+    out = {"ok": True, "dedup": event_deduper.snapshot(), "uow": uow.snapshot(),
+           "conv_cache": conv_cache.snapshot(), "bootstrap": bootstrap.snapshot(),
+           "routes": {"text": text_routes.snapshot(), "postback": postback_routes.snapshot()},
+           "holds": holds.snapshot(), "jobs": jobs.snapshot(), "catalog": catalog_cache.snapshot(),
+           "flex": flex_helper.snapshot(), "flex_engine": flex_engine.snapshot(),
+           "line_api": line_client.snapshot(),
+           "outbound": outbound.snapshot(), "reminders": reminders.snapshot(),
+           "maintenance": maintenance.snapshot(), "order_feed": order_feed.snapshot(),
+           "order_actions": order_actions.snapshot()}
+    if webhook_pool is not None:
+        out["webhook_queue"] = webhook_pool.snapshot()
+    return out
 
 # ---------- LINE Callback (強化除錯) ----------
 @app.post("/callback")
@@ -52,7 +121,16 @@ def callback():
         print("\n=== /callback ===")
         print("X-Line-Signature:", signature)
         print("Body preview:", body[:2000], "...\n")
-        handler.handle(body, signature)
+        payload = handler.parser.parse(body, signature, as_payload=True)
+        if webhook_pool is None:
+            # 同一使用者依序、不同使用者平行，全部處理完才回 200
+            sync_dispatcher.dispatch(payload.events)
+        else:
+            # 只驗簽 + 解析，事件依使用者進對應 lane，立刻回 200
+            for event in payload.events:
+                webhook_pool.submit(event)
+    except QueueFull:
+        return "Busy", 503
     except Exception:
         import traceback
         print("!! handler exception !!")
@@ -61,36 +139,21 @@ def callback():
     return "OK", 200
 
 # ---------- Helpers ----------
-def get_or_create_user(line_user_id):
-    u = User.query.filter_by(line_user_id=line_user_id).first()
-    if not u:
-        u = User(line_user_id=line_user_id)
-        db.session.add(u)
-        db.session.commit()
-    return u
-
-def get_or_create_conv(line_user_id):
-    c = Conversation.query.filter_by(line_user_id=line_user_id).first()
-    if not c:
-        c = Conversation(line_user_id=line_user_id, state="idle", payload={})
-        db.session.add(c)
-        db.session.commit()
-    if not isinstance(c.payload, dict):
-        c.payload = {}
-        db.session.commit()
-    return c
+# 以下 helper 只修改 session 內的物件，不自行 commit；
+# 每個事件由 dispatch_event 的 unit_of_work 統一 commit 一次（失敗則 rollback）。
+def get_user_and_conv(line_user_id):
+    # 一次取得（或建立）User + Conversation；回頭客走 LRU + conv_cache，不需查詢
+    return load_user_and_conv(line_user_id)
 
 def reset_conv(conv):
     conv.state = "idle"
     conv.payload = {}
-    db.session.commit()
 
 # NEW: 安全更新 JSON 欄位（避免原地修改不被 SQLAlchemy 偵測）
 def set_payload(conv, **kwargs):
     p = dict(conv.payload or {})
     p.update(kwargs)
     conv.payload = p
-    db.session.commit()
     return p
 
 def _hydrate_payload_defaults_from_user(user, conv):
@@ -103,7 +166,6 @@ def _hydrate_payload_defaults_from_user(user, conv):
     if not p.get("phone") and user.phone:
         p["phone"] = user.phone
     conv.payload = p
-    db.session.commit()
 
 def _sync_booking_display(conv):
     """
@@ -130,7 +192,6 @@ def _sync_booking_display(conv):
         p["time"] = p["booked_at"]
 
     conv.payload = p
-    db.session.commit()
 
 def _safe_str(v):
     s = "" if v is None else str(v)
@@ -139,7 +200,7 @@ def _safe_str(v):
 
 def list_upcoming_orders(user_id, days_ahead=30, limit=5):
     now = datetime.now()
-    q = (Order.query
+    q = (order_listing()
          .filter(Order.user_id == user_id)
          .filter(Order.status.in_(["pending", "confirmed"]))
          .filter((Order.booked_at == None) | (Order.booked_at >= now))
@@ -147,89 +208,73 @@ def list_upcoming_orders(user_id, days_ahead=30, limit=5):
          .limit(limit))
     return q.all()
 
-def check_capacity(when: datetime) -> tuple[bool, str]:
-    weekday = when.weekday()
-    slots = (ShopSlot.query
-             .filter(ShopSlot.weekday == weekday)
-             .order_by(ShopSlot.start_time.asc())
-             .all())
-    if not slots:
-        return False, "該日未開放預約（星期日休息），請選擇其他日期。"
-
-    hm = dtime(when.hour, when.minute)
-    chosen = None
-    for s in slots:
-        if s.start_time <= hm < s.end_time:
-            chosen = s
-            break
-    if not chosen:
-        return False, "所選時間不在營業時段（08:00–21:00）內，請重新選擇。"
-
-    block_min = (when.minute // chosen.interval_min) * chosen.interval_min
-    block_start = when.replace(minute=block_min, second=0, microsecond=0)
-    block_end = block_start + timedelta(minutes=chosen.interval_min)
-
-    cnt = (Order.query
-           .filter(Order.status.in_(["pending", "confirmed"]))
-           .filter(Order.booked_at >= block_start)
-           .filter(Order.booked_at < block_end)
-           .count())
-    if cnt >= chosen.capacity:
-        return False, "此時段名額已滿，請改其他時間。"
+CAPACITY_MESSAGES = {
+    occupancy.CLOSED_DAY: "該日未開放預約（星期日休息），請選擇其他日期。",
+    occupancy.CLOSED_TIME: "所選時間不在營業時段（08:00–21:00）內，請重新選擇。",
+    occupancy.OVERRUN: "所選時間離打烊太近，來不及完成此項服務，請改早一點的時段。",
+    "full": "此時段名額已滿，請改其他時間。",
+}
+
+def check_capacity(when: datetime, duration_min: int | None = None) -> tuple[bool, str]:
+    # 服務時間跨到的每一格都要有名額（一次主鍵 IN 查詢），真正佔名額在 occupancy.reserve_at
+    cells, reason = occupancy.cells_for(when, duration_min)
+    if cells is None:
+        return False, CAPACITY_MESSAGES[reason]
+    counts = occupancy.booked_many(c for c, _cap in cells)
+    if any(counts[c] >= cap for c, cap in cells):
+        return False, CAPACITY_MESSAGES["full"]
     return True, ""
 
-def find_available_slots(start_dt: datetime, days: int = 14, max_per_day: int = 48):
-    results = []
-    end_dt = start_dt + timedelta(days=days)
-    day_cursor = datetime(start_dt.year, start_dt.month, start_dt.day)
-
-    while day_cursor < end_dt:
-        weekday = day_cursor.weekday()
-        day_slots = (ShopSlot.query
-                     .filter(ShopSlot.weekday == weekday)
-                     .order_by(ShopSlot.start_time.asc())
-                     .all())
-        per_day_count = 0
-
-        for s in day_slots:
-            cur = datetime.combine(day_cursor.date(), s.start_time)
-            day_end = datetime.combine(day_cursor.date(), s.end_time)
-            while cur < day_end and per_day_count < max_per_day:
-                if cur >= start_dt:
-                    ok, _ = check_capacity(cur)
-                    if ok:
-                        results.append(cur)
-                        per_day_count += 1
-                cur += timedelta(minutes=s.interval_min)
-
-        day_cursor += timedelta(days=1)
-        if len(results) >= 500:
-            break
-    return results
+# 選到滿 / 休息的時間時，附上前後最近的幾個空檔（quick reply 按鈕）
+SLOT_SUGGEST_COUNT = int(os.getenv("SLOT_SUGGEST_COUNT", "4"))
+SLOT_SUGGEST_DAYS = int(os.getenv("SLOT_SUGGEST_DAYS", "7"))
+
+def _suggest_slots(when: datetime, duration_min: int | None, data_fmt: str, ignore=()):
+    """回傳 [(label, postback data)]；data_fmt 以 {t} 帶入時間，例如 "SLOT_PICK:{t:%Y-%m-%d %H:%M}"。"""
+    fmt = "%Y-%m-%dT%H:%M"
+    _initial, min_iso, max_iso = _datetimepicker_bounds()
+    slots = nearest_available(when, SLOT_SUGGEST_COUNT, duration_min,
+                              earliest=datetime.strptime(min_iso, fmt),
+                              latest=datetime.strptime(max_iso, fmt),
+                              horizon_days=SLOT_SUGGEST_DAYS, ignore=ignore)
+    return [(f"{t:%m/%d %H:%M}", data_fmt.format(t=t)) for t in slots]
+
+def _reply_unavailable(c, msg: str, options):
+    if options:
+        msg = f"{msg}\n👇 以下是離你選的時間最近的空檔，點一下即可選擇："
+    return reply_text(c.api, c.reply_token, msg, quick_replies=options)
+
+def _reply_unavailable_new_booking(c, when: datetime, msg: str):
+    options = _suggest_slots(when, _payload_duration(c.conv.payload), "SLOT_PICK:{t:%Y-%m-%d %H:%M}")
+    if options:
+        options.append(("更多時段…", "SLOT_LIST"))
+    return _reply_unavailable(c, msg, options)
+
+def _payload_duration(p) -> int | None:
+    return occupancy.service_duration((p or {}).get("service_id"))
+
+def _release_if_active(o):
+    if o.status in ACTIVE_STATUSES:
+        occupancy.release_at(o.booked_at, occupancy.order_duration(o))
+
+def order_listing():
+    """
+    訂單列表共用查詢：車牌 joinedload、明細 selectinload，服務名稱查 catalog（程序內快取）；
+    不論幾筆訂單、幾個明細，make_order_rows 都只需要這 2 個查詢。
+    """
+    return Order.query.options(
+        joinedload(Order.vehicle).load_only(Vehicle.plate),
+        selectinload(Order.items).load_only(OrderItem.service_id),
+    )
 
 def make_order_rows(orders):
+    """orders 需由 order_listing() 查出（否則每筆都會 lazy load 車輛與明細）。"""
+    by_id = current_catalog().by_id
     rows = []
     for o in orders:
         t = o.booked_at.strftime("%Y-%m-%d %H:%M") if o.booked_at else "未排定"
-        plate = "-"
-        if getattr(o, "vehicle", None) and getattr(o.vehicle, "plate", None):
-            plate = o.vehicle.plate
-
-        svc_names = []
-        try:
-            for it in getattr(o, "items", []):
-                if getattr(it, "service", None) and getattr(it.service, "name", None):
-                    svc_names.append(it.service.name)
-        except Exception:
-            items = OrderItem.query.filter_by(order_id=o.id).all()
-            svc_ids = [it.service_id for it in items if it.service_id]
-            if svc_ids:
-                svcs = Service.query.filter(Service.id.in_(svc_ids)).all()
-                id2name = {s.id: s.name for s in svcs}
-                for it in items:
-                    name = id2name.get(it.service_id)
-                    if name: svc_names.append(name)
-
+        plate = o.vehicle.plate if o.vehicle is not None and o.vehicle.plate else "-"
+        svc_names = [by_id[it.service_id].name for it in o.items if it.service_id in by_id]
         services = "、".join(svc_names) if svc_names else "-"
         rows.append({
             "id": o.id, "status": o.status, "time": t, "plate": plate, "services": services
@@ -255,6 +300,8 @@ def _datetimepicker_bounds(current=None, booked_at: datetime | None = None):
 
 # ---------- Admin ----------
 from flask_admin import Admin, expose, BaseView
+from flask_admin.base import AdminViewMeta
+from flask_admin.actions import action
 from flask_admin.contrib.sqla import ModelView
 from flask_basicauth import BasicAuth
 from wtforms.fields import DateTimeLocalField
@@ -264,6 +311,8 @@ from flask_admin.model.form import InlineFormAdmin
 app.config["BASIC_AUTH_USERNAME"] = os.getenv("ADMIN_USERNAME", "admin")
 app.config["BASIC_AUTH_PASSWORD"] = os.getenv("ADMIN_PASSWORD", "changeme")
 app.config["BASIC_AUTH_FORCE"] = False
+# 後台的 flash 訊息存在 session cookie；未設定時每個程序隨機產生（多 worker 時請設定）
+app.config["SECRET_KEY"] = os.getenv("SECRET_KEY") or os.urandom(24).hex()
 basic_auth = BasicAuth(app)
 
 class SecuredModelView(ModelView):
@@ -289,9 +338,56 @@ class ServiceAdmin(SecuredModelView):
     column_filters = ("duration_min", "recommend_days", "created_at")
 
 class OrderItemInline(InlineFormAdmin):
-    form_columns = ("service", "qty", "unit_price", "subtotal")
-
-class OrderAdmin(SecuredModelView):
+    form_columns = ("id", "service", "qty", "unit_price", "subtotal")   # inline 表單要有 id（hidden）才能對應既有明細
+
+def _order_span(order_id):
+    """有效訂單目前佔用的 (booked_at, 服務分鐘數)；不佔名額（沒有時間、非有效狀態、不存在）時為 None。"""
+    o = db.session.get(Order, order_id) if order_id else None
+    if o is None or o.status not in ACTIVE_STATUSES or o.booked_at is None:
+        return None
+    return o.booked_at, occupancy.order_durations([o.id]).get(o.id)
+
+def _apply_span_change(before, after):
+    if before == after:
+        return
+    if before:
+        occupancy.release_at(*before)
+    if after:
+        occupancy.reserve_at(*after, force=True)     # 後台直接改：不擋容量（與 confirm 動作相同）
+
+class _AbstractViewMeta(AdminViewMeta, ABCMeta):
+    pass
+
+class OccupancyTrackingView(SecuredModelView, metaclass=_AbstractViewMeta):
+    """
+    後台新增 / 修改 / 刪除訂單或明細時，依改動前後訂單佔用的格子調整 slot_occupancy
+    （與異動同一個 commit）。改動前的狀態在 populate_obj 之前記下（之後 lazy load 可能先 autoflush）。
+    子類別實作 _order_ids 與 _span_after_delete（沒實作就無法建立 view）。
+    """
+    @abstractmethod
+    def _order_ids(self, model):
+        """這筆資料影響的訂單 id。"""
+
+    @abstractmethod
+    def _span_after_delete(self, model, span):
+        """刪除這筆資料後，訂單的 (booked_at, 分鐘數)；訂單整個不見了回 None。"""
+
+    def update_model(self, form, model):
+        model._span_before = {oid: _order_span(oid) for oid in self._order_ids(model)}
+        return super().update_model(form, model)
+
+    def on_model_change(self, form, model, is_created):
+        before = getattr(model, "_span_before", {})
+        db.session.flush()
+        for oid in set(before) | set(self._order_ids(model)):
+            _apply_span_change(before.get(oid), _order_span(oid))
+
+    def on_model_delete(self, model):
+        for oid in self._order_ids(model):
+            span = _order_span(oid)
+            _apply_span_change(span, self._span_after_delete(model, span))
+
+class OrderAdmin(OccupancyTrackingView):
     column_list = ("id", "user_id", "vehicle_id", "status", "booked_at", "created_at")
     column_searchable_list = ("status",)
     column_filters = ("status", "booked_at", "vehicle_id", "user_id", "created_at")
@@ -299,30 +395,66 @@ class OrderAdmin(SecuredModelView):
     inline_models = (OrderItemInline(OrderItem),)
     form_overrides = {"booked_at": DateTimeLocalField}
     form_args = {"booked_at": {"format": "%Y-%m-%dT%H:%M", "validators": [Opt()]}}
+    def _order_ids(self, model):
+        return [model.id] if model.id else []
+    def _span_after_delete(self, model, span):
+        return None
+    def _transition(self, status, ids, notify=False, where=None):
+        # 一條條件式 UPDATE 處理整批；名額、日曆、保養提醒在 order_actions 內一起更新
+        where = where or [Order.id.in_([int(pk) for pk in ids])]
+        tr = order_actions.transition(status, *where)
+        db.session.commit()
+        sent = order_actions.notify_customers(tr) if notify else 0
+        failed = order_actions.failed_recipients()
+        if failed:
+            # 通知在背景送，失敗會在下一次後台動作時看到
+            flash(f"⚠️ 先前有 {failed} 位客人的通知重試後仍未送達，下次「並通知客人」時會用同一個 key 重送", "warning")
+        return len(tr.rows), sent
+    @action("cancel", "取消選取的預約", "確定取消選取的預約？")
     def action_cancel(self, ids):
-        count = 0
-        for pk in ids:
-            o = Order.query.get(pk)
-            if o and o.status != "canceled":
-                o.status = "canceled"; db.session.add(o); count += 1
-        db.session.commit(); self.flash(f"已取消 {count} 筆預約", "success")
+        count, _ = self._transition("canceled", ids)
+        flash(f"已取消 {count} 筆預約", "success")
+    @action("cancel_notify", "取消選取的預約並通知客人", "確定取消選取的預約並通知客人？")
+    def action_cancel_notify(self, ids):
+        count, sent = self._transition("canceled", ids, True)
+        flash(f"已取消 {count} 筆預約，通知 {sent} 位客人", "success")
+    @action("confirm", "將選取的預約標記為 confirmed")
     def action_confirm(self, ids):
-        count = 0
-        for pk in ids:
-            o = Order.query.get(pk)
-            if o and o.status != "confirmed":
-                o.status = "confirmed"; db.session.add(o); count += 1
-        db.session.commit(); self.flash(f"已標記 {count} 筆為 confirmed", "success")
+        # 已取消的訂單恢復時強制佔名額（不擋容量）
+        count, _ = self._transition("confirmed", ids)
+        flash(f"已標記 {count} 筆為 confirmed", "success")
+    @action("confirm_notify", "將選取的預約標記為 confirmed 並通知客人")
+    def action_confirm_notify(self, ids):
+        count, sent = self._transition("confirmed", ids, True)
+        flash(f"已標記 {count} 筆為 confirmed，通知 {sent} 位客人", "success")
+    @action("complete", "將選取的預約標記為完工（計算下次保養）")
+    def action_complete(self, ids):
+        count, _ = self._transition(COMPLETED_STATUS, ids)
+        flash(f"已標記 {count} 筆為完工", "success")
+    @action("complete_day", "將選取預約當天的所有有效預約標記為完工", "確定將這些日期的所有有效預約標記為完工？")
+    def action_complete_day(self, ids):
+        days = {at.date() for at in db.session.execute(
+            select(Order.booked_at).where(Order.id.in_([int(pk) for pk in ids]), Order.booked_at != None)).scalars()}
+        if not days:
+            return flash("選取的預約沒有預約時間", "warning")
+        spans = [and_(Order.booked_at >= datetime.combine(d, dtime.min),
+                      Order.booked_at < datetime.combine(d + timedelta(days=1), dtime.min)) for d in sorted(days)]
+        count, _ = self._transition(COMPLETED_STATUS, ids, where=[or_(*spans), Order.status.in_(ACTIVE_STATUSES)])
+        flash(f"{'、'.join(f'{d:%m/%d}' for d in sorted(days))} 共 {count} 筆有效預約標記為完工", "success")
     action_disallowed_list = []
-    def get_actions(self):
-        actions = super().get_actions()
-        actions["cancel"] = (self.action_cancel, "cancel", "取消選取的預約")
-        actions["confirm"] = (self.action_confirm, "confirm", "將選取的預約標記為 confirmed")
-        return actions
 
-class OrderItemAdmin(SecuredModelView):
+class OrderItemAdmin(OccupancyTrackingView):
     column_list = ("id", "order_id", "service_id", "qty", "unit_price", "subtotal")
     column_filters = ("order_id", "service_id")
+    def _order_ids(self, model):
+        # 改到別的訂單時，新舊兩筆都要重算
+        return [oid for oid in {model.order_id, model.order.id if model.order is not None else None} if oid]
+    def _span_after_delete(self, model, span):
+        # 訂單少了這項服務的時間；沒有明細了就與 order_durations 一樣視為 None（預設時間）
+        if span is None:
+            return None
+        left = (span[1] or 0) - (occupancy.service_duration(model.service_id) or 0)
+        return span[0], left if left > 0 else None
 
 class ConversationAdmin(SecuredModelView):
     column_list = ("id", "line_user_id", "state", "updated_at")
@@ -365,6 +497,16 @@ class CalendarView(BaseView):
                   displayEventEnd: true
                 });
                 calendar.render();
+
+                // 即時更新：resync = 重抓目前範圍（沒變動時是 304）；其餘只改那一筆
+                var feed = new EventSource("/admin/api/events/stream");
+                feed.addEventListener("order", function(e) {
+                  var msg = JSON.parse(e.data);
+                  if (msg.op === "resync") { calendar.refetchEvents(); return; }
+                  var old = calendar.getEventById(String(msg.id));
+                  if (old) old.remove();
+                  if (msg.op === "upsert") calendar.addEvent(msg.event, calendar.getEventSources()[0] || true);
+                });
               });
             </script>
           </body>
@@ -372,7 +514,17 @@ class CalendarView(BaseView):
         """
         return render_template_string(html)
 
-# 供 FullCalendar 取事件
+# 供 FullCalendar 取事件（查詢與 JSON 在 order_feed.iter_json）
+# 訂單 / 明細 / 車輛經 ORM 變動時，commit 後 cache_versions.orders +1（每次 commit 最多一次，
+# 不在客人下單的 transaction 裡鎖這一列；不經 ORM 的 bulk UPDATE 要自己 versions.bump_after_commit）；
+# ETag = orders + services 版本 + 查詢區間，FullCalendar 重複抓同一區間時只需一次主鍵查詢就回 304
+versions.track("orders", Order, OrderItem, Vehicle, after_commit=True)
+
+def _events_etag(start, end):
+    vers = dict(db.session.query(CacheVersion.name, CacheVersion.version)
+                .filter(CacheVersion.name.in_(("orders", "services"))).all())
+    return f'ev-{vers.get("orders", 0)}-{vers.get("services", 0)}-{start:%Y%m%d%H%M}-{end:%Y%m%d%H%M}'
+
 @app.get("/admin/api/events")
 def admin_events():
     start_str = request.args.get("start")
@@ -384,25 +536,23 @@ def admin_events():
         start = datetime.now() - timedelta(days=7)
         end = datetime.now() + timedelta(days=30)
 
-    q = (Order.query
-         .filter(Order.booked_at != None)
-         .filter(Order.booked_at >= start)
-         .filter(Order.booked_at <= end)
-         .order_by(Order.booked_at.asc()))
-    events = []
-    for o in q.all():
-        title = f"#{o.id} {o.status}"
-        if getattr(o, "vehicle", None):
-            title = f"#{o.id} {o.vehicle.plate} {o.status}"
-        events.append({
-            "id": o.id,
-            "title": title,
-            "start": o.booked_at.isoformat(),
-            "end": (o.booked_at + timedelta(minutes=60)).isoformat(),
-            "color": "#2E86C1" if o.status in ("pending", "confirmed") else "#999999",
-            "url": f"/admin/order/edit/?id={o.id}"
-        })
-    return jsonify(events)
+    etag = _events_etag(start, end)
+    if request.if_none_match.contains_weak(etag):
+        resp = Response(status=304)
+    else:
+        resp = Response(stream_with_context(order_feed.iter_json(start, end)), mimetype="application/json")
+    resp.set_etag(etag, weak=True)
+    resp.headers["Cache-Control"] = "no-cache"
+    return resp
+
+# 日曆即時更新（SSE）：訂單新增 / 取消 / 改期時推送單筆事件，前端直接改日曆上的那一格
+@app.get("/admin/api/events/stream")
+def admin_events_stream():
+    sub = order_feed.subscribe()
+    if sub is None:
+        return "Too many calendar clients", 503
+    return Response(order_feed.sse_stream(sub), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 def setup_admin(app):
     admin = Admin(app, name="MCShop 後台", template_mode="bootstrap4", url="/admin")
@@ -422,406 +572,523 @@ def protect_admin():
         if not basic_auth.authenticate():
             return basic_auth.challenge()
 
+# ========== 指令路由 ==========
+# 文字與 postback 各一張路由表（router.py），import 時建好；
+# 優先序：exact → prefix → pattern → conv.state → default
+text_routes = Router("text")
+postback_routes = Router("postback")
+
+def _reply_my_orders(c):
+    orders = (order_listing()
+              .filter(Order.user_id == c.user.id)
+              .filter(Order.status.in_(["pending","confirmed"]))
+              .order_by(Order.booked_at.asc().nullsfirst(), Order.id.desc())
+              .limit(10).all())
+    if not orders:
+        return reply_text(c.api, c.reply_token, "目前沒有預約紀錄。輸入「預約」可以開始預約。")
+    rows = make_order_rows(orders)
+    return reply_flex(c.api, c.reply_token, "我的預約列表", carousel_orders_full(rows))
+
+def _reply_my_vehicles(c):
+    vehicles = (Vehicle.query
+                .filter_by(user_id=c.user.id)
+                .order_by(Vehicle.created_at.desc())
+                .all())
+    vrows = [{"id":v.id,"plate":v.plate,"brand":v.brand,"model":v.model} for v in vehicles]
+    return reply_flex(c.api, c.reply_token, "我的車輛", carousel_my_vehicles(vrows))
+
+def _reply_services_first_page(c):
+    return reply_flex(c.api, c.reply_token, "請選擇服務", current_catalog().page(1))
+
+# ---------- 文字指令 ----------
+# 通用取消（純文字）
+@text_routes.exact("取消", "cancel")
+def text_cancel_flow(c):
+    holds.release(c.user.id)
+    reset_conv(c.conv)
+    return reply_text(c.api, c.reply_token, "已取消流程 ✅\n需要預約請輸入「預約」。")
+
+# 文字快速指令（相容舊 message 按鈕）
+@text_routes.pattern(r"^取消預約\s*#?(\d+)$")
+def text_cancel_order(c):
+    oid = int(c.m.group(1))
+    o = order_listing().filter_by(id=oid, user_id=c.user.id).first()
+    if not o: return reply_text(c.api, c.reply_token, "找不到這筆預約或不屬於你。")
+    row = make_order_rows([o])[0]
+    c.conv.state = "cancel_confirm_flex"; c.conv.payload = {"order_id": oid}
+    return reply_flex(c.api, c.reply_token, "確認取消", bubble_cancel_confirm(row))
+
+@text_routes.pattern(r"^確認取消\s*#?(\d+)$")
+def text_cancel_order_confirm(c):
+    oid = int(c.m.group(1))
+    o = Order.query.filter_by(id=oid, user_id=c.user.id).first()
+    if not o: return reply_text(c.api, c.reply_token, "找不到這筆預約或不屬於你。")
+    if o.status != "canceled":
+        _release_if_active(o)
+        o.status = "canceled"; db.session.add(o)
+    reset_conv(c.conv)
+    when = o.booked_at.strftime("%Y-%m-%d %H:%M") if o.booked_at else "未排定"
+    return reply_text(c.api, c.reply_token, f"✅ 已取消 #{o.id}｜{when}")
+
+@text_routes.pattern(r"^調整時間\s*#?(\d+)$")
+def text_reschedule(c):
+    oid = int(c.m.group(1))
+    o = order_listing().filter_by(id=oid, user_id=c.user.id).first()
+    if not o: return reply_text(c.api, c.reply_token, "找不到這筆預約或不屬於你。")
+    row = make_order_rows([o])[0]
+    initial_iso, min_iso, max_iso = _datetimepicker_bounds(booked_at=o.booked_at)
+    c.conv.state = "reschedule_wait_pick"; set_payload(c.conv, order_id=oid)
+    return reply_flex(c.api, c.reply_token, "選擇新的日期時間",
+                      bubble_reschedule_picker(row, initial_iso, min_iso, max_iso))
+
+# 入口：開始預約
+@text_routes.exact("預約", "預約維修", "預約保養")
+def text_start_booking(c):
+    c.conv.state = "ask_name"; c.conv.payload = {}
+    _hydrate_payload_defaults_from_user(c.user, c.conv)
+    _sync_booking_display(c.conv)
+    return reply_text(c.api, c.reply_token, "請輸入您的姓名：")
+
+# 我的車輛（Flex）
+@text_routes.exact("我的車輛", "車輛", "車子")
+def text_my_vehicles(c):
+    return _reply_my_vehicles(c)
+
+# 設定（Flex）
+@text_routes.exact("設定", "設定資料", "會員設定", "帳戶設定")
+def text_settings(c):
+    return reply_flex(c.api, c.reply_token, "設定", bubble_settings(c.user))
+
+# 查詢我的預約（Carousel，含取消/調整）
+@text_routes.exact("我的預約", "查詢預約")
+def text_my_orders(c):
+    return _reply_my_orders(c)
+
+# 表單：姓名/電話
+@text_routes.state("ask_name")
+def text_ask_name(c):
+    set_payload(c.conv, name=(c.key.strip() or c.user.name or ""))
+    _sync_booking_display(c.conv)
+    c.conv.state = "ask_phone"
+    return reply_text(c.api, c.reply_token, "請輸入您的電話（09xxxxxxxx）：")
+
+@text_routes.state("ask_phone")
+def text_ask_phone(c):
+    text = c.key
+    if not text.isdigit() or len(text) < 8:
+        return reply_text(c.api, c.reply_token, "電話格式不太對，請再輸入一次（例：0912345678）")
+    set_payload(c.conv, phone=text.strip())
+    _sync_booking_display(c.conv)
+
+    # 選車
+    vehicles = Vehicle.query.filter_by(user_id=c.user.id).order_by(Vehicle.created_at.desc()).all()
+    if not vehicles:
+        c.conv.state="v_add_plate"
+        return reply_text(c.api, c.reply_token, "目前沒有綁定車輛，請輸入車牌（例：ABC-1234）")
+    elif len(vehicles)==1:
+        v = vehicles[0]
+        set_payload(c.conv, vehicle_id=v.id, plate=v.plate, svc_page=1)
+        c.conv.state="svc_page"
+        _sync_booking_display(c.conv)
+        return _reply_services_first_page(c)
+    else:
+        opts = [{"i":i+1,"label":f"{v.plate} {v.brand or ''} {v.model or ''}".strip(),"id":v.id}
+                for i,v in enumerate(vehicles)]
+        set_payload(c.conv, vehicle_opts=opts)
+        c.conv.state = "choose_vehicle"
+        _sync_booking_display(c.conv)
+        return reply_flex(c.api, c.reply_token, "請選擇車輛", bubble_vehicle_picker(opts))
+
+# 新增車牌
+@text_routes.state("v_add_plate")
+def text_add_plate(c):
+    plate = c.key.upper().strip()
+    if not PLATE_RE.match(plate):
+        return reply_text(c.api, c.reply_token, "車牌格式不符，請再輸入（例：ABC-1234）")
+    v = Vehicle(user_id=c.user.id, plate=plate); db.session.add(v); db.session.flush()
+    set_payload(c.conv, vehicle_id=v.id, plate=v.plate, svc_page=1)
+    c.conv.state="svc_page"
+    _sync_booking_display(c.conv)
+    return _reply_services_first_page(c)
+
+# 接收設定修改（姓名/電話）
+@text_routes.state("edit_name")
+def text_edit_name(c):
+    c.user.name = c.key.strip()
+    reset_conv(c.conv)
+    return reply_text(c.api, c.reply_token, f"已更新姓名為：{_safe_str(c.user.name)} ✅")
+
+@text_routes.state("edit_phone")
+def text_edit_phone(c):
+    text = c.key
+    if not text.isdigit() or len(text) < 8:
+        return reply_text(c.api, c.reply_token, "電話格式不太對，請再輸入一次（例：0912345678）")
+    c.user.phone = text.strip()
+    reset_conv(c.conv)
+    return reply_text(c.api, c.reply_token, f"已更新電話為：{_safe_str(c.user.phone)} ✅")
+
+# 預設
+@text_routes.default
+def text_default(c):
+    return reply_text(c.api, c.reply_token, "輸入「預約」開始預約（Flex 選單）")
+
+# ---------- Postback ----------
+# 設定：修改姓名 / 電話 / 我的車輛（入口）
+@postback_routes.exact("SETTINGS_EDIT_NAME")
+def pb_settings_edit_name(c):
+    c.conv.state = "edit_name"; c.conv.payload = {}
+    _hydrate_payload_defaults_from_user(c.user, c.conv); _sync_booking_display(c.conv)
+    return reply_text(c.api, c.reply_token, "請輸入新姓名：")
+
+@postback_routes.exact("SETTINGS_EDIT_PHONE")
+def pb_settings_edit_phone(c):
+    c.conv.state = "edit_phone"; c.conv.payload = {}
+    _hydrate_payload_defaults_from_user(c.user, c.conv); _sync_booking_display(c.conv)
+    return reply_text(c.api, c.reply_token, "請輸入新電話（09xxxxxxxx）：")
+
+@postback_routes.exact("MY_VEHICLES")
+def pb_my_vehicles(c):
+    return _reply_my_vehicles(c)
+
+# 車輛選擇 / 使用
+@postback_routes.exact("VEHICLE_ADD")
+def pb_vehicle_add(c):
+    c.conv.state="v_add_plate"
+    return reply_text(c.api, c.reply_token, "請輸入新車牌（例：ABC-1234）：")
+
+@postback_routes.prefix("VEHICLE_PICK:", r"(\d+)")
+def pb_vehicle_pick(c):
+    idx = int(c.m.group(1))
+    opts = c.conv.payload.get("vehicle_opts", [])
+    chosen = next((o for o in opts if o["i"]==idx), None)
+    if not chosen:
+        return reply_text(c.api, c.reply_token, "序號不在清單中，請重新選擇。")
+    plate_label = chosen["label"].split()[0] if chosen["label"] else "-"
+    set_payload(c.conv, vehicle_id=chosen["id"], plate=plate_label, svc_page=1)
+    c.conv.state="svc_page"
+    _sync_booking_display(c.conv)
+    return _reply_services_first_page(c)
+
+@postback_routes.prefix("VEHICLE_USE:", r"(\d+)")
+def pb_vehicle_use(c):
+    vid = int(c.m.group(1))
+    v = Vehicle.query.filter_by(id=vid, user_id=c.user.id).first()
+    if not v:
+        return reply_text(c.api, c.reply_token, "找不到這台車或不屬於你。")
+    set_payload(c.conv, vehicle_id=v.id, plate=v.plate, svc_page=1)
+    c.conv.state="svc_page"
+    _sync_booking_display(c.conv)
+    return _reply_services_first_page(c)
+
+# 服務分頁 / 選擇
+@postback_routes.exact("SVC_PREV", "SVC_NEXT")
+def pb_services_page(c):
+    catalog = current_catalog()
+    page = c.conv.payload.get("svc_page", 1) or 1
+    page = max(1, page-1) if c.key == "SVC_PREV" else min(page+1, catalog.page_count)
+    set_payload(c.conv, svc_page=page)
+    _sync_booking_display(c.conv)
+    return reply_flex(c.api, c.reply_token, "請選擇服務", catalog.page(page))
+
+@postback_routes.prefix("SVC_PICK:", r"(.+)")
+def pb_service_pick(c):
+    name = c.m.group(1)
+    s = current_catalog().by_name.get(name)
+    if not s:
+        return reply_text(c.api, c.reply_token, "找不到此服務，請重新選擇。")
+
+    # 存入所選服務（同時寫 service 與 service_name）
+    set_payload(c.conv, service_id=s.id, service_name=s.name, service=s.name)
+
+    # datetimepicker（新預約）
+    initial_iso, min_iso, max_iso = _datetimepicker_bounds(booked_at=None)
+    c.conv.state = "new_booking_pick"
+    _sync_booking_display(c.conv)
+
+    return reply_flex(
+        c.api, c.reply_token, "選擇預約時間",
+        bubble_new_booking_picker(c.conv.payload, initial_iso, min_iso, max_iso)
+    )
+
+# 清單式時段分頁 / 選擇
+# payload 只記游標：slot_page、本頁第一個 / 最後一個時間（slot_first / slot_last），
+# 翻頁時從游標往後（或往前）算出一頁所需的時段，不存整份清單
+SLOT_PAGE_SIZE = 6
+_SLOT_FMT = "%Y-%m-%d %H:%M"
+
+def _slot_range():
+    fmt = "%Y-%m-%dT%H:%M"
+    _initial, min_iso, max_iso = _datetimepicker_bounds()
+    return datetime.strptime(min_iso, fmt), datetime.strptime(max_iso, fmt)
+
+def _reply_slot_page(c, slots, page: int, has_next: bool):
+    set_payload(c.conv, slot_page=page,
+                slot_first=slots[0].strftime(_SLOT_FMT) if slots else None,
+                slot_last=slots[-1].strftime(_SLOT_FMT) if slots else None)
+    _sync_booking_display(c.conv)
+    return reply_flex(c.api, c.reply_token, "請選擇時段",
+                      bubble_timeslots(slots, page, SLOT_PAGE_SIZE, has_prev=page > 1, has_next=has_next))
+
+def _slot_page_after(c, after: datetime, page: int):
+    _earliest, latest = _slot_range()
+    it = iter_available(after, _payload_duration(c.conv.payload), bound=latest)
+    items = list(islice(it, SLOT_PAGE_SIZE + 1))   # 多算一個判斷有沒有下一頁
+    return _reply_slot_page(c, items[:SLOT_PAGE_SIZE], page, len(items) > SLOT_PAGE_SIZE)
+
+@postback_routes.exact("SLOT_LIST")
+def pb_slot_list(c):
+    earliest, _latest = _slot_range()
+    return _slot_page_after(c, earliest - timedelta(minutes=1), 1)
+
+@postback_routes.exact("SLOT_PREV", "SLOT_NEXT")
+def pb_slots_page(c):
+    p = c.conv.payload or {}
+    page = p.get("slot_page", 1) or 1
+    if "slots_cache" in p:
+        # 舊版 payload 存整份清單：換成游標後丟掉
+        cached = p["slots_cache"][(page - 1) * SLOT_PAGE_SIZE:page * SLOT_PAGE_SIZE]
+        c.conv.payload = {k: v for k, v in p.items() if k != "slots_cache"}
+        set_payload(c.conv, slot_first=cached[0] if cached else None, slot_last=cached[-1] if cached else None)
+        p = c.conv.payload
+    earliest, _latest = _slot_range()
+    if c.key == "SLOT_NEXT" and p.get("slot_last"):
+        return _slot_page_after(c, datetime.strptime(p["slot_last"], _SLOT_FMT), page + 1)
+    if c.key == "SLOT_PREV" and p.get("slot_first") and page > 1:
+        it = iter_available(datetime.strptime(p["slot_first"], _SLOT_FMT),
+                            _payload_duration(p), reverse=True, bound=earliest)
+        items = list(islice(it, SLOT_PAGE_SIZE))[::-1]
+        if len(items) == SLOT_PAGE_SIZE:
+            return _reply_slot_page(c, items, page - 1, True)
+    # 沒有游標或前面已不足一頁：回到第一頁
+    return _slot_page_after(c, earliest - timedelta(minutes=1), 1)
+
+@postback_routes.prefix("SLOT_PICK:", r"(\d{4}-\d{2}-\d{2}\s\d{2}:\d{2})")
+def pb_slot_pick(c):
+    when = datetime.strptime(c.m.group(1), "%Y-%m-%d %H:%M")
+    # 選好就先保留名額，確認前不會被別人訂走
+    ok, reason = holds.place(c.user.id, when, _payload_duration(c.conv.payload))
+    if not ok:
+        return _reply_unavailable_new_booking(c, when, CAPACITY_MESSAGES[reason])
+    set_payload(c.conv, booked_at=when.strftime("%Y-%m-%d %H:%M"))
+    c.conv.state = "confirm"
+    _sync_booking_display(c.conv)
+    return reply_flex(c.api, c.reply_token, "請確認預約資訊", bubble_confirm(c.conv.payload))
+
+# 確認/取消整個預約流程
+@postback_routes.exact("CONFIRM_SUBMIT")
+def pb_confirm_submit(c):
+    user, conv = c.user, c.conv
+    _sync_booking_display(conv)
+    p = conv.payload or {}
+
+    # 防呆：必須有時間
+    if not p.get("booked_at"):
+        return reply_text(c.api, c.reply_token, "請先選擇預約時間喔 🙏")
+
+    # 若尚未輸入姓名/電話但帳號有資料，補齊
+    if not p.get("name") and user.name:
+        p["name"] = user.name
+    if not p.get("phone") and user.phone:
+        p["phone"] = user.phone
+    conv.payload = p
+
+    user.name = p.get("name") or user.name
+    user.phone = p.get("phone") or user.phone
+
+    when = datetime.strptime(p["booked_at"], "%Y-%m-%d %H:%M")
+    # 沿用選時間時的 hold；hold 已過期被清掉才重新條件式佔名額
+    ok, reason = holds.confirm(user.id, when, _payload_duration(p))
+    if not ok:
+        return _reply_unavailable_new_booking(c, when, CAPACITY_MESSAGES[reason])
+    order = Order(
+        user_id=user.id,
+        vehicle_id=p.get("vehicle_id"),
+        status="pending",
+        booked_at=when,
+        note=f"車牌:{p.get('plate')}"
+    )
+    db.session.add(order); db.session.flush()
+    item = OrderItem(order_id=order.id, service_id=p.get("service_id"), qty=1, unit_price=0, subtotal=0)
+    db.session.add(item)
+    reset_conv(conv)
+    return reply_flex(c.api, c.reply_token, "預約成功",
+                     bubble_booking_success(order.id, p))
+
+@postback_routes.exact("FLOW_CANCEL")
+def pb_flow_cancel(c):
+    holds.release(c.user.id)
+    reset_conv(c.conv)
+    return reply_text(c.api, c.reply_token, "已取消流程 ✅\n需要預約請輸入「預約」。")
+
+# 我的預約：取消/改期
+@postback_routes.prefix("CANCEL#", r"(\d+)")
+def pb_cancel(c):
+    oid = int(c.m.group(1))
+    o = order_listing().filter_by(id=oid, user_id=c.user.id).first()
+    if not o:
+        return reply_text(c.api, c.reply_token, "查無此預約。")
+    row = make_order_rows([o])[0]
+    c.conv.state = "cancel_confirm_flex"; set_payload(c.conv, order_id=oid)
+    return reply_flex(c.api, c.reply_token, "確認取消", bubble_cancel_confirm(row))
+
+@postback_routes.prefix("CANCEL_CONFIRM#", r"(\d+)")
+def pb_cancel_confirm(c):
+    oid = int(c.m.group(1))
+    o = Order.query.filter_by(id=oid, user_id=c.user.id).first()
+    if not o:
+        return reply_text(c.api, c.reply_token, "查無此預約。")
+    _release_if_active(o)
+    o.status = "canceled"; db.session.add(o)
+    when = o.booked_at.strftime("%Y-%m-%d %H:%M") if o.booked_at else "未排定"
+    reset_conv(c.conv)
+    return reply_text(c.api, c.reply_token, f"✅ 已取消 #{o.id}｜{when}")
+
+@postback_routes.exact("BACK_MY_ORDERS")
+def pb_back_my_orders(c):
+    return _reply_my_orders(c)
+
+def _picked_datetime(params):
+    picked = params.get("datetime") or params.get("date") or params.get("time")
+    return datetime.strptime(picked, "%Y-%m-%dT%H:%M") if picked else None
+
+# 新預約：datetimepicker 回傳（data = NEWBOOK）
+@postback_routes.exact("NEWBOOK")
+def pb_new_booking_picked(c):
+    when = _picked_datetime(c.params)
+    if when is None:
+        return "OK"
+
+    # 選好就先保留名額，確認前不會被別人訂走
+    ok, reason = holds.place(c.user.id, when, _payload_duration(c.conv.payload))
+    if not ok:
+        return _reply_unavailable_new_booking(c, when, CAPACITY_MESSAGES[reason])
+
+    # 存入時間，進入確認頁
+    set_payload(c.conv, booked_at=when.strftime("%Y-%m-%d %H:%M"))
+    c.conv.state = "confirm"
+    _sync_booking_display(c.conv)
+
+    return reply_flex(c.api, c.reply_token, "請確認預約資訊", bubble_confirm(c.conv.payload))
+
+# 改期：沒有 params → 顯示 datetimepicker；picker 回傳（有 params）→ 套用新時間
+@postback_routes.prefix("RESCHEDULE#", r"(\d+)")
+def pb_reschedule(c):
+    oid = int(c.m.group(1))
+    if not c.params:
+        o = order_listing().filter_by(id=oid, user_id=c.user.id).first()
+        if not o:
+            return reply_text(c.api, c.reply_token, "查無此預約。")
+        row = make_order_rows([o])[0]
+        initial_iso, min_iso, max_iso = _datetimepicker_bounds(booked_at=o.booked_at)
+        c.conv.state = "reschedule_wait_pick"; set_payload(c.conv, order_id=oid)
+        return reply_flex(c.api, c.reply_token, "選擇新的日期時間",
+                          bubble_reschedule_picker(row, initial_iso, min_iso, max_iso))
+
+    when = _picked_datetime(c.params)
+    if when is None:
+        return "OK"
+    return _apply_reschedule(c, oid, when)
+
+# 改期時段已滿時的 quick reply 建議（data = RESCHEDULE_AT#<order_id>@<時間>）
+@postback_routes.prefix("RESCHEDULE_AT#", r"(\d+)@(\d{4}-\d{2}-\d{2}\s\d{2}:\d{2})")
+def pb_reschedule_at(c):
+    return _apply_reschedule(c, int(c.m.group(1)), datetime.strptime(c.m.group(2), "%Y-%m-%d %H:%M"))
+
+def _apply_reschedule(c, oid: int, when: datetime):
+    o = Order.query.filter_by(id=oid, user_id=c.user.id).first()
+    if not o:
+        return reply_text(c.api, c.reply_token, "查無此預約。")
+    duration = occupancy.order_duration(o)
+    active = o.status in ACTIVE_STATUSES
+    if active:
+        # 只佔新時間多出來的格子、放掉舊時間不再用的格子
+        ok, reason = occupancy.move(o.booked_at, when, duration)
+        msg = CAPACITY_MESSAGES.get(reason, "")
+    else:
+        ok, msg = check_capacity(when, duration)
+    if not ok:
+        # 自己原本佔的格子在建議時視為空出來
+        own = occupancy.cells_for(o.booked_at, duration, strict=False)[0] if active and o.booked_at else None
+        options = _suggest_slots(when, duration, f"RESCHEDULE_AT#{o.id}@{{t:%Y-%m-%d %H:%M}}", ignore=own or ())
+        return _reply_unavailable(c, msg, options)
+    o.booked_at = when
+    if o.status == "pending":
+        o.status = "confirmed"
+    db.session.add(o)
+    reset_conv(c.conv)
+    return reply_text(c.api, c.reply_token, f"✅ 已改期：#{o.id} → {when:%Y-%m-%d %H:%M}")
+
 # ========== 文字事件 ==========
 @handler.add(MessageEvent, message=TextMessageContent)
 def on_text(event):
+    outbound.bind(event)
     try:
         text = (event.message.text or "").strip()
         print(f"[on_text] user:{event.source.user_id} text:{text}")
-        user = get_or_create_user(event.source.user_id)
-        conv  = get_or_create_conv(event.source.user_id)
+        user, conv = get_user_and_conv(event.source.user_id)
 
         # 先把帳號姓名/電話灌入缺值欄位，再同步 Flex 需要的鍵
         _hydrate_payload_defaults_from_user(user, conv)
         _sync_booking_display(conv)
 
-        with ApiClient(configuration) as api_client:
-            # 通用取消（純文字）
-            if text in ["取消", "cancel"]:
-                reset_conv(conv)
-                return reply_text(api_client, event.reply_token, "已取消流程 ✅\n需要預約請輸入「預約」。")
-
-            # 文字快速指令（相容舊 message 按鈕）
-            m = re.match(r"^取消預約\s*#?(\d+)$", text)
-            if m:
-                oid = int(m.group(1))
-                o = Order.query.filter_by(id=oid, user_id=user.id).first()
-                if not o: return reply_text(api_client, event.reply_token, "找不到這筆預約或不屬於你。")
-                row = make_order_rows([o])[0]
-                conv.state = "cancel_confirm_flex"; conv.payload = {"order_id": oid}; db.session.commit()
-                return reply_flex(api_client, event.reply_token, "確認取消", bubble_cancel_confirm(row))
-
-            m = re.match(r"^確認取消\s*#?(\d+)$", text)
-            if m:
-                oid = int(m.group(1))
-                o = Order.query.filter_by(id=oid, user_id=user.id).first()
-                if not o: return reply_text(api_client, event.reply_token, "找不到這筆預約或不屬於你。")
-                if o.status != "canceled":
-                    o.status = "canceled"; db.session.add(o); db.session.commit()
-                reset_conv(conv)
-                when = o.booked_at.strftime("%Y-%m-%d %H:%M") if o.booked_at else "未排定"
-                return reply_text(api_client, event.reply_token, f"✅ 已取消 #{o.id}｜{when}")
-
-            m = re.match(r"^調整時間\s*#?(\d+)$", text)
-            if m:
-                oid = int(m.group(1))
-                o = Order.query.filter_by(id=oid, user_id=user.id).first()
-                if not o: return reply_text(api_client, event.reply_token, "找不到這筆預約或不屬於你。")
-                row = make_order_rows([o])[0]
-                initial_iso, min_iso, max_iso = _datetimepicker_bounds(booked_at=o.booked_at)
-                conv.state = "reschedule_wait_pick"; set_payload(conv, order_id=oid)
-                return reply_flex(api_client, event.reply_token, "選擇新的日期時間",
-                                  bubble_reschedule_picker(row, initial_iso, min_iso, max_iso))
-
-            # 入口：開始預約
-            if text in ["預約","預約維修","預約保養"]:
-                conv.state = "ask_name"; conv.payload = {}; db.session.commit()
-                _hydrate_payload_defaults_from_user(user, conv)
-                _sync_booking_display(conv)
-                return reply_text(api_client, event.reply_token, "請輸入您的姓名：")
-
-            # 表單：姓名/電話
-            if conv.state == "ask_name":
-                set_payload(conv, name=(text.strip() or user.name or ""))
-                _sync_booking_display(conv)
-                conv.state = "ask_phone"; db.session.commit()
-                return reply_text(api_client, event.reply_token, "請輸入您的電話（09xxxxxxxx）：")
-
-            if conv.state == "ask_phone":
-                if not text.isdigit() or len(text) < 8:
-                    return reply_text(api_client, event.reply_token, "電話格式不太對，請再輸入一次（例：0912345678）")
-                set_payload(conv, phone=text.strip())
-                _sync_booking_display(conv)
-
-                # 選車
-                vehicles = Vehicle.query.filter_by(user_id=user.id).order_by(Vehicle.created_at.desc()).all()
-                if not vehicles:
-                    conv.state="v_add_plate"; db.session.commit()
-                    return reply_text(api_client, event.reply_token, "目前沒有綁定車輛，請輸入車牌（例：ABC-1234）")
-                elif len(vehicles)==1:
-                    v = vehicles[0]
-                    set_payload(conv, vehicle_id=v.id, plate=v.plate, svc_page=1)
-                    conv.state="svc_page"; db.session.commit()
-                    _sync_booking_display(conv)
-                    svc = [{"name": s.name, "mins": (s.duration_min or 30)} for s in Service.query.order_by(Service.name).all()]
-                    return reply_flex(api_client, event.reply_token, "請選擇服務", bubble_services_page(svc, 1))
-                else:
-                    opts = [{"i":i+1,"label":f"{v.plate} {v.brand or ''} {v.model or ''}".strip(),"id":v.id}
-                            for i,v in enumerate(vehicles)]
-                    set_payload(conv, vehicle_opts=opts)
-                    conv.state = "choose_vehicle"; db.session.commit()
-                    _sync_booking_display(conv)
-                    return reply_flex(api_client, event.reply_token, "請選擇車輛", bubble_vehicle_picker(opts))
-
-            # 新增車牌
-            if conv.state == "v_add_plate":
-                plate = text.upper().strip()
-                if not PLATE_RE.match(plate):
-                    return reply_text(api_client, event.reply_token, "車牌格式不符，請再輸入（例：ABC-1234）")
-                v = Vehicle(user_id=user.id, plate=plate); db.session.add(v); db.session.commit()
-                set_payload(conv, vehicle_id=v.id, plate=v.plate, svc_page=1)
-                conv.state="svc_page"; db.session.commit()
-                _sync_booking_display(conv)
-                svc = [{"name": s.name, "mins": (s.duration_min or 30)} for s in Service.query.order_by(Service.name).all()]
-                return reply_flex(api_client, event.reply_token, "請選擇服務", bubble_services_page(svc, 1))
-
-            # 我的車輛（Flex）
-            if text in ["我的車輛","車輛","車子"]:
-                vehicles = (Vehicle.query
-                            .filter_by(user_id=user.id)
-                            .order_by(Vehicle.created_at.desc())
-                            .all())
-                vrows = [{"id":v.id,"plate":v.plate,"brand":v.brand,"model":v.model} for v in vehicles]
-                return reply_flex(api_client, event.reply_token, "我的車輛", carousel_my_vehicles(vrows))
-
-            # 設定（Flex）
-            if text in ["設定","設定資料","會員設定","帳戶設定"]:
-                return reply_flex(api_client, event.reply_token, "設定", bubble_settings(user))
-
-            # 接收設定修改（姓名/電話）
-            if conv.state == "edit_name":
-                user.name = text.strip()
-                db.session.add(user); db.session.commit()
-                reset_conv(conv)
-                return reply_text(api_client, event.reply_token, f"已更新姓名為：{_safe_str(user.name)} ✅")
-
-            if conv.state == "edit_phone":
-                if not text.isdigit() or len(text) < 8:
-                    return reply_text(api_client, event.reply_token, "電話格式不太對，請再輸入一次（例：0912345678）")
-                user.phone = text.strip()
-                db.session.add(user); db.session.commit()
-                reset_conv(conv)
-                return reply_text(api_client, event.reply_token, f"已更新電話為：{_safe_str(user.phone)} ✅")
-
-            # 查詢我的預約（Carousel，含取消/調整）
-            if text in ["我的預約","查詢預約"]:
-                orders = (Order.query
-                          .filter(Order.user_id == user.id)
-                          .filter(Order.status.in_(["pending","confirmed"]))
-                          .order_by(Order.booked_at.asc().nullsfirst(), Order.id.desc())
-                          .limit(10).all())
-                if not orders:
-                    return reply_text(api_client, event.reply_token, "目前沒有預約紀錄。輸入「預約」可以開始預約。")
-                rows = make_order_rows(orders)
-                return reply_flex(api_client, event.reply_token, "我的預約列表", carousel_orders_full(rows))
-
-            # 預設
-            return reply_text(api_client, event.reply_token, "輸入「預約」開始預約（Flex 選單）")
+        return text_routes.dispatch(RouteContext(event, line_client.get_client(), user, conv, text))
 
     except Exception:
         import traceback
         traceback.print_exc()
+        uow.rollback()
         try:
-            with ApiClient(configuration) as api_client:
-                return reply_text(api_client, event.reply_token, "系統忙線或設定有誤，請稍後再試 🙏")
+            return reply_text(None, event.reply_token, "系統忙線或設定有誤，請稍後再試 🙏")
         except Exception:
             pass
 
 # ========== Postback 事件 ==========
 @handler.add(PostbackEvent)
 def on_postback(event):
+    outbound.bind(event)
     try:
         data = (getattr(event.postback, "data", "") or "").strip()
         params = getattr(event.postback, "params", {}) or {}
         print(f"[on_postback] data={data} params={params}")
-        user = get_or_create_user(event.source.user_id)
-        conv  = get_or_create_conv(event.source.user_id)
+        user, conv = get_user_and_conv(event.source.user_id)
 
         # 進任何 Postback 前，補 name/phone 並同步顯示鍵
         _hydrate_payload_defaults_from_user(user, conv)
         _sync_booking_display(conv)
 
-        with ApiClient(configuration) as api_client:
-
-            # 設定：修改姓名 / 電話 / 我的車輛（入口）
-            if data == "SETTINGS_EDIT_NAME":
-                conv.state = "edit_name"; conv.payload = {}; db.session.commit()
-                _hydrate_payload_defaults_from_user(user, conv); _sync_booking_display(conv)
-                return reply_text(api_client, event.reply_token, "請輸入新姓名：")
-
-            if data == "SETTINGS_EDIT_PHONE":
-                conv.state = "edit_phone"; conv.payload = {}; db.session.commit()
-                _hydrate_payload_defaults_from_user(user, conv); _sync_booking_display(conv)
-                return reply_text(api_client, event.reply_token, "請輸入新電話（09xxxxxxxx）：")
-
-            if data == "MY_VEHICLES":
-                vehicles = (Vehicle.query
-                            .filter_by(user_id=user.id)
-                            .order_by(Vehicle.created_at.desc())
-                            .all())
-                vrows = [{"id":v.id,"plate":v.plate,"brand":v.brand,"model":v.model} for v in vehicles]
-                return reply_flex(api_client, event.reply_token, "我的車輛", carousel_my_vehicles(vrows))
-
-            # 車輛選擇 / 使用
-            if data == "VEHICLE_ADD":
-                conv.state="v_add_plate"; db.session.commit()
-                return reply_text(api_client, event.reply_token, "請輸入新車牌（例：ABC-1234）：")
-
-            m = re.match(r"^VEHICLE_PICK:(\d+)$", data)
-            if m:
-                idx = int(m.group(1))
-                opts = conv.payload.get("vehicle_opts", [])
-                chosen = next((o for o in opts if o["i"]==idx), None)
-                if not chosen:
-                    return reply_text(api_client, event.reply_token, "序號不在清單中，請重新選擇。")
-                plate_label = chosen["label"].split()[0] if chosen["label"] else "-"
-                set_payload(conv, vehicle_id=chosen["id"], plate=plate_label, svc_page=1)
-                conv.state="svc_page"; db.session.commit()
-                _sync_booking_display(conv)
-                svc = [{"name": s.name, "mins": (s.duration_min or 30)} for s in Service.query.order_by(Service.name).all()]
-                return reply_flex(api_client, event.reply_token, "請選擇服務", bubble_services_page(svc, 1))
-
-            m = re.match(r"^VEHICLE_USE:(\d+)$", data)
-            if m:
-                vid = int(m.group(1))
-                v = Vehicle.query.filter_by(id=vid, user_id=user.id).first()
-                if not v:
-                    return reply_text(api_client, event.reply_token, "找不到這台車或不屬於你。")
-                set_payload(conv, vehicle_id=v.id, plate=v.plate, svc_page=1)
-                conv.state="svc_page"; db.session.commit()
-                _sync_booking_display(conv)
-                svc = [{"name": s.name, "mins": (s.duration_min or 30)} for s in Service.query.order_by(Service.name).all()]
-                return reply_flex(api_client, event.reply_token, "請選擇服務", bubble_services_page(svc, 1))
-
-            # 服務分頁 / 選擇
-            if data == "SVC_PREV" or data == "SVC_NEXT":
-                svc = [{"name": s.name, "mins": (s.duration_min or 30)} for s in Service.query.order_by(Service.name).all()]
-                page = conv.payload.get("svc_page", 1) or 1
-                page = max(1, page-1) if data == "SVC_PREV" else page+1
-                set_payload(conv, svc_page=page)
-                _sync_booking_display(conv)
-                return reply_flex(api_client, event.reply_token, "請選擇服務", bubble_services_page(svc, page))
-
-            m = re.match(r"^SVC_PICK:(.+)$", data)
-            if m:
-                name = m.group(1)
-                s = Service.query.filter(Service.name==name).first()
-                if not s:
-                    return reply_text(api_client, event.reply_token, "找不到此服務，請重新選擇。")
-
-                # 存入所選服務（同時寫 service 與 service_name）
-                set_payload(conv, service_id=s.id, service_name=s.name, service=s.name)
-
-                # datetimepicker（新預約）
-                initial_iso, min_iso, max_iso = _datetimepicker_bounds(booked_at=None)
-                conv.state = "new_booking_pick"
-                db.session.commit()
-                _sync_booking_display(conv)
-
-                return reply_flex(
-                    api_client, event.reply_token, "選擇預約時間",
-                    bubble_new_booking_picker(conv.payload, initial_iso, min_iso, max_iso)
-                )
-
-            # （保留）清單式時段分頁 / 選擇
-            if data in ["SLOT_PREV","SLOT_NEXT"]:
-                slots = [datetime.strptime(s, "%Y-%m-%d %H:%M") for s in conv.payload.get("slots_cache", [])]
-                page  = conv.payload.get("slot_page", 1) or 1
-                page = max(1, page-1) if data == "SLOT_PREV" else page+1
-                set_payload(conv, slot_page=page)
-                _sync_booking_display(conv)
-                return reply_flex(api_client, event.reply_token, "請選擇時段", bubble_timeslots(slots, page))
-
-            m = re.match(r"^SLOT_PICK:(\d{4}-\d{2}-\d{2}\s\d{2}:\d{2})$", data)
-            if m:
-                ts = m.group(1)
-                when = datetime.strptime(ts, "%Y-%m-%d %H:%M")
-                ok,msg = check_capacity(when)
-                if not ok:
-                    return reply_text(api_client, event.reply_token, msg)
-                set_payload(conv, booked_at=when.strftime("%Y-%m-%d %H:%M"))
-                conv.state = "confirm"; db.session.commit()
-                _sync_booking_display(conv)
-                return reply_flex(api_client, event.reply_token, "請確認預約資訊", bubble_confirm(conv.payload))
-
-            # 確認/取消整個預約流程
-            if data == "CONFIRM_SUBMIT":
-                _sync_booking_display(conv)
-                p = conv.payload or {}
-
-                # 防呆：必須有時間
-                if not p.get("booked_at"):
-                    return reply_text(api_client, event.reply_token, "請先選擇預約時間喔 🙏")
-
-                # 若尚未輸入姓名/電話但帳號有資料，補齊
-                if not p.get("name") and user.name:
-                    p["name"] = user.name
-                if not p.get("phone") and user.phone:
-                    p["phone"] = user.phone
-                conv.payload = p; db.session.commit()
-
-                user.name = p.get("name") or user.name
-                user.phone = p.get("phone") or user.phone
-                db.session.add(user); db.session.commit()
-
-                when = datetime.strptime(p["booked_at"], "%Y-%m-%d %H:%M")
-                order = Order(
-                    user_id=user.id,
-                    vehicle_id=p.get("vehicle_id"),
-                    status="pending",
-                    booked_at=when,
-                    note=f"車牌:{p.get('plate')}"
-                )
-                db.session.add(order); db.session.commit()
-                item = OrderItem(order_id=order.id, service_id=p.get("service_id"), qty=1, unit_price=0, subtotal=0)
-                db.session.add(item); db.session.commit()
-                reset_conv(conv)
-                return reply_flex(api_client, event.reply_token, "預約成功",
-                                 bubble_booking_success(order.id, p))
-
-
-            if data == "FLOW_CANCEL":
-                reset_conv(conv)
-                return reply_text(api_client, event.reply_token, "已取消流程 ✅\n需要預約請輸入「預約」。")
-
-            # 我的預約：取消/改期
-            m = re.match(r"^CANCEL#(\d+)$", data)
-            if m:
-                oid = int(m.group(1))
-                o = Order.query.filter_by(id=oid, user_id=user.id).first()
-                if not o:
-                    return reply_text(api_client, event.reply_token, "查無此預約。")
-                row = make_order_rows([o])[0]
-                conv.state = "cancel_confirm_flex"; set_payload(conv, order_id=oid)
-                return reply_flex(api_client, event.reply_token, "確認取消", bubble_cancel_confirm(row))
-
-            m = re.match(r"^CANCEL_CONFIRM#(\d+)$", data)
-            if m:
-                oid = int(m.group(1))
-                o = Order.query.filter_by(id=oid, user_id=user.id).first()
-                if not o:
-                    return reply_text(api_client, event.reply_token, "查無此預約。")
-                o.status = "canceled"; db.session.add(o); db.session.commit()
-                when = o.booked_at.strftime("%Y-%m-%d %H:%M") if o.booked_at else "未排定"
-                reset_conv(conv)
-                return reply_text(api_client, event.reply_token, f"✅ 已取消 #{o.id}｜{when}")
-
-            if data == "BACK_MY_ORDERS":
-                orders = (Order.query
-                          .filter(Order.user_id == user.id)
-                          .filter(Order.status.in_(["pending","confirmed"]))
-                          .order_by(Order.booked_at.asc().nullsfirst(), Order.id.desc())
-                          .limit(10).all())
-                if not orders:
-                    return reply_text(api_client, event.reply_token, "目前沒有預約紀錄。輸入「預約」可以開始預約。")
-                rows = make_order_rows(orders)
-                return reply_flex(api_client, event.reply_token, "我的預約列表", carousel_orders_full(rows))
-
-            # 新預約：datetimepicker 回傳（data = NEWBOOK）
-            if data == "NEWBOOK" and ("datetime" in params or "date" in params or "time" in params):
-                picked = params.get("datetime") or params.get("date") or params.get("time")
-                when = datetime.strptime(picked, "%Y-%m-%dT%H:%M")
-
-                ok, msg = check_capacity(when)
-                if not ok:
-                    return reply_text(api_client, event.reply_token, msg)
-
-                # 存入時間，進入確認頁
-                set_payload(conv, booked_at=when.strftime("%Y-%m-%d %H:%M"))
-                conv.state = "confirm"
-                db.session.commit()
-                _sync_booking_display(conv)
-
-                return reply_flex(api_client, event.reply_token, "請確認預約資訊", bubble_confirm(conv.payload))
-
-            # 改期：顯示 datetimepicker
-            m = re.match(r"^RESCHEDULE#(\d+)$", data)
-            if m and not params:
-                oid = int(m.group(1))
-                o = Order.query.filter_by(id=oid, user_id=user.id).first()
-                if not o:
-                    return reply_text(api_client, event.reply_token, "查無此預約。")
-                row = make_order_rows([o])[0]
-                initial_iso, min_iso, max_iso = _datetimepicker_bounds(booked_at=o.booked_at)
-                conv.state = "reschedule_wait_pick"; set_payload(conv, order_id=oid)
-                return reply_flex(api_client, event.reply_token, "選擇新的日期時間",
-                                  bubble_reschedule_picker(row, initial_iso, min_iso, max_iso))
-
-            # 改期：picker 回傳
-            if data.startswith("RESCHEDULE#") and ("datetime" in params or "date" in params or "time" in params):
-                oid = int(data.split("#",1)[1])
-                picked = params.get("datetime") or params.get("date") or params.get("time")
-                when = datetime.strptime(picked, "%Y-%m-%dT%H:%M")
-                ok, msg = check_capacity(when)
-                if not ok:
-                    return reply_text(api_client, event.reply_token, msg)
-                o = Order.query.filter_by(id=oid, user_id=user.id).first()
-                if not o:
-                    return reply_text(api_client, event.reply_token, "查無此預約。")
-                o.booked_at = when
-                if o.status == "pending":
-                    o.status = "confirmed"
-                db.session.add(o); db.session.commit()
-                reset_conv(conv)
-                return reply_text(api_client, event.reply_token, f"✅ 已改期：#{o.id} → {when:%Y-%m-%d %H:%M}")
-
-            return "OK"
+        out = postback_routes.dispatch(RouteContext(event, line_client.get_client(), user, conv, data, params))
+        return "OK" if out is None else out
 
     except Exception:
         import traceback
         traceback.print_exc()
+        uow.rollback()
         return "OK"
 
+# ---------- CLI ----------
+@app.cli.command("rebuild-occupancy")
+def rebuild_occupancy_cmd():
+    """依現有訂單重建 slot_occupancy（flask --app app rebuild-occupancy）"""
+    n = occupancy.rebuild()
+    db.session.commit()
+    print(f"slot_occupancy rebuilt: {n} cells")
+
+@app.cli.command("send-reminders")
+def send_reminders_cmd():
+    """立刻送明天的預約提醒（flask --app app send-reminders），已送過的不會重送"""
+    n = reminders.run()
+    db.session.commit()
+    print(f"reminders sent: {n} users")
+
+@app.cli.command("rebuild-maintenance")
+def rebuild_maintenance_cmd():
+    """依完工訂單重算 maintenance_due（flask --app app rebuild-maintenance），已提醒過且沒變的保留"""
+    n = maintenance.rebuild()
+    db.session.commit()
+    print(f"maintenance_due rebuilt: {n} rows changed")
+
+jobs.start_from_env(app)
+
 # ---------- Boot ----------
 if __name__ == "__main__":
     with app.app_context():
@@ -845,6 +1112,10 @@ if __name__ == "__main__":
                     capacity=2
                 ))
             db.session.commit()
+        # 第一次啟用 slot_occupancy：由既有訂單補齊
+        if SlotOccupancy.query.count() == 0 and Order.query.filter(Order.status.in_(ACTIVE_STATUSES)).count() > 0:
+            occupancy.rebuild()
+            db.session.commit()
 
         setup_admin(app)
     app.run(port=5001)
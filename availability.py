@@ -0,0 +1,194 @@
+# availability.py
+"""
+可預約時段的批次計算。
+
+原本 find_available_slots 每天查一次 ShopSlot，每個 30 分鐘格子再呼叫 check_capacity
+（又查一次 ShopSlot + 一次 Order count），14 天就是幾百個查詢。
+這裡整個區間只查一次：
+  - 營業時段來自 schedule.py 的程序內快取（ShopSlot 變動時才重載）
+  - 區間內 slot_occupancy 的已預約數（見 occupancy.py）
+判斷規則與 check_capacity 相同（取第一個包含該時間的時段、格子以整點對齊）。
+
+服務時間（duration_min）會跨好幾格，所以每天先攤成一張 DayGrid：
+依時間排序的格子陣列 + 每格剩餘名額 free[]，外加 run_end[]（往後連續不中斷到哪一格）。
+某個開始時間放不放得下 = 找出 [i, j] 兩端的索引，檢查 j 沒超過 run_end[i]、min(free[i:j+1]) > 0。
+
+iter_available()：從某個時間往後（或往前）一天一天產生可預約時間，每天查一次該天的 slot_occupancy；
+時段清單分頁只記游標（本頁第一 / 最後一個時間），翻頁時只算出那一頁需要的幾個。
+
+nearest_available()：使用者挑到滿 / 休息的時間時，從該時間往前後兩個方向一天一天擴散，
+找最近的 n 個可預約時間。只查一次 slot_occupancy 的小範圍（主鍵區間），與 orders 筆數無關。
+"""
+from bisect import bisect_left
+from datetime import datetime, timedelta
+
+from models import db, SlotOccupancy
+from schedule import current_schedule
+
+ACTIVE_STATUSES = ("pending", "confirmed")
+COMPLETED_STATUS = "completed"      # 已完工（保養到期提醒依此計算）
+
+
+def load_occupancy(start: datetime, end: datetime):
+    """{cell_start: booked}，[start, end) 內有預約的格子。"""
+    rows = (db.session.query(SlotOccupancy.cell_start, SlotOccupancy.booked)
+            .filter(SlotOccupancy.cell_start >= start)
+            .filter(SlotOccupancy.cell_start < end)
+            .filter(SlotOccupancy.booked > 0)
+            .all())
+    return {c: n for c, n in rows}
+
+
+class DayGrid:
+    """某一天所有格子的平行陣列：starts / ends / free，以及 run_end（連續區段的最後一格索引）。"""
+    __slots__ = ("sched", "occupied", "starts", "ends", "free", "run_end", "index")
+
+    def __init__(self, sched, day: datetime, occupied: dict):
+        self.sched = sched
+        self.occupied = occupied
+        cells = {}
+        for st, et, interval, _cap in sched.windows.get(day.weekday(), []):
+            cur = datetime.combine(day.date(), st)
+            end = datetime.combine(day.date(), et)
+            while cur < end:
+                c_start, c_end, cap, _reason = sched.cell(cur)
+                if c_start is not None:
+                    cells.setdefault(c_start, (c_end, cap))
+                cur = c_end if c_end and c_end > cur else cur + timedelta(minutes=interval)
+        self.starts = sorted(cells)
+        self.ends = [cells[c][0] for c in self.starts]
+        self.free = [cells[c][1] - occupied.get(c, 0) for c in self.starts]
+        self.index = {c: i for i, c in enumerate(self.starts)}
+        n = len(self.starts)
+        self.run_end = [0] * n
+        for i in range(n - 1, -1, -1):
+            linked = i + 1 < n and self.ends[i] == self.starts[i + 1]
+            self.run_end[i] = self.run_end[i + 1] if linked else i
+
+    def fits(self, when: datetime, duration_min: int | None = None) -> bool:
+        """when 開始、做 duration_min 分鐘，經過的每一格都還有名額。"""
+        c_start, _c_end, _cap, reason = self.sched.cell(when)
+        if c_start is None:
+            return False
+        i = self.index.get(c_start)
+        if i is None:
+            # 時段設定沒對齊整點時的保底：逐格算
+            cells, _reason = self.sched.cells_for_span(when, duration_min)
+            return bool(cells) and all(self.occupied.get(c, 0) < cap for c, cap in cells)
+        j = i
+        if duration_min:
+            j = bisect_left(self.ends, when + timedelta(minutes=duration_min), lo=i)
+            if j > self.run_end[i]:
+                return False
+        return min(self.free[i:j + 1]) > 0
+
+
+def find_available_slots(start_dt: datetime, days: int = 14, max_per_day: int = 48, limit: int = 500,
+                         duration_min: int | None = None):
+    """
+    依時間排序的可預約 datetime 清單；duration_min 有給時只回傳整段服務都放得下的開始時間。
+    duration_min 為空時輸出與原本逐格查詢版本相同。
+    """
+    end_dt = start_dt + timedelta(days=days)
+    day_cursor = datetime(start_dt.year, start_dt.month, start_dt.day)
+
+    sched = current_schedule()
+    if not sched.windows:
+        return []
+    # 格子可能跨過 end_dt，多抓一天
+    occupied = load_occupancy(day_cursor, end_dt + timedelta(days=1))
+
+    results = []
+    while day_cursor < end_dt:
+        per_day_count = 0
+        for cur in _day_starts(sched, day_cursor, occupied, duration_min):
+            if per_day_count >= max_per_day:
+                break
+            if cur >= start_dt:
+                results.append(cur)
+                per_day_count += 1
+
+        day_cursor += timedelta(days=1)
+        if len(results) >= limit:
+            break
+    return results
+
+
+def _day_starts(sched, day: datetime, occupied: dict, duration_min: int | None = None):
+    """依時段順序產生當天放得下的開始時間（每個時段從 start_time 起每 interval_min 一個）。"""
+    windows = sched.windows.get(day.weekday(), [])
+    if not windows:
+        return
+    grid = DayGrid(sched, day, occupied)
+    for st, et, interval, _cap in windows:
+        cur = datetime.combine(day.date(), st)
+        day_end = datetime.combine(day.date(), et)
+        while cur < day_end:
+            if grid.fits(cur, duration_min):
+                yield cur
+            cur += timedelta(minutes=interval)
+
+
+def iter_available(frm: datetime, duration_min: int | None = None, reverse: bool = False,
+                   bound: datetime | None = None, max_days: int = 60):
+    """
+    reverse=False：依序產生 > frm 的可預約時間（到 bound 為止，含）
+    reverse=True： 依序產生 < frm 的可預約時間，由近到遠（到 bound 為止，含）
+    """
+    sched = current_schedule()
+    if not sched.windows:
+        return
+    step = timedelta(days=-1 if reverse else 1)
+    day = datetime(frm.year, frm.month, frm.day)
+    for _ in range(max_days + 1):
+        if bound is not None and (day > bound if not reverse else day + timedelta(days=1) <= bound):
+            return
+        starts = list(_day_starts(sched, day, load_occupancy(day, day + timedelta(days=2)), duration_min)) \
+            if sched.is_open_day(day.weekday()) else []
+        for t in (reversed(starts) if reverse else starts):
+            if (t < frm) if reverse else (t > frm):
+                if bound is not None and ((t < bound) if reverse else (t > bound)):
+                    return
+                yield t
+        day += step
+
+
+def nearest_available(when: datetime, n: int = 4, duration_min: int | None = None,
+                      earliest: datetime | None = None, latest: datetime | None = None,
+                      horizon_days: int = 7, ignore=()):
+    """
+    離 when 最近的 n 個可預約開始時間（依時間排序）。
+    earliest / latest 限制可選範圍（例如 datetimepicker 的 min / max）；
+    ignore：視為已釋放的格子 [(cell_start, capacity), ...]（改期時自己原本佔的格子）。
+    """
+    sched = current_schedule()
+    if not sched.windows or n <= 0:
+        return []
+    day0 = datetime(when.year, when.month, when.day)
+    lo = day0 - timedelta(days=horizon_days)
+    hi = day0 + timedelta(days=horizon_days + 1)
+    if earliest is not None:
+        lo = max(lo, datetime(earliest.year, earliest.month, earliest.day))
+    if latest is not None:
+        hi = min(hi, datetime(latest.year, latest.month, latest.day) + timedelta(days=1))
+    if lo >= hi:
+        return []
+    occupied = load_occupancy(lo, hi + timedelta(days=1))
+    for cell, _cap in ignore:
+        if occupied.get(cell, 0) > 0:
+            occupied[cell] -= 1
+
+    found = []   # (距離, 時間)
+    for k in range(horizon_days + 1):
+        # 第 k 天以外的時間距離至少 k-1 天，已經湊滿且都比它近就不用再往外找
+        if len(found) >= n and found[n - 1][0] <= timedelta(days=k - 1):
+            break
+        days = [day0] if k == 0 else [day0 - timedelta(days=k), day0 + timedelta(days=k)]
+        for day in days:
+            if not lo <= day < hi:
+                continue
+            for t in _day_starts(sched, day, occupied, duration_min):
+                if (earliest is None or t >= earliest) and (latest is None or t <= latest):
+                    found.append((abs(t - when), t))
+        found.sort()
+    return sorted(t for _d, t in found[:n])
@@ -0,0 +1,138 @@
+# bench_availability.py
+"""
+比較 find_available_slots 舊版（逐格 check_capacity）與 availability 批次版的查詢數與耗時，
+並確認兩者輸出一致；另外檢查跨格服務（duration_min）的結果。使用 SQLite in-memory，不需要 .env。
+
+    python bench_availability.py            # 預設每天約 20 筆訂單
+    python bench_availability.py 40         # 每天約 40 筆
+"""
+import random, sys, time
+from datetime import datetime, timedelta, time as dtime
+
+from flask import Flask
+from sqlalchemy import event
+
+from models import db, User, Order, ShopSlot
+import availability
+import occupancy
+import schedule
+
+
+# ---- 舊版（baseline 的 check_capacity + find_available_slots）----
+def legacy_check_capacity(when):
+    weekday = when.weekday()
+    slots = (ShopSlot.query
+             .filter(ShopSlot.weekday == weekday)
+             .order_by(ShopSlot.start_time.asc())
+             .all())
+    if not slots:
+        return False, ""
+    hm = dtime(when.hour, when.minute)
+    chosen = None
+    for s in slots:
+        if s.start_time <= hm < s.end_time:
+            chosen = s
+            break
+    if not chosen:
+        return False, ""
+    block_min = (when.minute // chosen.interval_min) * chosen.interval_min
+    block_start = when.replace(minute=block_min, second=0, microsecond=0)
+    block_end = block_start + timedelta(minutes=chosen.interval_min)
+    cnt = (Order.query
+           .filter(Order.status.in_(["pending", "confirmed"]))
+           .filter(Order.booked_at >= block_start)
+           .filter(Order.booked_at < block_end)
+           .count())
+    return cnt < chosen.capacity, ""
+
+
+def legacy_find_available_slots(start_dt, days=14, max_per_day=48):
+    results = []
+    end_dt = start_dt + timedelta(days=days)
+    day_cursor = datetime(start_dt.year, start_dt.month, start_dt.day)
+    while day_cursor < end_dt:
+        day_slots = (ShopSlot.query
+                     .filter(ShopSlot.weekday == day_cursor.weekday())
+                     .order_by(ShopSlot.start_time.asc())
+                     .all())
+        per_day_count = 0
+        for s in day_slots:
+            cur = datetime.combine(day_cursor.date(), s.start_time)
+            day_end = datetime.combine(day_cursor.date(), s.end_time)
+            while cur < day_end and per_day_count < max_per_day:
+                if cur >= start_dt:
+                    ok, _ = legacy_check_capacity(cur)
+                    if ok:
+                        results.append(cur)
+                        per_day_count += 1
+                cur += timedelta(minutes=s.interval_min)
+        day_cursor += timedelta(days=1)
+        if len(results) >= 500:
+            break
+    return results
+
+
+def seed(per_day: int, days: int, start: datetime):
+    for wd in range(0, 6):
+        db.session.add(ShopSlot(weekday=wd, start_time=dtime(8, 0), end_time=dtime(21, 0),
+                                interval_min=30, capacity=2))
+    u = User(line_user_id="bench")
+    db.session.add(u); db.session.flush()
+    rnd = random.Random(42)
+    rows = []
+    for d in range(days + 1):
+        day = start + timedelta(days=d)
+        for _ in range(per_day):
+            t = day.replace(hour=rnd.randint(8, 20), minute=rnd.choice([0, 15, 30, 45]))
+            rows.append(Order(user_id=u.id, status=rnd.choice(["pending", "confirmed", "canceled"]), booked_at=t))
+    db.session.add_all(rows)
+    db.session.commit()
+    return len(rows)
+
+
+def measure(fn, *args, **kwargs):
+    counter = {"n": 0}
+
+    def on_exec(*_):
+        counter["n"] += 1
+    event.listen(db.engine, "before_cursor_execute", on_exec)
+    t0 = time.perf_counter()
+    out = fn(*args, **kwargs)
+    ms = (time.perf_counter() - t0) * 1000
+    event.remove(db.engine, "before_cursor_execute", on_exec)
+    return out, counter["n"], ms
+
+
+def main():
+    per_day = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite://"
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+        start = datetime(2030, 1, 7, 9, 0)
+        n = seed(per_day, 60, datetime(2030, 1, 7))
+        occupancy.rebuild()
+        db.session.commit()
+        print(f"orders: {n}")
+        print(f"{'days':>5} {'legacy q':>9} {'legacy ms':>10} {'batch q':>8} {'batch ms':>9} {'slots':>6}")
+        for days in (14, 30, 60):
+            old, old_q, old_ms = measure(legacy_find_available_slots, start, days=days)
+            new, new_q, new_ms = measure(availability.find_available_slots, start, days=days)
+            assert old == new, f"輸出不一致（days={days}）"
+            print(f"{days:>5} {old_q:>9} {old_ms:>10.1f} {new_q:>8} {new_ms:>9.1f} {len(new):>6}")
+
+        # 跨格服務：DayGrid 的區間檢查要與逐格 cells_for_span 的結果一致
+        sched = schedule.current_schedule()
+        occupied = availability.load_occupancy(datetime(2030, 1, 7), datetime(2030, 3, 10))
+        print(f"{'mins':>5} {'slots':>6} {'ms':>7}")
+        for mins in (20, 40, 90):
+            new, _q, ms = measure(availability.find_available_slots, start, days=30, duration_min=mins)
+            for t in new:
+                cells, _reason = sched.cells_for_span(t, mins)
+                assert cells and all(occupied.get(c, 0) < cap for c, cap in cells), f"{t} 放不下 {mins} 分鐘"
+            print(f"{mins:>5} {len(new):>6} {ms:>7.1f}")
+
+
+if __name__ == "__main__":
+    main()
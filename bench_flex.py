@@ -0,0 +1,108 @@
+# bench_flex.py
+"""
+比較 reply_flex 嚴格模式（FlexContainer.from_dict + SDK 序列化）與快速路徑（同形狀只驗一次、直接送 JSON）
+每次回覆的 CPU 時間，並確認兩種模式送出的 JSON 相同。
+另列：預先 prepare 過的固定內容、以及每次呼叫模板函式（flex_engine 編譯過的骨架填插槽）再送出。不連網路：把 ApiClient 的連線池換成假的。
+
+    python bench_flex.py            # 每種模板各 2000 次
+    python bench_flex.py 5000
+"""
+import json, sys, time
+from datetime import datetime, timedelta
+
+from linebot.v3.messaging import Configuration, ApiClient
+
+import flex_helper
+from flex_templates import (
+    bubble_services_page, bubble_timeslots, bubble_confirm, carousel_orders_full, bubble_settings
+)
+
+
+class _Resp:
+    status = 200
+    reason = "OK"
+    data = b'{"sentMessages":[{"id":"1","quoteToken":"q"}]}'
+    headers = {"Content-Type": "application/json"}
+
+    def getheaders(self):
+        return self.headers
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name, default)
+
+
+class _Pool:
+    def __init__(self):
+        self.bodies = []
+
+    def request(self, method, url, body=None, **kwargs):
+        self.bodies.append(body)
+        return _Resp()
+
+
+def samples():
+    t0 = datetime(2030, 1, 7, 9, 0)
+    services = [{"name": f"服務{i}", "mins": 30} for i in range(10)]
+    slots = [t0 + timedelta(minutes=30 * i) for i in range(12)]
+    payload = {"name": "王小明", "phone": "0912345678", "plate": "ABC-1234",
+               "service_name": "更換機油", "booked_at": "2030-01-07 09:00"}
+    rows = [{"id": i, "time": "2030-01-07 09:00", "plate": "ABC-1234", "status": "pending",
+             "items": "更換機油", "status_label": "待確認"} for i in range(5)]
+
+    class _User:
+        name, phone = "王小明", "0912345678"
+    return {
+        "services_page": lambda: bubble_services_page(services, 1),
+        "timeslots": lambda: bubble_timeslots(slots, 1),
+        "confirm": lambda: bubble_confirm(payload),
+        "orders_carousel": lambda: carousel_orders_full(rows),
+        "settings": lambda: bubble_settings(_User()),
+    }
+
+
+def _as_dict(contents):
+    return contents.contents if isinstance(contents, flex_helper.PreparedFlex) else contents
+
+
+def run(api, contents, n, strict):
+    flex_helper.FLEX_STRICT = strict
+    t0 = time.process_time()
+    for _ in range(n):
+        flex_helper.reply_flex(api, "token", "alt", contents)
+    return (time.process_time() - t0) / n * 1e6
+
+
+def run_build(api, build, n):
+    """每次都呼叫模板函式產生內容再送出（實際 handler 的情況）。"""
+    flex_helper.FLEX_STRICT = False
+    t0 = time.process_time()
+    for _ in range(n):
+        flex_helper.reply_flex(api, "token", "alt", build())
+    return (time.process_time() - t0) / n * 1e6
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    conf = Configuration(access_token="bench")
+    with ApiClient(conf) as api:
+        pool = _Pool()
+        api.rest_client.pool_manager = pool
+        print(f"{'template':<16} {'strict µs':>10} {'fast µs':>9} {'prepared µs':>12} {'build+send µs':>14} {'speedup':>8}")
+        for name, build in samples().items():
+            contents = _as_dict(build())
+            strict_us = run(api, contents, n, True)
+            strict_body = json.loads(pool.bodies[-1])
+            fast_us = run(api, contents, n, False)
+            fast_body = json.loads(pool.bodies[-1])
+            assert strict_body == fast_body, f"{name}: 兩種模式送出的 JSON 不同"
+            # 預先 prepare 過的固定內容（例如 catalog 的服務分頁）
+            prepared_us = run(api, flex_helper.prepare(contents), n, False)
+            build_us = run_build(api, build, n)
+            assert json.loads(pool.bodies[-1]) == strict_body, f"{name}: 模板輸出與嚴格模式不同"
+            print(f"{name:<16} {strict_us:>10.1f} {fast_us:>9.1f} {prepared_us:>12.1f} {build_us:>14.1f}"
+                  f" {strict_us / fast_us:>7.1f}x")
+            pool.bodies.clear()
+
+
+if __name__ == "__main__":
+    main()
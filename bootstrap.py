@@ -0,0 +1,204 @@
+# bootstrap.py
+"""
+每個事件開頭取得 User + Conversation。
+
+  - Postgres：一個 statement（兩段 INSERT ... ON CONFLICT DO NOTHING RETURNING 的 CTE）
+    同時「取得或建立」兩筆，兩個新使用者同時進來也不會撞 line_user_id 的 unique
+  - SQLite：INSERT ... ON CONFLICT DO NOTHING 兩次 + 一次 JOIN 查詢
+  - 其他：查詢，缺的再 INSERT
+
+line_user_id → users.id 用有上限的 LRU 記住；回頭客（LRU + conv_cache 都命中）不需任何查詢。
+handler 拿到的 user 是 UserRef：只有讀寫 id 以外的欄位時才會載入 User 物件。
+"""
+import json, os, threading
+from collections import OrderedDict
+from datetime import datetime
+
+from sqlalchemy import event, text
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session
+
+from models import db, User, Conversation
+from conv_cache import conv_cache
+
+
+class UserRef:
+    """只帶 id 的 User 代理；第一次用到其他欄位時才 db.session.get(User, id)。"""
+    __slots__ = ("id", "line_user_id", "_row")
+
+    def __init__(self, id, line_user_id):
+        object.__setattr__(self, "id", id)
+        object.__setattr__(self, "line_user_id", line_user_id)
+        object.__setattr__(self, "_row", None)
+
+    @property
+    def row(self) -> User:
+        if self._row is None:
+            object.__setattr__(self, "_row", db.session.get(User, self.id))
+        return self._row
+
+    def __getattr__(self, name):
+        return getattr(self.row, name)
+
+    def __setattr__(self, name, value):
+        setattr(self.row, name, value)
+
+    def __repr__(self) -> str:
+        return f"<UserRef id={self.id} line_user_id={self.line_user_id!r}>"
+
+
+class _LRU:
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            v = self._data.get(key)
+            if v is not None:
+                self._data.move_to_end(key)
+            return v
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def __len__(self):
+        return len(self._data)
+
+
+user_ids = _LRU(int(os.getenv("USER_ID_CACHE_SIZE", "50000")))
+stats = {"hits": 0, "upserts": 0, "created_users": 0, "created_convs": 0}
+_stats_lock = threading.Lock()
+
+
+def _bump(key, n=1):
+    with _stats_lock:
+        stats[key] += n
+
+
+_PG_UPSERT = text("""
+WITH ins_u AS (
+    INSERT INTO users (line_user_id, created_at, updated_at)
+    VALUES (:luid, :now, :now)
+    ON CONFLICT (line_user_id) DO NOTHING
+    RETURNING id
+), ins_c AS (
+    INSERT INTO conversations (line_user_id, state, payload, updated_at)
+    VALUES (:luid, 'idle', CAST('{}' AS JSON), :now)
+    ON CONFLICT (line_user_id) DO NOTHING
+    RETURNING id, state, payload
+)
+SELECT
+    COALESCE((SELECT id FROM ins_u), (SELECT id FROM users WHERE line_user_id = :luid)) AS user_id,
+    (SELECT id FROM ins_u) IS NOT NULL AS user_created,
+    c.id AS conv_id, c.state, c.payload, c.created AS conv_created
+FROM (
+    SELECT id, state, payload, TRUE AS created FROM ins_c
+    UNION ALL
+    SELECT id, state, payload, FALSE AS created FROM conversations WHERE line_user_id = :luid
+) c
+LIMIT 1
+""")
+
+
+def _upsert_pg(line_user_id):
+    params = {"luid": line_user_id, "now": datetime.utcnow()}
+    row = db.session.execute(_PG_UPSERT, params).first()
+    if row is None or row.user_id is None:
+        # 另一個 transaction 剛好同時建立：ON CONFLICT 等它 commit 後，
+        # 本 statement 的 snapshot 看不到那筆，再跑一次就會讀到
+        row = db.session.execute(_PG_UPSERT, params).first()
+    return row.user_id, row.user_created, (row.conv_id, row.state, row.payload), row.conv_created
+
+
+def _upsert_sqlite(line_user_id):
+    now = datetime.utcnow()
+    r1 = db.session.execute(sqlite_insert(User)
+                            .values(line_user_id=line_user_id, created_at=now, updated_at=now)
+                            .on_conflict_do_nothing(index_elements=["line_user_id"]))
+    r2 = db.session.execute(sqlite_insert(Conversation)
+                            .values(line_user_id=line_user_id, state="idle", payload={}, updated_at=now)
+                            .on_conflict_do_nothing(index_elements=["line_user_id"]))
+    row = (db.session.query(User.id, Conversation.id, Conversation.state, Conversation.payload)
+           .join(Conversation, Conversation.line_user_id == User.line_user_id)
+           .filter(User.line_user_id == line_user_id).first())
+    return row[0], r1.rowcount == 1, (row[1], row[2], row[3]), r2.rowcount == 1
+
+
+def _upsert_generic(line_user_id):
+    u = User.query.filter_by(line_user_id=line_user_id).first()
+    c = Conversation.query.filter_by(line_user_id=line_user_id).first()
+    u_new, c_new = u is None, c is None
+    if u_new:
+        u = User(line_user_id=line_user_id); db.session.add(u)
+    if c_new:
+        c = Conversation(line_user_id=line_user_id, state="idle", payload={}); db.session.add(c)
+    if u_new or c_new:
+        db.session.flush()
+    return u.id, u_new, (c.id, c.state, c.payload), c_new
+
+
+def upsert_user_and_conv(line_user_id):
+    """回傳 (user_id, user_created, (conv_id, state, payload), conv_created)。"""
+    dialect = db.session.get_bind().dialect.name
+    if dialect == "postgresql":
+        out = _upsert_pg(line_user_id)
+    elif dialect == "sqlite":
+        out = _upsert_sqlite(line_user_id)
+    else:
+        out = _upsert_generic(line_user_id)
+    _bump("upserts")
+    if out[1]:
+        _bump("created_users")
+    if out[3]:
+        _bump("created_convs")
+    return out
+
+
+def load_user_and_conv(line_user_id):
+    """事件開頭用：回傳 (UserRef, ConvState)。"""
+    upserted = []
+
+    def fallback():
+        res = upsert_user_and_conv(line_user_id)
+        upserted.append(res)
+        cid, state, payload = res[2]
+        if isinstance(payload, str):
+            payload = json.loads(payload)
+        return cid, state, payload
+
+    uid = user_ids.get(line_user_id)
+    conv = conv_cache.load(line_user_id, fallback=fallback)
+    if uid is None and not upserted:
+        upserted.append(upsert_user_and_conv(line_user_id))
+    if upserted:
+        uid, user_created = upserted[0][0], upserted[0][1]
+        # 本次才建立的 user 可能隨事件 rollback 消失，等下次事件再記
+        if not user_created:
+            user_ids.put(line_user_id, uid)
+    else:
+        _bump("hits")
+    return UserRef(uid, line_user_id), conv
+
+
+def snapshot():
+    with _stats_lock:
+        out = dict(stats)
+    out["user_id_cache_size"] = len(user_ids)
+    return out
+
+
+@event.listens_for(Session, "after_flush")
+def _forget_deleted_users(session, flush_context):
+    for obj in session.deleted:
+        if isinstance(obj, User):
+            user_ids.discard(obj.line_user_id)
@@ -0,0 +1,60 @@
+# catalog.py
+"""
+服務項目（Service）的程序內目錄，放在 versions.VersionedCache（名稱 "services"）。
+
+  services   依名稱排序的 ServiceInfo
+  by_id / by_name
+  page(n)    服務分頁的 Flex bubble（flex_helper.prepare 過、已序列化），每個目錄版本只算一次
+
+ServiceAdmin 新增 / 修改 / 刪除 Service 時版本 +1，本程序立即重載、其他 worker 在
+CATALOG_VERSION_CHECK_SEC 秒內跟上。翻頁 / 選服務都不查 DB。
+回傳的 PreparedFlex 是共用物件，呼叫端不可修改。
+"""
+import os, threading
+from collections import namedtuple
+
+from models import db, Service
+from flex_templates import bubble_services_page
+from flex_helper import prepare
+import versions
+
+SERVICES_PER_PAGE = 6
+DEFAULT_DURATION_MIN = 30   # 與 Service.duration_min 的預設值相同
+
+ServiceInfo = namedtuple("ServiceInfo", "id name base_price duration_min recommend_days")
+
+
+class Catalog:
+    def __init__(self, rows):
+        self.services = [ServiceInfo(r.id, r.name, r.base_price or 0, r.duration_min or DEFAULT_DURATION_MIN,
+                                     r.recommend_days) for r in rows]
+        self.by_id = {s.id: s for s in self.services}
+        self.by_name = {s.name: s for s in self.services}
+        self._rows = [{"name": s.name, "mins": s.duration_min} for s in self.services]
+        self._pages = {}
+        self._lock = threading.Lock()
+
+    @property
+    def page_count(self) -> int:
+        return max(1, -(-len(self.services) // SERVICES_PER_PAGE))
+
+    def page(self, n: int):
+        n = min(max(1, n), self.page_count)
+        bubble = self._pages.get(n)
+        if bubble is None:
+            with self._lock:
+                bubble = self._pages.setdefault(n, prepare(bubble_services_page(self._rows, n, SERVICES_PER_PAGE)))
+        return bubble
+
+
+def _load():
+    return Catalog(db.session.query(Service).order_by(Service.name).all())
+
+
+versions.track("services", Service)
+catalog_cache = versions.VersionedCache(
+    "services", _load, check_interval=float(os.getenv("CATALOG_VERSION_CHECK_SEC", "5")))
+
+
+def current_catalog() -> Catalog:
+    return catalog_cache.get()
@@ -0,0 +1,227 @@
+# conv_cache.py
+"""
+Conversation 的 write-behind 快取。
+
+handler 拿到的是 ConvState（只有 state / payload 兩個可改欄位），
+事件結束時（uow before_commit）和載入時的快照比對：
+  - 沒變 → 不寫 DB（_hydrate / _sync 沒改到東西時最常見）
+  - 有變 → 一次 UPDATE conversations（新使用者則 INSERT）
+commit 成功後才寫回快取；rollback 則把該使用者從快取移除，下次重新讀 DB。
+
+後端（CONV_CACHE_BACKEND）：
+  local  程序內 LRU（預設；單台部署，或搭配 webhook_worker 同使用者固定 lane）
+  redis  多台 replica 共用（需安裝 redis 套件，CONV_CACHE_REDIS_URL 指定位置）
+  none   不快取，每次讀 DB，但仍會略過沒變的寫入
+後台（ConversationAdmin）修改或刪除 Conversation 時會透過 session 事件讓快取失效。
+"""
+import json, os, threading
+from collections import OrderedDict
+from datetime import datetime
+
+from sqlalchemy import event, update
+from sqlalchemy.orm import Session
+
+from models import db, Conversation
+import uow
+
+
+def _dump(payload) -> str:
+    return json.dumps(payload or {}, ensure_ascii=False, sort_keys=True, default=str)
+
+
+class ConvState:
+    """handler 用的 Conversation 替身；只需讀寫 state / payload。"""
+    __slots__ = ("id", "line_user_id", "state", "payload", "_orig")
+
+    def __init__(self, id, line_user_id, state, payload):
+        self.id = id
+        self.line_user_id = line_user_id
+        self.state = state or "idle"
+        self.payload = payload if isinstance(payload, dict) else {}
+        self._orig = None if id is None else (self.state, _dump(self.payload))
+
+    def snapshot(self):
+        return (self.state, _dump(self.payload))
+
+    def is_dirty(self) -> bool:
+        return self._orig != self.snapshot()
+
+    def __repr__(self) -> str:
+        return f"<ConvState id={self.id} line_user_id={self.line_user_id!r} state={self.state!r}>"
+
+
+# ---------- backends：值為 (id, state, payload_json) ----------
+class LocalBackend:
+    def __init__(self, maxsize: int = 10000):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            v = self._data.get(key)
+            if v is not None:
+                self._data.move_to_end(key)
+            return v
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class RedisBackend:
+    def __init__(self, url: str, ttl: int = 3600, prefix: str = "mcshop:conv:"):
+        import redis  # 選用套件，只有 CONV_CACHE_BACKEND=redis 才需要
+        self.r = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        raw = self.r.get(self.prefix + key)
+        if raw is None:
+            return None
+        cid, state, payload = json.loads(raw)
+        return (cid, state, payload)
+
+    def put(self, key, value):
+        self.r.set(self.prefix + key, json.dumps(list(value), ensure_ascii=False), ex=self.ttl)
+
+    def invalidate(self, key):
+        self.r.delete(self.prefix + key)
+
+    def clear(self):
+        for k in self.r.scan_iter(self.prefix + "*"):
+            self.r.delete(k)
+
+
+class NullBackend:
+    def get(self, key): return None
+    def put(self, key, value): pass
+    def invalidate(self, key): pass
+    def clear(self): pass
+
+
+class ConversationCache:
+    def __init__(self, backend):
+        self.backend = backend
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "writes": 0, "inserts": 0, "skipped": 0}
+
+    def _bump(self, key):
+        with self._lock:
+            self.stats[key] += 1
+
+    def _touched(self):
+        t = getattr(self._local, "touched", None)
+        if t is None:
+            t = self._local.touched = {}
+        return t
+
+    def load(self, line_user_id, fallback=None) -> ConvState:
+        """
+        取得（或建立）使用者的 ConvState；同一事件內重複呼叫回傳同一個物件。
+        fallback：快取沒命中時改用它取得 (id, state, payload)（例如 bootstrap 的 upsert）。
+        """
+        touched = self._touched()
+        if line_user_id in touched:
+            return touched[line_user_id]
+
+        cached = self.backend.get(line_user_id)
+        if cached is not None:
+            self._bump("hits")
+            cid, state, payload_json = cached
+            conv = ConvState(cid, line_user_id, state, json.loads(payload_json))
+        elif fallback is not None:
+            self._bump("misses")
+            cid, state, payload = fallback()
+            conv = ConvState(cid, line_user_id, state, payload)
+        else:
+            self._bump("misses")
+            row = (db.session.query(Conversation.id, Conversation.state, Conversation.payload)
+                   .filter(Conversation.line_user_id == line_user_id).first())
+            if row:
+                conv = ConvState(row.id, line_user_id, row.state, row.payload)
+            else:
+                conv = ConvState(None, line_user_id, "idle", {})
+
+        # 不在 unit of work 內就不追蹤（也不會寫回）
+        if uow.enlist(self):
+            touched[line_user_id] = conv
+        return conv
+
+    # ---- uow participant ----
+    def before_commit(self):
+        for conv in self._touched().values():
+            if conv.id is None:
+                row = Conversation(line_user_id=conv.line_user_id, state=conv.state, payload=conv.payload)
+                db.session.add(row)
+                db.session.flush()
+                conv.id = row.id
+                self._bump("inserts")
+            elif conv.is_dirty():
+                db.session.execute(
+                    update(Conversation)
+                    .where(Conversation.id == conv.id)
+                    .values(state=conv.state, payload=conv.payload, updated_at=datetime.utcnow())
+                )
+                self._bump("writes")
+            else:
+                self._bump("skipped")
+
+    def after_commit(self):
+        touched = self._touched()
+        for key, conv in touched.items():
+            state, payload_json = conv.snapshot()
+            conv._orig = (state, payload_json)
+            self.backend.put(key, (conv.id, state, payload_json))
+        touched.clear()
+
+    def after_rollback(self):
+        touched = self._touched()
+        for key in touched:
+            self.backend.invalidate(key)
+        touched.clear()
+
+    def invalidate(self, line_user_id):
+        self.backend.invalidate(line_user_id)
+
+    def snapshot(self):
+        with self._lock:
+            out = dict(self.stats)
+        out["backend"] = type(self.backend).__name__
+        return out
+
+
+def backend_from_env():
+    kind = os.getenv("CONV_CACHE_BACKEND", "local")
+    if kind == "local":
+        return LocalBackend(maxsize=int(os.getenv("CONV_CACHE_SIZE", "10000")))
+    if kind == "redis":
+        return RedisBackend(os.getenv("CONV_CACHE_REDIS_URL", "redis://localhost:6379/0"),
+                            ttl=int(os.getenv("CONV_CACHE_TTL", "3600")))
+    if kind == "none":
+        return NullBackend()
+    raise ValueError(f"CONV_CACHE_BACKEND 必須是 local / redis / none：{kind!r}")
+
+
+conv_cache = ConversationCache(backend_from_env())
+
+
+# 後台或其他地方透過 ORM 改到 Conversation → 快取失效
+@event.listens_for(Session, "after_flush")
+def _invalidate_on_orm_change(session, flush_context):
+    for obj in list(session.dirty) + list(session.deleted):
+        if isinstance(obj, Conversation):
+            conv_cache.invalidate(obj.line_user_id)
@@ -0,0 +1,131 @@
+# dedup.py
+"""
+webhookEventId 去重：LINE 在回應太慢時會重送同一事件，
+重複的 CONFIRM_SUBMIT 會建立重複的 Order，所以在進 handler 前先擋掉。
+
+  - 記憶體：有 TTL 的 LRU（OrderedDict），O(1) 判斷
+  - DB（WEBHOOK_DEDUP_DB=1）：processed_events 表，主鍵衝突即代表其他程序已處理過
+
+設定：
+  WEBHOOK_DEDUP_SIZE=50000   LRU 上限筆數
+  WEBHOOK_DEDUP_TTL=600      保留秒數（LINE 重送在幾分鐘內）
+  WEBHOOK_DEDUP_DB=0         1 = 同時寫入 processed_events（多程序部署時開啟）
+
+注意：事件在執行 handler 前就被記錄，handler 失敗後的重送也會被擋掉（寧可少做、不可重複下單）。
+"""
+import os, threading, time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from sqlalchemy.exc import IntegrityError
+
+from models import db, ProcessedEvent
+
+
+class TTLCache:
+    """只存 key 與寫入時間的 LRU；過期或超過上限就淘汰最舊的。"""
+    def __init__(self, maxsize: int = 50000, ttl: float = 600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add_if_absent(self, key) -> bool:
+        """key 不存在（或已過期）時寫入並回 True；已存在回 False。"""
+        now = time.monotonic()
+        with self._lock:
+            ts = self._data.get(key)
+            if ts is not None and now - ts < self.ttl:
+                return False
+            self._data[key] = now
+            self._data.move_to_end(key)
+            # 最舊的在最前面，依序淘汰過期或超量的
+            while self._data:
+                k, t = next(iter(self._data.items()))
+                if len(self._data) > self.maxsize or now - t >= self.ttl:
+                    self._data.popitem(last=False)
+                else:
+                    break
+            return True
+
+    def discard(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def __len__(self):
+        return len(self._data)
+
+
+class EventDeduper:
+    def __init__(self, maxsize: int = 50000, ttl: float = 600, use_db: bool = False,
+                 purge_every: int = 1000):
+        self.cache = TTLCache(maxsize, ttl)
+        self.ttl = ttl
+        self.use_db = use_db
+        self.purge_every = purge_every
+        self._lock = threading.Lock()
+        self._claims = 0
+        self.stats = {"hits": 0, "misses": 0, "db_hits": 0, "no_id": 0}
+
+    def _bump(self, key):
+        with self._lock:
+            self.stats[key] += 1
+            if key == "misses":
+                self._claims += 1
+                return self._claims
+        return 0
+
+    def claim(self, event) -> bool:
+        """
+        第一次看到這個事件回 True（應處理）；重複事件回 False（直接丟棄）。
+        DB 模式需在 app context 內呼叫。
+        """
+        event_id = getattr(event, "webhook_event_id", None)
+        if not event_id:
+            self._bump("no_id")
+            return True
+        if not self.cache.add_if_absent(event_id):
+            self._bump("hits")
+            return False
+
+        if self.use_db and not self._claim_db(event_id):
+            self._bump("hits")
+            self._bump("db_hits")
+            return False
+
+        n = self._bump("misses")
+        if self.use_db and n % self.purge_every == 0:
+            self._purge_db()
+        return True
+
+    def _claim_db(self, event_id) -> bool:
+        try:
+            db.session.add(ProcessedEvent(webhook_event_id=event_id))
+            db.session.commit()
+            return True
+        except IntegrityError:
+            db.session.rollback()
+            return False
+
+    def _purge_db(self):
+        cutoff = datetime.utcnow() - timedelta(seconds=self.ttl)
+        try:
+            ProcessedEvent.query.filter(ProcessedEvent.created_at < cutoff).delete(synchronize_session=False)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+
+    def snapshot(self):
+        with self._lock:
+            out = dict(self.stats)
+        out["size"] = len(self.cache)
+        out["db"] = self.use_db
+        return out
+
+
+def deduper_from_env():
+    return EventDeduper(
+        maxsize=int(os.getenv("WEBHOOK_DEDUP_SIZE", "50000")),
+        ttl=float(os.getenv("WEBHOOK_DEDUP_TTL", "600")),
+        use_db=os.getenv("WEBHOOK_DEDUP_DB", "0") == "1",
+    )
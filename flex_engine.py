@@ -0,0 +1,158 @@
+# flex_engine.py
+"""
+Flex 模板編譯：骨架只組一次，每次回覆只填入會變的欄位。
+
+  _CONFIRM = Template("confirm", {... "text": Slot("name") ...})
+  _CONFIRM.render(name="王小明")     # → flex_helper.PreparedFlex（已序列化的 JSON）
+
+編譯時：
+  - 骨架 json.dumps 一次，切成「固定字串片段 + 插槽」；render 只對插槽值做 json.dumps 再串起來，
+    不建任何 dict
+  - 用預設值（清單插槽各放一筆）跑一次 FlexContainer.from_dict，確認結構合法
+  - 依每個插槽的 max_len / 清單 max_items 算出最大可能大小，超過 LINE 上限就直接丟例外
+    （bubble 30 KB、carousel 50 KB、carousel 最多 12 張）；render 時字串超過 max_len 會截斷，
+    所以實際送出的內容不會超過編譯時檢查過的上限
+
+插槽：
+  Slot(name, max_len=60, default="-")         字串；空白或 None 時用 default；
+                                              超過 max_len 截斷，印 log 並計入 stats["truncated"]
+  Each(name, template, max_items, head=(), tail=(), empty=())
+      清單：每個元素是子模板 render 的參數 dict；head / tail 為固定放在前後的元素，
+      沒有元素時改放 empty
+"""
+import json, re
+
+from linebot.v3.messaging.models import FlexContainer
+
+from flex_helper import PreparedFlex
+
+BUBBLE_MAX_BYTES = 30 * 1024
+CAROUSEL_MAX_BYTES = 50 * 1024
+CAROUSEL_MAX_BUBBLES = 12
+
+stats = {"truncated": 0}
+
+_MARK = "\x00slot:{}\x00"
+_MARK_RE = re.compile(r'"\\u0000slot:(\d+)\\u0000"')
+
+
+def _dumps(v) -> str:
+    return json.dumps(v, ensure_ascii=False, separators=(",", ":"))
+
+
+class Slot:
+    __slots__ = ("name", "max_len", "default")
+
+    def __init__(self, name: str, max_len: int = 60, default: str = "-"):
+        self.name = name
+        self.max_len = max_len
+        self.default = default
+
+    def fill(self, value) -> str:
+        s = "" if value is None else str(value)
+        if not s.strip():
+            s = self.default
+        if len(s) > self.max_len:
+            stats["truncated"] += 1
+            print(f"[flex_engine] slot {self.name!r} truncated: {len(s)} > {self.max_len} chars")
+            s = s[:self.max_len]
+        return _dumps(s)
+
+    def max_bytes(self) -> int:
+        # 中文 UTF-8 3 bytes，加上引號
+        return self.max_len * 3 + 2
+
+    def sample(self):
+        return self.fill(None)
+
+
+class Each:
+    __slots__ = ("name", "template", "max_items", "head", "tail", "empty")
+
+    def __init__(self, name: str, template: "Template", max_items: int, head=(), tail=(), empty=()):
+        self.name = name
+        self.template = template
+        self.max_items = max_items
+        self.head = [_dumps(x) for x in head]
+        self.tail = [_dumps(x) for x in tail]
+        self.empty = [_dumps(x) for x in empty]
+
+    def fill(self, items) -> str:
+        rendered = [self.template.render_json(**kw) for kw in (items or [])[:self.max_items]]
+        if not rendered:
+            rendered = self.empty
+        return "[" + ",".join(self.head + rendered + self.tail) + "]"
+
+    def max_bytes(self) -> int:
+        fixed = sum(len(x.encode()) + 1 for x in self.head + self.tail)
+        body = max(self.max_items * (self.template.max_bytes + 1),
+                   sum(len(x.encode()) + 1 for x in self.empty))
+        return 2 + fixed + body
+
+    def count_max(self) -> int:
+        return len(self.head) + len(self.tail) + max(self.max_items, len(self.empty))
+
+    def sample(self):
+        return self.fill([{}])
+
+
+class Template:
+    def __init__(self, name: str, skeleton: dict):
+        self.name = name
+        self.kind = skeleton.get("type")
+        slots = []
+
+        def mark(node):
+            if isinstance(node, (Slot, Each)):
+                slots.append(node)
+                return _MARK.format(len(slots) - 1)
+            if isinstance(node, dict):
+                return {k: mark(v) for k, v in node.items()}
+            if isinstance(node, list):
+                return [mark(v) for v in node]
+            return node
+
+        parts = _MARK_RE.split(_dumps(mark(skeleton)))
+        # parts：片段, 插槽序號, 片段, 插槽序號, ..., 片段
+        self._fragments = parts[0::2]
+        self._slots = [slots[int(i)] for i in parts[1::2]]
+        names = [s.name for s in self._slots]
+        if len(set(names)) != len(names):
+            raise ValueError(f"Flex 模板 {name}：插槽名稱重複 {names}")
+
+        static = sum(len(f.encode()) for f in self._fragments)
+        self.max_bytes = static + sum(s.max_bytes() for s in self._slots)
+        self._check_budget()
+        if self.kind in ("bubble", "carousel"):
+            # 用預設值組一份完整內容讓 SDK 驗證一次（子模板隨外層一起驗）
+            FlexContainer.from_dict(json.loads(self._join([s.sample() for s in self._slots])))
+
+    def _check_budget(self):
+        if self.kind == "carousel":
+            limit = CAROUSEL_MAX_BYTES
+            count = sum(s.count_max() for s in self._slots if isinstance(s, Each))
+            if count > CAROUSEL_MAX_BUBBLES:
+                raise ValueError(f"Flex 模板 {self.name}：carousel 最多 {count} 張，超過 {CAROUSEL_MAX_BUBBLES}")
+        elif self.kind == "bubble":
+            limit = BUBBLE_MAX_BYTES
+        else:
+            return   # bubble 的一部分（子模板），由外層模板一起算
+        if self.max_bytes > limit:
+            raise ValueError(f"Flex 模板 {self.name}：最大 {self.max_bytes} bytes，超過 LINE 上限 {limit}")
+
+    def _join(self, filled) -> str:
+        out = [self._fragments[0]]
+        for value, frag in zip(filled, self._fragments[1:]):
+            out.append(value)
+            out.append(frag)
+        return "".join(out)
+
+    def render_json(self, **values) -> str:
+        return self._join([s.fill(values.get(s.name)) for s in self._slots])
+
+    def render(self, **values) -> PreparedFlex:
+        return PreparedFlex(None, self.render_json(**values))
+
+
+def snapshot():
+    return dict(stats)
@@ -1,33 +1,154 @@
 # flex_helper.py
-from linebot.v3.messaging import MessagingApi, ReplyMessageRequest, TextMessage
-from linebot.v3.messaging.models import FlexMessage, FlexContainer
-
-def reply_text(api_client, reply_token: str, text: str):
-    MessagingApi(api_client).reply_message(
-        ReplyMessageRequest(
-            reply_token=reply_token,
-            messages=[TextMessage(text=text)]
-        )
-    )
-
-def reply_flex(api_client, reply_token: str, alt_text: str, contents: dict):
-    try:
-        container = FlexContainer.from_dict(contents)
-    except Exception as e:
-        # 內容不是合法的 bubble/carousel，回傳可讀訊息幫你定位
-        MessagingApi(api_client).reply_message(
-            ReplyMessageRequest(
-                reply_token=reply_token,
-                messages=[TextMessage(text=f"⚠️ Flex 內容不合法：{e}")]
-            )
-        )
-        return
-
-    MessagingApi(api_client).reply_message(
-        ReplyMessageRequest(
-            reply_token=reply_token,
-            messages=[FlexMessage(alt_text=alt_text or "Flex", contents=container)]
-        )
-    )
+"""
+回覆訊息的小工具。
 
+reply_flex 的快速路徑：
+  FlexContainer.from_dict 每次都要建一整棵 pydantic 物件，SDK 再把它轉回 JSON 送出。
+  這裡改成每種「模板形狀」（巢狀的 key、type/layout/style 等列舉值，不含文字內容）
+  只用 FlexContainer.from_dict 驗證一次，之後同形狀的內容直接 json.dumps 後送出。
+  驗證時也比對 SDK 轉回的 dict 是否與原內容相同；不同（例如含 SDK 會丟掉的欄位）的形狀
+  一律照 SDK 的輸出送，確保送出去的 JSON 與嚴格模式一致。
 
+  FLEX_STRICT=1   每次都完整驗證並走 SDK 原本的路徑（除錯用）
+
+prepare(contents) 可預先驗證 + 序列化（例如服務分頁這種固定內容），reply_flex 直接送出字串。
+
+api_client 傳 None 時使用 line_client 的程序共用 client（keep-alive 連線池）。
+所有回覆都交給 outbound.deliver 送出（重試、斷路器、token 過期改 push）。
+在 unit of work（webhook 事件）內呼叫時，訊息先序列化好，deliver 排到 commit 成功之後才送。
+"""
+import json, os, threading
+
+from linebot.v3.messaging import models
+from linebot.v3.messaging.models import (
+    TextMessage, FlexMessage, FlexContainer, QuickReply, QuickReplyItem, PostbackAction
+)
+
+import outbound
+
+FLEX_STRICT = os.getenv("FLEX_STRICT", "0") == "1"
+
+def _sdk_enum_keys():
+    """SDK 的 Flex 元件與 action 模型裡有列舉驗證（<欄位>_validate_enum）的欄位，取 JSON 用的 key。"""
+    keys = set()
+    for name, cls in vars(models).items():
+        fields = getattr(cls, "__fields__", None)
+        if not isinstance(cls, type) or not fields:
+            continue
+        if not (name.startswith("Flex") or issubclass(cls, models.Action)):
+            continue
+        for attr in dir(cls):
+            if attr.endswith("_validate_enum") and attr[:-len("_validate_enum")] in fields:
+                keys.add(fields[attr[:-len("_validate_enum")]].alias)
+    return keys
+
+
+# 這些 key 的字串值是列舉，形狀不同就要重新驗證；其他字串（text、label、data…）視為內容
+# SDK 驗證的列舉（mode、inputOption、justifyContent…）自動帶入，SDK 新增的欄位不必手動補
+_ENUM_KEYS = frozenset({
+    "type", "layout", "style", "height", "size", "weight", "align", "gravity", "position",
+    "margin", "spacing", "aspectMode", "aspectRatio", "decoration", "direction", "wrap",
+} | _sdk_enum_keys())
+
+_validated_shapes = {}   # 形狀 → 原內容可直接送出（True）/ 需經 SDK 轉換（False）
+_shapes_lock = threading.Lock()
+stats = {"fast": 0, "validated": 0, "strict": 0, "invalid": 0}
+
+
+def quick_reply(options):
+    """options：[(label, postback data), ...]，LINE 最多 13 個、label 最長 20 字。"""
+    items = [
+        QuickReplyItem(action=PostbackAction(label=label[:20], data=data, display_text=label))
+        for label, data in options[:13]
+    ]
+    return QuickReply(items=items) if items else None
+
+def _dumps(v) -> str:
+    return json.dumps(v, ensure_ascii=False, separators=(",", ":"))
+
+
+def reply_text(api_client, reply_token: str, text: str, quick_replies=None):
+    msg = TextMessage(text=text, quick_reply=quick_reply(quick_replies or []))
+    outbound.deliver(api_client, reply_token, _dumps([msg.to_dict()]))
+
+
+def shape_of(obj):
+    """模板形狀：dict → key 與子形狀、list → 元素形狀的集合（長度不影響）、列舉 key 保留值。"""
+    if isinstance(obj, dict):
+        return frozenset((k, v if k in _ENUM_KEYS and not isinstance(v, (dict, list)) else shape_of(v))
+                         for k, v in obj.items())
+    if isinstance(obj, list):
+        return ("list", frozenset(shape_of(v) for v in obj))
+    if isinstance(obj, bool):
+        return "b"
+    if isinstance(obj, (int, float)):
+        return "n"
+    if obj is None:
+        return None
+    return "s"
+
+
+class PreparedFlex:
+    """已驗證、已序列化的 Flex 內容（json 為序列化後的字串；contents 需要時才由 json 還原）。"""
+    __slots__ = ("_contents", "json")
+
+    def __init__(self, contents: dict | None, json_str: str):
+        self._contents = contents
+        self.json = json_str
+
+    @property
+    def contents(self) -> dict:
+        if self._contents is None:
+            self._contents = json.loads(self.json)
+        return self._contents
+
+
+def prepare(contents: dict) -> PreparedFlex:
+    """驗證（同形狀只驗一次）並序列化；內容不合法時丟出 SDK 的驗證例外。"""
+    if isinstance(contents, PreparedFlex):
+        return contents
+    shape = shape_of(contents)
+    as_is = _validated_shapes.get(shape)
+    data = contents
+    if as_is is None:
+        converted = FlexContainer.from_dict(contents).to_dict()   # 不合法會丟例外
+        as_is = converted == contents
+        with _shapes_lock:
+            _validated_shapes[shape] = as_is
+        stats["validated"] += 1
+        data = converted
+    elif not as_is:
+        data = FlexContainer.from_dict(contents).to_dict()
+    return PreparedFlex(contents, _dumps(data))
+
+
+def _reply_invalid(api_client, reply_token: str, e):
+    # 內容不是合法的 bubble/carousel，回傳可讀訊息幫你定位
+    stats["invalid"] += 1
+    reply_text(api_client, reply_token, f"⚠️ Flex 內容不合法：{e}")
+
+
+def reply_flex(api_client, reply_token: str, alt_text: str, contents):
+    """contents 可以是 dict 或 prepare() 的結果。"""
+    if FLEX_STRICT:
+        raw = contents.contents if isinstance(contents, PreparedFlex) else contents
+        try:
+            container = FlexContainer.from_dict(raw)
+        except Exception as e:
+            return _reply_invalid(api_client, reply_token, e)
+        stats["strict"] += 1
+        msg = FlexMessage(alt_text=alt_text or "Flex", contents=container)
+        return outbound.deliver(api_client, reply_token, _dumps([msg.to_dict()]))
+
+    if not isinstance(contents, PreparedFlex):
+        try:
+            contents = prepare(contents)
+        except Exception as e:
+            return _reply_invalid(api_client, reply_token, e)
+    stats["fast"] += 1
+    messages = '[{"type":"flex","altText":%s,"contents":%s}]' % (_dumps(alt_text or "Flex"), contents.json)
+    outbound.deliver(api_client, reply_token, messages)
+
+
+def snapshot():
+    return dict(stats, strict_mode=FLEX_STRICT, shapes=len(_validated_shapes))
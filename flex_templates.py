@@ -1,6 +1,45 @@
 # flex_templates.py
+"""
+Flex 內容。
+
+固定結構的 bubble（確認頁、訂單詳情、車輛卡、設定…）用 flex_engine.Template 在 import 時編譯一次，
+呼叫時只填入插槽，回傳已序列化的 PreparedFlex；
+按鈕數量 / 頁尾隨資料變動的（服務分頁、時段清單、車輛選單）仍直接組 dict。
+"""
 from datetime import datetime
 
+from flex_engine import Template, Slot, Each
+
+
+def _kv(label: str, value, label_flex: int = 2):
+    """「標題：內容」一列（baseline box）。"""
+    return {"type": "box", "layout": "baseline", "spacing": "sm", "contents": [
+        {"type": "text", "text": label, "size": "sm", "color": "#888888", "flex": label_flex},
+        {"type": "text", "text": value, "size": "sm", "wrap": True, "flex": 5}
+    ]}
+
+
+def _info_body(title: str, rows):
+    return {"type": "box", "layout": "vertical", "contents": [
+        {"type": "text", "text": title, "weight": "bold", "size": "lg"},
+        {"type": "separator", "margin": "md"},
+        {"type": "box", "layout": "vertical", "spacing": "md", "margin": "md", "contents": rows}
+    ]}
+
+
+def _postback_btn(style: str, label: str, data):
+    return {"type": "button", "style": style, "action": {"type": "postback", "label": label, "data": data}}
+
+
+def _picker_btn(data):
+    return {"type": "button", "style": "primary", "action": {
+        "type": "datetimepicker", "label": "選日期時間", "data": data, "mode": "datetime",
+        "initial": Slot("initial", 16), "min": Slot("min", 16), "max": Slot("max", 16)}}
+
+
+def _footer(*buttons):
+    return {"type": "box", "layout": "vertical", "spacing": "sm", "contents": list(buttons)}
+
 def bubble_vehicle_picker(options):
     # options: [{"i":1,"label":"AAA-1234 | YAMAHA Many"}]
     btns = []
@@ -102,10 +141,18 @@ def bubble_services_page(services, page: int, per_page: int = 6):
         "footer": {"type": "box", "layout": "horizontal", "spacing": "sm", "contents": footer_btns}
     }
 
-def bubble_timeslots(slots: list[datetime], page: int, per_page: int = 6):
-    total = len(slots)
-    start = (page - 1) * per_page
-    page_items = slots[start:start + per_page]
+def bubble_timeslots(slots: list[datetime], page: int, per_page: int = 6,
+                     has_prev: bool | None = None, has_next: bool | None = None):
+    """
+    slots 為完整清單時依 page 切頁；有給 has_prev / has_next 時 slots 就是本頁的項目（游標分頁）。
+    """
+    if has_next is None:
+        total = len(slots)
+        start = (page - 1) * per_page
+        page_items = slots[start:start + per_page]
+        has_prev, has_next = page > 1, page * per_page < total
+    else:
+        page_items = slots[:per_page]
     btns = []
     for dt in page_items:
         btns.append({
@@ -122,13 +169,13 @@ def bubble_timeslots(slots: list[datetime], page: int, per_page: int = 6):
         btns = [{"type": "text", "text": "近期沒有可預約時段", "color": "#888888"}]
 
     footer = []
-    if page > 1:
+    if has_prev:
         footer.append({
             "type": "button",
             "style": "secondary",
             "action": {"type": "postback", "label": "上一頁", "data": "SLOT_PREV"}
         })
-    if page * per_page < total:
+    if has_next:
         footer.append({
             "type": "button",
             "style": "secondary",
@@ -155,48 +202,19 @@ def bubble_timeslots(slots: list[datetime], page: int, per_page: int = 6):
         "footer": {"type": "box", "layout": "horizontal", "spacing": "sm", "contents": footer}
     }
 
+_CONFIRM = Template("confirm", {
+    "type": "bubble",
+    "body": _info_body("請確認預約資訊", [
+        _kv("姓名", Slot("name")), _kv("電話", Slot("phone")), _kv("車牌", Slot("plate")),
+        _kv("服務", Slot("service", 100)), _kv("時間", Slot("time")),
+    ]),
+    "footer": _footer(_postback_btn("primary", "確認送出", "CONFIRM_SUBMIT"),
+                      _postback_btn("secondary", "取消流程", "FLOW_CANCEL")),
+})
+
 def bubble_confirm(payload: dict):
-    rows = [
-        ("姓名", payload.get("name") or "-"),
-        ("電話", payload.get("phone") or "-"),
-        ("車牌", payload.get("plate") or "-"),
-        ("服務", payload.get("service_name") or "-"),
-        ("時間", payload.get("booked_at") or "-"),
-    ]
-    lines = []
-    for k, v in rows:
-        lines.append({
-            "type": "box",
-            "layout": "baseline",
-            "spacing": "sm",
-            "contents": [
-                {"type": "text", "text": str(k), "color": "#888888", "size": "sm", "flex": 2},
-                {"type": "text", "text": str(v) if str(v).strip() else "-", "wrap": True, "size": "sm", "flex": 5}
-            ]
-        })
-    return {
-        "type": "bubble",
-        "body": {
-            "type": "box",
-            "layout": "vertical",
-            "contents": [
-                {"type": "text", "text": "請確認預約資訊", "weight": "bold", "size": "lg"},
-                {"type": "separator", "margin": "md"},
-                {"type": "box", "layout": "vertical", "spacing": "md", "margin": "md", "contents": lines}
-            ]
-        },
-        "footer": {
-            "type": "box",
-            "layout": "vertical",
-            "spacing": "sm",
-            "contents": [
-                {"type": "button", "style": "primary",
-                 "action": {"type": "postback", "label": "確認送出", "data": "CONFIRM_SUBMIT"}},
-                {"type": "button", "style": "secondary",
-                 "action": {"type": "postback", "label": "取消流程", "data": "FLOW_CANCEL"}}
-            ]
-        }
-    }
+    return _CONFIRM.render(name=payload.get("name"), phone=payload.get("phone"), plate=payload.get("plate"),
+                           service=payload.get("service_name"), time=payload.get("booked_at"))
 
 
 def bubble_orders(rows, mode_label=None):
@@ -248,6 +266,22 @@ def bubble_orders(rows, mode_label=None):
     }
 
 # === 單筆訂單詳情 bubble（含取消/調整時間的 Postback）===
+_ORDER_DETAIL = Template("order_detail", {
+    "type": "bubble",
+    "body": _info_body("預約詳情", [
+        _kv("編號", Slot("no", 16)), _kv("狀態", Slot("status", 20)), _kv("時間", Slot("time", 20, "未排定")),
+        _kv("車牌", Slot("plate")), _kv("服務", Slot("services", 200)),
+    ]),
+    "footer": _footer(_postback_btn("primary", "取消預約", Slot("cancel_data", 40)),
+                      _postback_btn("secondary", "調整時間", Slot("reschedule_data", 40))),
+})
+
+def _order_detail_values(order_row: dict):
+    oid = order_row["id"]
+    return {"no": f"#{oid}", "status": order_row.get("status"), "time": order_row.get("time"),
+            "plate": order_row.get("plate"), "services": order_row.get("services"),
+            "cancel_data": f"CANCEL#{oid}", "reschedule_data": f"RESCHEDULE#{oid}"}
+
 def bubble_order_detail(order_row: dict):
     """
     order_row: {
@@ -258,295 +292,171 @@ def bubble_order_detail(order_row: dict):
       "time": str
     }
     """
-    lines = [
-        {"type":"box","layout":"baseline","spacing":"sm","contents":[
-            {"type":"text","text":"編號","size":"sm","color":"#888888","flex":2},
-            {"type":"text","text":f"#{order_row['id']}", "size":"sm","wrap":True,"flex":5}
-        ]},
-        {"type":"box","layout":"baseline","spacing":"sm","contents":[
-            {"type":"text","text":"狀態","size":"sm","color":"#888888","flex":2},
-            {"type":"text","text":order_row.get("status","-"), "size":"sm","wrap":True,"flex":5}
-        ]},
-        {"type":"box","layout":"baseline","spacing":"sm","contents":[
-            {"type":"text","text":"時間","size":"sm","color":"#888888","flex":2},
-            {"type":"text","text":order_row.get("time","未排定"), "size":"sm","wrap":True,"flex":5}
-        ]},
-        {"type":"box","layout":"baseline","spacing":"sm","contents":[
-            {"type":"text","text":"車牌","size":"sm","color":"#888888","flex":2},
-            {"type":"text","text":(order_row.get("plate") or "-"), "size":"sm","wrap":True,"flex":5}
-        ]},
-        {"type":"box","layout":"baseline","spacing":"sm","contents":[
-            {"type":"text","text":"服務","size":"sm","color":"#888888","flex":2},
-            {"type":"text","text":(order_row.get("services") or "-"), "size":"sm","wrap":True,"flex":5}
-        ]},
-    ]
-    return {
-      "type":"bubble",
-      "body":{"type":"box","layout":"vertical","contents":[
-        {"type":"text","text":"預約詳情","weight":"bold","size":"lg"},
-        {"type":"separator","margin":"md"},
-        {"type":"box","layout":"vertical","spacing":"md","margin":"md","contents":lines}
-      ]},
-      "footer":{"type":"box","layout":"vertical","spacing":"sm","contents":[
-        {"type":"button","style":"primary",
-         "action":{"type":"postback","label":"取消預約","data":f"CANCEL#{order_row['id']}"}},
-        {"type":"button","style":"secondary",
-         "action":{"type":"postback","label":"調整時間","data":f"RESCHEDULE#{order_row['id']}"}}
-      ]}
-    }
+    return _ORDER_DETAIL.render(**_order_detail_values(order_row))
 
 # === 多筆 orders 組成 carousel（最多 10 張）===
+_ORDERS_CAROUSEL = Template("orders_carousel", {
+    "type": "carousel",
+    "contents": Each("orders", _ORDER_DETAIL, 10, empty=[{   # LINE 限制最多 10 張
+        "type": "bubble",
+        "body": {"type": "box", "layout": "vertical", "contents": [
+            {"type": "text", "text": "目前沒有預約", "weight": "bold", "size": "lg"},
+            {"type": "separator", "margin": "md"},
+            {"type": "text", "text": "輸入「預約」開始建立新預約", "size": "sm", "color": "#888888", "margin": "md"}
+        ]}
+    }]),
+})
+
 def carousel_orders_full(rows: list[dict]):
-    bubbles = [bubble_order_detail(r) for r in rows[:10]]  # LINE 限制最多 10 張
-    if not bubbles:
-        bubbles = [{
-          "type":"bubble",
-          "body":{"type":"box","layout":"vertical","contents":[
-            {"type":"text","text":"目前沒有預約","weight":"bold","size":"lg"},
-            {"type":"separator","margin":"md"},
-            {"type":"text","text":"輸入「預約」開始建立新預約","size":"sm","color":"#888888","margin":"md"}
-          ]}
-        }]
-    return {"type":"carousel","contents":bubbles}
+    return _ORDERS_CAROUSEL.render(orders=[_order_detail_values(r) for r in rows[:10]])
 
 # === 取消預約確認 bubble（兩個按鈕：確認、返回） ===
+_CANCEL_CONFIRM = Template("cancel_confirm", {
+    "type": "bubble",
+    "body": _info_body("確認取消這筆預約？", [
+        _kv("編號", Slot("no", 16)), _kv("時間", Slot("time", 20, "未排定")),
+        _kv("車牌", Slot("plate")), _kv("服務", Slot("services", 200)),
+    ]),
+    "footer": _footer(_postback_btn("primary", "確認取消", Slot("confirm_data", 40)),
+                      _postback_btn("secondary", "返回", "BACK_MY_ORDERS")),
+})
+
 def bubble_cancel_confirm(order_row: dict):
     """
     order_row: { id, plate, status, services, time }
     """
-    lines = [
-        {"type":"box","layout":"baseline","spacing":"sm","contents":[
-            {"type":"text","text":"編號","size":"sm","color":"#888888","flex":2},
-            {"type":"text","text":f"#{order_row['id']}", "size":"sm","wrap":True,"flex":5}
-        ]},
-        {"type":"box","layout":"baseline","spacing":"sm","contents":[
-            {"type":"text","text":"時間","size":"sm","color":"#888888","flex":2},
-            {"type":"text","text":order_row.get("time","未排定"), "size":"sm","wrap":True,"flex":5}
-        ]},
-        {"type":"box","layout":"baseline","spacing":"sm","contents":[
-            {"type":"text","text":"車牌","size":"sm","color":"#888888","flex":2},
-            {"type":"text","text":(order_row.get("plate") or "-"), "size":"sm","wrap":True,"flex":5}
-        ]},
-        {"type":"box","layout":"baseline","spacing":"sm","contents":[
-            {"type":"text","text":"服務","size":"sm","color":"#888888","flex":2},
-            {"type":"text","text":(order_row.get("services") or "-"), "size":"sm","wrap":True,"flex":5}
-        ]},
-    ]
-    return {
-        "type":"bubble",
-        "body":{"type":"box","layout":"vertical","contents":[
-            {"type":"text","text":"確認取消這筆預約？","weight":"bold","size":"lg"},
-            {"type":"separator","margin":"md"},
-            {"type":"box","layout":"vertical","spacing":"md","margin":"md","contents":lines}
-        ]},
-        "footer":{"type":"box","layout":"vertical","spacing":"sm","contents":[
-            {"type":"button","style":"primary",
-             "action":{"type":"postback","label":"確認取消", "data":f"CANCEL_CONFIRM#{order_row['id']}"}},
-            {"type":"button","style":"secondary",
-             "action":{"type":"postback","label":"返回", "data":"BACK_MY_ORDERS"}}
-        ]}
-    }
+    return _CANCEL_CONFIRM.render(no=f"#{order_row['id']}", time=order_row.get("time"),
+                                  plate=order_row.get("plate"), services=order_row.get("services"),
+                                  confirm_data=f"CANCEL_CONFIRM#{order_row['id']}")
+
+_NEW_BOOKING_PICKER = Template("new_booking_picker", {
+    "type": "bubble",
+    "body": _info_body("選擇預約日期時間", [
+        _kv("姓名", Slot("name")), _kv("電話", Slot("phone")), _kv("車牌", Slot("plate")),
+        _kv("服務", Slot("service", 100)),
+    ]),
+    "footer": _footer(_picker_btn("NEWBOOK"), _postback_btn("secondary", "取消流程", "FLOW_CANCEL")),
+})
 
 def bubble_new_booking_picker(payload: dict, initial_iso: str, min_iso: str, max_iso: str):
     """
     顯示要預約的新時間的 datetimepicker（尚未有訂單）
     payload 用於顯示：name/phone/plate/service_name
     """
-    lines = []
-    for k, v in [
-        ("姓名", payload.get("name") or "-"),
-        ("電話", payload.get("phone") or "-"),
-        ("車牌", payload.get("plate") or "-"),
-        ("服務", payload.get("service_name") or "-"),
-    ]:
-        lines.append({
-            "type":"box","layout":"baseline","spacing":"sm","contents":[
-                {"type":"text","text":k,"size":"sm","color":"#888888","flex":2},
-                {"type":"text","text":(str(v).strip() or "-"),"size":"sm","wrap":True,"flex":5}
-            ]
-        })
-
-    return {
-        "type":"bubble",
-        "body":{"type":"box","layout":"vertical","contents":[
-            {"type":"text","text":"選擇預約日期時間","weight":"bold","size":"lg"},
-            {"type":"separator","margin":"md"},
-            {"type":"box","layout":"vertical","spacing":"md","margin":"md","contents":lines}
-        ]},
-        "footer":{"type":"box","layout":"vertical","spacing":"sm","contents":[
-            {
-                "type":"button","style":"primary",
-                "action":{
-                    "type":"datetimepicker",
-                    "label":"選日期時間",
-                    "data":"NEWBOOK",
-                    "mode":"datetime",
-                    "initial": initial_iso,
-                    "min": min_iso,
-                    "max": max_iso
-                }
-            },
-            {"type":"button","style":"secondary",
-             "action":{"type":"postback","label":"取消流程","data":"FLOW_CANCEL"}}
-        ]}
-    }
-
-
+    return _NEW_BOOKING_PICKER.render(name=payload.get("name"), phone=payload.get("phone"),
+                                      plate=payload.get("plate"), service=payload.get("service_name"),
+                                      initial=initial_iso, min=min_iso, max=max_iso)
 
 
 # === 改期：用 LINE Datetime Picker 的 bubble ===
+_RESCHEDULE_PICKER = Template("reschedule_picker", {
+    "type": "bubble",
+    "body": _info_body("選擇新的日期時間", [
+        _kv("編號", Slot("no", 16)), _kv("目前時間", Slot("time", 20, "未排定")),
+        _kv("車牌", Slot("plate")), _kv("服務", Slot("services", 200)),
+    ]),
+    "footer": _footer(_picker_btn(Slot("data", 40)), _postback_btn("secondary", "返回", "BACK_MY_ORDERS")),
+})
+
 def bubble_reschedule_picker(order_row: dict, initial_iso: str, min_iso: str, max_iso: str):
     """
     order_row: { id, plate, status, services, time }
     initial_iso/min_iso/max_iso: 'YYYY-MM-DDTHH:MM' (LINE datetimepicker 格式)
     """
-    lines = [
-        {"type":"box","layout":"baseline","spacing":"sm","contents":[
-            {"type":"text","text":"編號","size":"sm","color":"#888888","flex":2},
-            {"type":"text","text":f"#{order_row['id']}", "size":"sm","wrap":True,"flex":5}
-        ]},
-        {"type":"box","layout":"baseline","spacing":"sm","contents":[
-            {"type":"text","text":"目前時間","size":"sm","color":"#888888","flex":2},
-            {"type":"text","text":order_row.get("time","未排定"), "size":"sm","wrap":True,"flex":5}
-        ]},
-        {"type":"box","layout":"baseline","spacing":"sm","contents":[
-            {"type":"text","text":"車牌","size":"sm","color":"#888888","flex":2},
-            {"type":"text","text":(order_row.get("plate") or "-"), "size":"sm","wrap":True,"flex":5}
-        ]},
-        {"type":"box","layout":"baseline","spacing":"sm","contents":[
-            {"type":"text","text":"服務","size":"sm","color":"#888888","flex":2},
-            {"type":"text","text":(order_row.get("services") or "-"), "size":"sm","wrap":True,"flex":5}
-        ]},
-    ]
-    return {
-        "type":"bubble",
-        "body":{"type":"box","layout":"vertical","contents":[
-            {"type":"text","text":"選擇新的日期時間","weight":"bold","size":"lg"},
-            {"type":"separator","margin":"md"},
-            {"type":"box","layout":"vertical","spacing":"md","margin":"md","contents":lines}
-        ]},
-        "footer":{"type":"box","layout":"vertical","spacing":"sm","contents":[
-            {
-                "type":"button","style":"primary",
-                "action":{
-                    "type":"datetimepicker",
-                    "label":"選日期時間",
-                    "data": f"RESCHEDULE#{order_row['id']}",
-                    "mode":"datetime",
-                    "initial": initial_iso,   # e.g. "2025-10-20T14:30"
-                    "min": min_iso,           # e.g. "2025-10-01T09:00"
-                    "max": max_iso            # e.g. "2025-12-31T18:00"
-                }
-            },
-            {"type":"button","style":"secondary",
-             "action":{"type":"postback","label":"返回", "data":"BACK_MY_ORDERS"}}
-        ]}
-    }
+    return _RESCHEDULE_PICKER.render(no=f"#{order_row['id']}", time=order_row.get("time"),
+                                     plate=order_row.get("plate"), services=order_row.get("services"),
+                                     data=f"RESCHEDULE#{order_row['id']}",
+                                     initial=initial_iso, min=min_iso, max=max_iso)
 
 
-def bubble_vehicle_card(vrow):
+_VEHICLE_CARD = Template("vehicle_card", {
+    "type": "bubble",
+    "body": {"type": "box", "layout": "vertical", "spacing": "sm", "contents": [
+        {"type": "text", "text": Slot("plate", 20), "weight": "bold", "size": "lg"},
+        {"type": "text", "text": Slot("subtitle"), "size": "sm", "color": "#666666"}
+    ]},
+    "footer": _footer(_postback_btn("primary", "用這台預約", Slot("data", 40))),
+})
+
+def _vehicle_values(vrow):
     # vrow: {"id":int, "plate":str, "brand":str|None, "model":str|None}
-    subtitle = " ".join([x for x in [vrow.get("brand"), vrow.get("model")] if x]) or "-"
-    return {
-        "type":"bubble",
-        "body":{
-            "type":"box","layout":"vertical","spacing":"sm","contents":[
-                {"type":"text","text":vrow.get("plate","-"),"weight":"bold","size":"lg"},
-                {"type":"text","text":subtitle,"size":"sm","color":"#666666"}
-            ]
-        },
-        "footer":{
-            "type":"box","layout":"vertical","spacing":"sm","contents":[
-                {"type":"button","style":"primary",
-                 "action":{"type":"postback","label":"用這台預約","data":f"VEHICLE_USE:{vrow['id']}"}}
-            ]
-        }
-    }
+    return {"plate": vrow.get("plate"), "data": f"VEHICLE_USE:{vrow['id']}",
+            "subtitle": " ".join([x for x in [vrow.get("brand"), vrow.get("model")] if x])}
+
+def bubble_vehicle_card(vrow):
+    return _VEHICLE_CARD.render(**_vehicle_values(vrow))
+
+_MY_VEHICLES = Template("my_vehicles", {
+    "type": "carousel",
+    "contents": Each("vehicles", _VEHICLE_CARD, 10, tail=[{   # 最後固定一張「新增車輛」卡
+        "type": "bubble",
+        "body": {"type": "box", "layout": "vertical", "spacing": "sm", "contents": [
+            {"type": "text", "text": "新增車輛", "weight": "bold", "size": "lg"},
+            {"type": "text", "text": "綁定你的新車牌", "size": "sm", "color": "#666666"}
+        ]},
+        "footer": _footer(_postback_btn("secondary", "新增車輛", "VEHICLE_ADD")),
+    }]),
+})
 
 def carousel_my_vehicles(vrows):
     # vrows: list of dict (最多 10 張)
-    bubbles = [bubble_vehicle_card(v) for v in vrows[:10]]
-    # 追加一張「新增車輛」卡
-    bubbles.append({
-        "type":"bubble",
-        "body":{"type":"box","layout":"vertical","spacing":"sm","contents":[
-            {"type":"text","text":"新增車輛","weight":"bold","size":"lg"},
-            {"type":"text","text":"綁定你的新車牌","size":"sm","color":"#666666"}
-        ]},
-        "footer":{"type":"box","layout":"vertical","spacing":"sm","contents":[
-            {"type":"button","style":"secondary",
-             "action":{"type":"postback","label":"新增車輛","data":"VEHICLE_ADD"}}
-        ]}
-    })
-    return {"type":"carousel","contents":bubbles}
+    return _MY_VEHICLES.render(vehicles=[_vehicle_values(v) for v in vrows[:10]])
+
+_SETTINGS = Template("settings", {
+    "type": "bubble",
+    "body": _info_body("設定", [_kv("姓名", Slot("name")), _kv("電話", Slot("phone"))]),
+    "footer": _footer(_postback_btn("primary", "修改姓名", "SETTINGS_EDIT_NAME"),
+                      _postback_btn("primary", "修改電話", "SETTINGS_EDIT_PHONE"),
+                      _postback_btn("secondary", "我的車輛", "MY_VEHICLES")),
+})
 
 def bubble_settings(user):
-    name  = user.name or "-"
-    phone = user.phone or "-"
-    lines = [
-        {"type":"box","layout":"baseline","spacing":"sm","contents":[
-            {"type":"text","text":"姓名","size":"sm","color":"#888888","flex":2},
-            {"type":"text","text":name,"size":"sm","flex":5,"wrap":True}
-        ]},
-        {"type":"box","layout":"baseline","spacing":"sm","contents":[
-            {"type":"text","text":"電話","size":"sm","color":"#888888","flex":2},
-            {"type":"text","text":phone,"size":"sm","flex":5,"wrap":True}
-        ]},
-    ]
-    return {
-        "type":"bubble",
-        "body":{"type":"box","layout":"vertical","contents":[
-            {"type":"text","text":"設定","weight":"bold","size":"lg"},
-            {"type":"separator","margin":"md"},
-            {"type":"box","layout":"vertical","spacing":"md","margin":"md","contents":lines}
-        ]},
-        "footer":{"type":"box","layout":"vertical","spacing":"sm","contents":[
-            {"type":"button","style":"primary",
-             "action":{"type":"postback","label":"修改姓名","data":"SETTINGS_EDIT_NAME"}},
-            {"type":"button","style":"primary",
-             "action":{"type":"postback","label":"修改電話","data":"SETTINGS_EDIT_PHONE"}},
-            {"type":"button","style":"secondary",
-             "action":{"type":"postback","label":"我的車輛","data":"MY_VEHICLES"}}
-        ]}
+    return _SETTINGS.render(name=user.name, phone=user.phone)
+
+_BOOKING_SUCCESS = Template("booking_success", {
+    "type": "bubble",
+    "hero": {
+        "type": "image",
+        "url": "https://cdn-icons-png.flaticon.com/512/845/845646.png",
+        "size": "full",
+        "aspectRatio": "1.91:1",
+        "aspectMode": "cover"
+    },
+    "body": {
+        "type": "box",
+        "layout": "vertical",
+        "contents": [
+            {"type": "text", "text": "✅ 預約成功！", "weight": "bold", "size": "xl", "color": "#00AA00"},
+            {"type": "separator", "margin": "md"},
+            {"type": "box", "layout": "vertical", "margin": "md", "contents": [
+                {"type": "text", "text": Slot("order_line", 40), "size": "md"},
+                {"type": "text", "text": Slot("plate_line", 80), "size": "md"},
+                {"type": "text", "text": Slot("service_line", 120), "size": "md"},
+                {"type": "text", "text": Slot("time_line", 40), "size": "md"},
+            ]}
+        ]
+    },
+    "footer": {
+        "type": "box",
+        "layout": "vertical",
+        "spacing": "sm",
+        "contents": [
+            {
+                "type": "button",
+                "action": {"type": "postback", "label": "查看我的預約", "data": "BACK_MY_ORDERS"},
+                "style": "primary", "color": "#2E86C1"
+            }
+        ]
     }
+})
 
 def bubble_booking_success(order_id, payload):
     """
     成功預約通知 Flex
     """
-    return {
-        "type": "bubble",
-        "hero": {
-            "type": "image",
-            "url": "https://cdn-icons-png.flaticon.com/512/845/845646.png",
-            "size": "full",
-            "aspectRatio": "1.91:1",
-            "aspectMode": "cover"
-        },
-        "body": {
-            "type": "box",
-            "layout": "vertical",
-            "contents": [
-                {"type": "text", "text": "✅ 預約成功！", "weight": "bold", "size": "xl", "color": "#00AA00"},
-                {"type": "separator", "margin": "md"},
-                {"type": "box", "layout": "vertical", "margin": "md", "contents": [
-                    {"type": "text", "text": f"訂單編號：#{order_id}", "size": "md"},
-                    {"type": "text", "text": f"車牌：{payload.get('plate','-')}", "size": "md"},
-                    {"type": "text", "text": f"服務項目：{payload.get('service','-')}", "size": "md"},
-                    {"type": "text", "text": f"預約時間：{payload.get('booked_at','-')}", "size": "md"},
-                ]}
-            ]
-        },
-        "footer": {
-            "type": "box",
-            "layout": "vertical",
-            "spacing": "sm",
-            "contents": [
-                {
-                    "type": "button",
-                    "action": {"type": "postback", "label": "查看我的預約", "data": "BACK_MY_ORDERS"},
-                    "style": "primary", "color": "#2E86C1"
-                }
-            ]
-        }
-    }
+    return _BOOKING_SUCCESS.render(
+        order_line=f"訂單編號：#{order_id}",
+        plate_line=f"車牌：{payload.get('plate','-')}",
+        service_line=f"服務項目：{payload.get('service','-')}",
+        time_line=f"預約時間：{payload.get('booked_at','-')}",
+    )
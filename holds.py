@@ -0,0 +1,93 @@
+# holds.py
+"""
+確認頁前的暫時保留（slot_holds）。
+
+NEWBOOK / SLOT_PICK 選好時間時就先佔名額（occupancy.reserve_at，直接計入 slot_occupancy.booked），
+所以容量檢查不必另外查 hold 表；按下 CONFIRM_SUBMIT 時把 hold 轉成訂單（名額不再變動）。
+
+  place(user_id, when, duration)    換掉自己舊的 hold 後重新佔名額，SLOT_HOLD_TTL 秒後過期
+  confirm(user_id, when, duration)  有對應的 hold 就直接刪掉沿用；已被清掉（或時間不同）就重新佔
+  release(user_id)                  取消流程時放掉
+  sweep()                           排程（jobs.py）定期把過期的 hold 一次刪掉並把名額加總後減回去
+
+過期但尚未被清掉的 hold 仍然有效（名額還在），confirm 一樣可以沿用。
+刪除都用 DELETE ... RETURNING，confirm 與 sweep 同時搶同一筆時只有一方拿得到。
+
+設定：
+  SLOT_HOLD_TTL=300    保留秒數
+"""
+import os
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, select
+
+from models import db, SlotHold
+import occupancy
+
+HOLD_TTL_SEC = int(os.getenv("SLOT_HOLD_TTL", "300"))
+
+stats = {"placed": 0, "confirmed": 0, "reserved_late": 0, "released": 0, "expired": 0}
+
+_holds = SlotHold.__table__
+
+
+def _delete_returning(*where):
+    """刪除符合條件的 hold，回傳被刪掉的 (booked_at, duration_min) 清單。"""
+    cols = (_holds.c.booked_at, _holds.c.duration_min)
+    if db.session.get_bind().dialect.delete_returning:
+        return db.session.execute(delete(_holds).where(*where).returning(*cols)).all()
+    rows = db.session.execute(select(_holds.c.user_id, *cols).where(*where).with_for_update()).all()
+    if rows:
+        db.session.execute(delete(_holds).where(_holds.c.user_id.in_([r[0] for r in rows])))
+    return [r[1:] for r in rows]
+
+
+def release(user_id) -> bool:
+    rows = _delete_returning(_holds.c.user_id == user_id)
+    for when, minutes in rows:
+        occupancy.release_at(when, minutes)
+    if rows:
+        stats["released"] += 1
+    return bool(rows)
+
+
+def place(user_id, when: datetime, duration_min: int | None = None):
+    """佔名額並記錄 hold；回傳 (ok, reason)，reason 同 occupancy.reserve_at。"""
+    release(user_id)
+    ok, reason = occupancy.reserve_at(when, duration_min)
+    if not ok:
+        return False, reason
+    db.session.execute(_holds.insert().values(
+        user_id=user_id, booked_at=when, duration_min=duration_min,
+        expires_at=datetime.utcnow() + timedelta(seconds=HOLD_TTL_SEC)))
+    stats["placed"] += 1
+    return True, None
+
+
+def confirm(user_id, when: datetime, duration_min: int | None = None):
+    """
+    下單時呼叫：回傳 (ok, reason)。
+    有相同時間 / 服務時間的 hold → 刪掉沿用（名額已佔）；否則放掉舊的並重新佔。
+    """
+    same_duration = (_holds.c.duration_min.is_(None) if duration_min is None
+                     else _holds.c.duration_min == duration_min)
+    if _delete_returning(_holds.c.user_id == user_id, _holds.c.booked_at == when, same_duration):
+        stats["confirmed"] += 1
+        return True, None
+    release(user_id)
+    stats["reserved_late"] += 1
+    return occupancy.reserve_at(when, duration_min)
+
+
+def sweep(now: datetime | None = None) -> int:
+    """刪掉所有過期的 hold，名額依格子加總後一次批次減回；回傳清掉的筆數。"""
+    rows = _delete_returning(_holds.c.expires_at < (now or datetime.utcnow()))
+    if not rows:
+        return 0
+    occupancy.release_many(rows)
+    stats["expired"] += len(rows)
+    return len(rows)
+
+
+def snapshot():
+    return dict(stats, ttl_sec=HOLD_TTL_SEC)
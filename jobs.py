@@ -0,0 +1,81 @@
+# jobs.py
+"""
+背景排程（APScheduler BackgroundScheduler，與 web 同一個程序）。
+
+每個 job 在 app context 內執行，結束時 commit、失敗時 rollback。
+多個 worker 程序各自跑同一個 job 也沒關係：job 本身以條件式 SQL 寫成（例如 DELETE ... RETURNING），
+同一筆資料只會被其中一個處理到。
+
+設定：
+  SCHEDULER_ENABLED=1   0 = 不啟動排程（跑 CLI / 另外用 cron 時）
+  HOLD_SWEEP_SEC=30     清過期 slot hold 的間隔
+  REMINDER_ENABLED=1    預約前一天提醒（reminders.py），從 REMINDER_HOUR 點起每 15 分鐘一輪
+  MAINTENANCE_ENABLED=1 保養到期提醒（maintenance.py），從 MAINTENANCE_HOUR 點起每小時一輪到 20 點
+"""
+import os, threading, traceback
+
+from apscheduler.schedulers.background import BackgroundScheduler
+
+from models import db
+import holds
+import maintenance
+import reminders
+
+scheduler = None
+
+
+def _run(app, name, func):
+    def job():
+        with app.app_context():
+            try:
+                n = func()
+                db.session.commit()
+                if n:
+                    print(f"[job:{name}] {n}")
+            except Exception:
+                db.session.rollback()
+                print(f"[job:{name}] failed")
+                traceback.print_exc()
+    return job
+
+
+def start(app):
+    global scheduler
+    if scheduler is not None:
+        return scheduler
+    scheduler = BackgroundScheduler(daemon=True)
+    scheduler.add_job(_run(app, "hold_sweep", holds.sweep), "interval", id="hold_sweep",
+                      seconds=int(os.getenv("HOLD_SWEEP_SEC", "30")),
+                      max_instances=1, coalesce=True)
+    if os.getenv("REMINDER_ENABLED", "1") == "1":
+        scheduler.add_job(_run(app, "reminders", reminders.run), "cron", id="reminders",
+                          hour=f"{reminders.REMINDER_HOUR}-23", minute="*/15",
+                          max_instances=1, coalesce=True)
+    if os.getenv("MAINTENANCE_ENABLED", "1") == "1":
+        scheduler.add_job(_run(app, "maintenance", maintenance.run), "cron", id="maintenance",
+                          hour=f"{maintenance.MAINTENANCE_HOUR}-20", minute=0,
+                          max_instances=1, coalesce=True)
+    scheduler.start()
+    return scheduler
+
+
+def submit(name, func, *args):
+    """一次性的背景工作（不碰 DB，例如通知客人）：排程有開就排進去立刻跑，否則開一個背景 thread。"""
+    if scheduler is not None and scheduler.running:
+        scheduler.add_job(func, args=args, name=name, misfire_grace_time=None)
+    else:
+        threading.Thread(target=func, args=args, name=name, daemon=True).start()
+
+
+def start_from_env(app):
+    if os.getenv("SCHEDULER_ENABLED", "1") != "1":
+        return None
+    return start(app)
+
+
+def snapshot():
+    if scheduler is None:
+        return {"running": False}
+    return {"running": scheduler.running,
+            "jobs": {j.id: (j.next_run_time.isoformat() if j.next_run_time else None)
+                     for j in scheduler.get_jobs()}}
@@ -0,0 +1,73 @@
+# line_client.py
+"""
+程序共用的 LINE Messaging API client。
+
+原本每個事件都 `with ApiClient(configuration)`，每次都是新的 urllib3 PoolManager，
+回覆常常要重新做一次 TLS handshake。這裡整個程序只建一個 ApiClient：
+  - urllib3 PoolManager 本身是 thread-safe，webhook worker 可以共用
+  - 每個 host 最多保留 LINE_API_POOL_SIZE 條 keep-alive 連線（另開 TCP keepalive）
+  - snapshot() 回報每個連線池的建立連線數 / 請求數，兩者的差就是重用次數
+
+設定：
+  LINE_API_POOL_SIZE=10    每個 host 的連線池大小（建議 ≥ WEBHOOK_WORKERS）
+  LINE_API_TIMEOUT=10      連線 / 讀取逾時（秒）
+  LINE_API_HOST=           覆寫 API host（例如本機 stub：http://127.0.0.1:8099），預設 https://api.line.me
+"""
+import os, socket, threading
+
+import urllib3
+from urllib3.connection import HTTPConnection
+from linebot.v3.messaging import Configuration, ApiClient, MessagingApi
+
+POOL_SIZE = int(os.getenv("LINE_API_POOL_SIZE", "10"))
+TIMEOUT = float(os.getenv("LINE_API_TIMEOUT", "10"))
+API_HOST = os.getenv("LINE_API_HOST") or None
+
+_lock = threading.Lock()
+_client = None
+_api = None
+
+
+def _configuration() -> Configuration:
+    conf = Configuration(access_token=os.getenv("LINE_CHANNEL_ACCESS_TOKEN"), host=API_HOST)
+    conf.connection_pool_maxsize = POOL_SIZE
+    conf.socket_options = HTTPConnection.default_socket_options + [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+    return conf
+
+
+def get_client() -> ApiClient:
+    global _client, _api
+    if _client is None:
+        with _lock:
+            if _client is None:
+                client = ApiClient(_configuration())
+                client.rest_client.pool_manager.connection_pool_kw["timeout"] = urllib3.Timeout(TIMEOUT)
+                _api = MessagingApi(client)
+                _client = client
+    return _client
+
+
+def messaging_api(api_client=None) -> MessagingApi:
+    """共用 client 時回傳同一個 MessagingApi；傳入其他 client 時另建一個。"""
+    shared = get_client()
+    if api_client is None or api_client is shared:
+        return _api
+    return MessagingApi(api_client)
+
+
+def snapshot():
+    if _client is None:
+        return {"pool_size": POOL_SIZE, "pools": {}}
+    pools = {}
+    pm = _client.rest_client.pool_manager
+    for key in list(pm.pools.keys()):
+        pool = pm.pools.get(key)
+        if pool is None:
+            continue
+        pools[f"{pool.scheme}://{pool.host}:{pool.port}"] = {
+            "connections": pool.num_connections,
+            "requests": pool.num_requests,
+            "reused": max(0, pool.num_requests - pool.num_connections),
+            "idle": pool.pool.qsize() if pool.pool is not None else 0,
+        }
+    return {"pool_size": POOL_SIZE, "pools": pools}
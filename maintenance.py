@@ -0,0 +1,249 @@
+# maintenance.py
+"""
+保養到期提醒（Service.recommend_days）。
+
+maintenance_due：每台車每項服務一列，記最近一次完工（status = completed）的時間。
+  - 增量更新：Order / OrderItem 透過 ORM 變動時（after_flush，與訂單同一個 transaction），
+    只重算受影響車輛的幾列，不掃歷史；沒有變的列保留 notified_at
+    下單時的明細（訂單在 session 裡、不是完工）不查資料庫
+  - 不存 due_at：到期 = last_done_at + recommend_days，每日排程對每項服務算出 cutoff，
+    用 (service_id, last_done_at) 索引做範圍查詢；後台改了 recommend_days 立刻生效，不必重算整張表
+  - 後台 bulk UPDATE 等不經 ORM 的變動要自己呼叫 refresh(vehicle_ids)
+  - `flask --app app rebuild-maintenance` 依 vehicles 分批呼叫 refresh，補齊既有資料
+
+每日推播（jobs.py，MAINTENANCE_HOUR 點起每小時一輪，到 20 點）：
+  - 只撈「已到期、到期不超過 MAINTENANCE_MAX_OVERDUE_DAYS 天、還沒提醒過、沒有未來有效預約」的列，
+    依 (last_done_at, vehicle_id) keyset 分批讀
+  - 內容只跟服務有關，同一項服務每 500 位使用者一次 multicast
+  - 先用條件式 UPDATE 把這批標上 batch_key（= X-Line-Retry-Key）並 commit，送完補 notified_at；
+    中斷的批次下一輪用原本的 batch_key 重送（LINE 回 409 視為已送達）；送出 / 重送與額度檢查在 push_batches.py
+
+設定：
+  MAINTENANCE_ENABLED=1
+  MAINTENANCE_HOUR=10
+  MAINTENANCE_MAX_OVERDUE_DAYS=30
+  MAINTENANCE_RATE=10          每秒最多幾次 multicast
+  MAINTENANCE_SCAN_BATCH=2000
+"""
+import json, os, uuid
+from datetime import datetime, timedelta
+
+from sqlalchemy import event, select, update, delete, func, exists, tuple_, inspect
+from sqlalchemy.orm import Session
+
+from models import db, Order, OrderItem, Vehicle, User, MaintenanceDue
+from availability import ACTIVE_STATUSES, COMPLETED_STATUS
+from catalog import current_catalog
+import outbound
+from push_batches import PushBatches
+
+MAINTENANCE_HOUR = int(os.getenv("MAINTENANCE_HOUR", "10"))
+MAX_OVERDUE_DAYS = int(os.getenv("MAINTENANCE_MAX_OVERDUE_DAYS", "30"))
+RATE = float(os.getenv("MAINTENANCE_RATE", "10"))
+SCAN_BATCH = int(os.getenv("MAINTENANCE_SCAN_BATCH", "2000"))
+CHUNK = outbound.MULTICAST_MAX
+
+bucket = outbound.TokenBucket(RATE, burst=max(1, int(RATE)))
+stats = {"refreshed": 0, "runs": 0, "batches": 0, "recipients": 0, "resumed": 0, "quota_stop": 0}
+
+_due = MaintenanceDue.__table__
+_orders = Order.__table__
+_items = OrderItem.__table__
+_order_mapper = inspect(Order)
+
+
+# ---------- 增量更新 ----------
+def refresh(vehicle_ids, conn=None) -> int:
+    """
+    重算這些車輛的 maintenance_due（一次 GROUP BY）；last_done_at 沒變的列不動（保留 notified_at）。
+    conn 未給時用 db.session（與呼叫端同一個 transaction）。回傳變動列數。
+    """
+    ids = sorted({v for v in vehicle_ids if v is not None})
+    if not ids:
+        return 0
+    execute = conn.execute if conn is not None else db.session.execute
+    done = execute(
+        select(_orders.c.vehicle_id, _items.c.service_id, Vehicle.__table__.c.user_id,
+               func.max(_orders.c.booked_at))
+        .join(_items, _items.c.order_id == _orders.c.id)
+        .join(Vehicle.__table__, Vehicle.__table__.c.id == _orders.c.vehicle_id)
+        .where(_orders.c.vehicle_id.in_(ids))
+        .where(_orders.c.status == COMPLETED_STATUS)
+        .where(_orders.c.booked_at != None)
+        .group_by(_orders.c.vehicle_id, _items.c.service_id, Vehicle.__table__.c.user_id)).all()
+    want = {(v, s): (u, at) for v, s, u, at in done}
+    have = {(v, s): at for v, s, at in execute(
+        select(_due.c.vehicle_id, _due.c.service_id, _due.c.last_done_at).where(_due.c.vehicle_id.in_(ids)))}
+
+    gone = [k for k in have if k not in want]
+    changed = [k for k, (_u, at) in want.items() if k in have and have[k] != at]
+    added = [k for k in want if k not in have]
+    for v, s in gone:
+        execute(delete(_due).where(_due.c.vehicle_id == v, _due.c.service_id == s))
+    for v, s in changed:
+        u, at = want[(v, s)]
+        execute(update(_due).where(_due.c.vehicle_id == v, _due.c.service_id == s)
+                .values(user_id=u, last_done_at=at, batch_key=None, notified_at=None))
+    if added:
+        execute(_due.insert(), [{"vehicle_id": v, "service_id": s, "user_id": want[(v, s)][0],
+                                 "last_done_at": want[(v, s)][1]} for v, s in added])
+    n = len(gone) + len(changed) + len(added)
+    stats["refreshed"] += n
+    return n
+
+
+def _history(obj, attr):
+    hist = inspect(obj).attrs[attr].history
+    return list(hist.added or ()) + list(hist.unchanged or ()) + list(hist.deleted or ())
+
+
+def _known_not_completed(session, order_id) -> bool:
+    """session 裡已有這張訂單、狀態已載入且（含這次 flush 前後）都不是完工：不必查資料庫。"""
+    order = session.identity_map.get(_order_mapper.identity_key_from_primary_key((order_id,)))
+    if order is None or "status" in inspect(order).unloaded:
+        return False
+    return COMPLETED_STATUS not in _history(order, "status")
+
+
+@event.listens_for(Session, "after_flush")
+def _refresh_on_change(session, flush_context):
+    vehicle_ids, order_ids = set(), set()
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, Order):
+            statuses = set(_history(obj, "status"))
+            if COMPLETED_STATUS not in statuses:
+                continue      # 與完工無關的訂單（下單、改期、取消）不影響
+            if obj in session.dirty and not session.is_modified(obj):
+                continue
+            vehicle_ids.update(_history(obj, "vehicle_id"))
+        elif isinstance(obj, OrderItem):
+            order = inspect(obj).attrs.order.loaded_value
+            if isinstance(order, Order) and COMPLETED_STATUS not in _history(order, "status"):
+                continue      # 新訂單的明細（下單時）不必查
+            # 只給 order_id 的明細（CONFIRM_SUBMIT）：訂單若在 session 裡且狀態已載入，直接看它的狀態
+            order_ids.update(oid for oid in _history(obj, "order_id")
+                             if oid is not None and not _known_not_completed(session, oid))
+    order_ids.discard(None)
+    if not vehicle_ids and not order_ids:
+        return
+    conn = session.connection()
+    if order_ids:
+        vehicle_ids.update(conn.execute(
+            select(_orders.c.vehicle_id)
+            .where(_orders.c.id.in_(order_ids))
+            .where(_orders.c.status == COMPLETED_STATUS)).scalars())
+    refresh(vehicle_ids, conn)
+
+
+def rebuild(batch_size: int = 1000) -> int:
+    """依 vehicles 的 id 分批重算（記憶體只放一批）；回傳變動列數。"""
+    n, after = 0, 0
+    while True:
+        ids = db.session.execute(
+            select(Vehicle.id).where(Vehicle.id > after).order_by(Vehicle.id).limit(batch_size)).scalars().all()
+        if not ids:
+            return n
+        n += refresh(ids)
+        db.session.commit()
+        after = ids[-1]
+
+
+# ---------- 每日推播 ----------
+def message_for(service) -> str:
+    text = (f"🔧 保養提醒\n距離上次「{service.name}」已超過 {service.recommend_days} 天，建議近期回廠保養。\n"
+            f"輸入「預約」即可線上預約。")
+    return json.dumps([{"type": "text", "text": text}], ensure_ascii=False)
+
+
+pushes = PushBatches("maintenance", _due, "notified_at", message_for, bucket, stats)
+
+
+def _claim(batch_key: str, service_id: int, vehicle_ids) -> list:
+    """把還沒排進任何批次的列標上 batch_key；回傳搶到的 vehicle_id（多個程序同時跑只有一方拿到）。"""
+    stmt = (update(_due)
+            .where(_due.c.service_id == service_id, _due.c.vehicle_id.in_(vehicle_ids))
+            .where(_due.c.batch_key == None, _due.c.notified_at == None)
+            .values(batch_key=batch_key))
+    if db.session.get_bind().dialect.update_returning:
+        got = db.session.execute(stmt.returning(_due.c.vehicle_id)).scalars().all()
+    else:
+        db.session.execute(stmt)
+        got = db.session.execute(select(_due.c.vehicle_id).where(_due.c.batch_key == batch_key)).scalars().all()
+    db.session.commit()
+    return got
+
+
+def _pending(services):
+    """上次中斷、還沒標記 notified_at 的批次：(batch_key, service, 收件人)。"""
+    keys = db.session.execute(
+        select(_due.c.batch_key, func.min(_due.c.service_id))
+        .where(_due.c.batch_key != None, _due.c.notified_at == None)
+        .group_by(_due.c.batch_key)).all()
+    for key, service_id in keys:
+        uids = db.session.execute(
+            select(User.line_user_id).join(_due, _due.c.user_id == User.id)
+            .where(_due.c.batch_key == key, _due.c.notified_at == None)).scalars().all()
+        yield key, services.get(service_id), uids
+
+
+def _scan(service, now: datetime):
+    """到期、還沒提醒、沒有未來有效預約的列：yield (vehicle_id, line_user_id)。"""
+    cutoff = now - timedelta(days=service.recommend_days)
+    floor = cutoff - timedelta(days=MAX_OVERDUE_DAYS)
+    booked = exists().where(_orders.c.vehicle_id == _due.c.vehicle_id,
+                            _orders.c.status.in_(ACTIVE_STATUSES),
+                            _orders.c.booked_at >= now)
+    after = None
+    while True:
+        q = (select(_due.c.vehicle_id, User.line_user_id, _due.c.last_done_at)
+             .join(User, User.id == _due.c.user_id)
+             .where(_due.c.service_id == service.id)
+             .where(_due.c.last_done_at > floor, _due.c.last_done_at <= cutoff)
+             .where(_due.c.notified_at == None, _due.c.batch_key == None)
+             .where(~booked)
+             .order_by(_due.c.last_done_at, _due.c.vehicle_id)
+             .limit(SCAN_BATCH))
+        if after is not None:
+            q = q.where(tuple_(_due.c.last_done_at, _due.c.vehicle_id) > after)
+        rows = db.session.execute(q).all()
+        if not rows:
+            return
+        for vid, uid, _at in rows:
+            yield vid, uid
+        after = (rows[-1][2], rows[-1][0])
+
+
+def _flush(quota: dict, service, group) -> bool:
+    """group：{vehicle_id: line_user_id}，最多 CHUNK 位使用者。"""
+    key = str(uuid.uuid4())
+    claimed = _claim(key, service.id, list(group))
+    if not claimed:
+        return True
+    return pushes.send(quota, key, service, [group[v] for v in claimed])
+
+
+def run(now: datetime | None = None) -> int:
+    """推播今天到期的保養提醒；回傳這次送出的人數。"""
+    now = now or datetime.now()
+    services = {s.id: s for s in current_catalog().services if s.recommend_days}
+    stats["runs"] += 1
+    before = stats["recipients"]
+    quota = {}
+    if not pushes.resume(quota, _pending(services)):
+        return stats["recipients"] - before
+    for service in services.values():
+        group, users = {}, set()
+        for vid, uid in _scan(service, now):
+            if uid not in users and len(users) >= CHUNK:
+                if not _flush(quota, service, group):
+                    return stats["recipients"] - before
+                group, users = {}, set()
+            group[vid] = uid       # 同一位使用者多台車：一起標記，只送一次
+            users.add(uid)
+        if group and not _flush(quota, service, group):
+            return stats["recipients"] - before
+    return stats["recipients"] - before
+
+
+def snapshot():
+    return dict(stats, hour=MAINTENANCE_HOUR, rate=RATE)
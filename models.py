@@ -47,7 +47,7 @@ class Order(db.Model):
     vehicle_id = db.Column(db.Integer, db.ForeignKey("vehicles.id"), nullable=True, index=True)
 
     status = db.Column(db.String(32), default="pending")
-    booked_at = db.Column(db.DateTime)
+    booked_at = db.Column(db.DateTime, index=True)
     note = db.Column(db.Text)
 
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
@@ -128,4 +128,83 @@ class ShopSlot(db.Model):
     )
 
     def __repr__(self):
-        return f"<ShopSlot weekday={self.weekday} {self.start_time}-{self.end_time} cap={self.capacity}>"
\ No newline at end of file
+        return f"<ShopSlot weekday={self.weekday} {self.start_time}-{self.end_time} cap={self.capacity}>"
+
+class ProcessedEvent(db.Model):
+    """已處理過的 webhookEventId（多程序部署時的去重表，定期清掉過期資料）"""
+    __tablename__ = "processed_events"
+
+    webhook_event_id = db.Column(db.String(64), primary_key=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+    def __repr__(self):
+        return f"<ProcessedEvent {self.webhook_event_id}>"
+
+class SlotOccupancy(db.Model):
+    """每個時段格子（依 ShopSlot.interval_min 對齊）目前的有效預約數；容量檢查只查主鍵"""
+    __tablename__ = "slot_occupancy"
+
+    cell_start = db.Column(db.DateTime, primary_key=True)
+    booked = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f"<SlotOccupancy {self.cell_start} booked={self.booked}>"
+
+class CacheVersion(db.Model):
+    """程序內快取的版本號（ShopSlot 等資料變動時 +1，各 worker 比對後重載）"""
+    __tablename__ = "cache_versions"
+
+    name = db.Column(db.String(64), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    def __repr__(self):
+        return f"<CacheVersion {self.name}={self.version}>"
+
+class SlotHold(db.Model):
+    """選好時間到按下確認之間暫時保留的名額（已計入 slot_occupancy.booked），逾時由排程批次釋放"""
+    __tablename__ = "slot_holds"
+
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id"), primary_key=True)   # 每人最多一個
+    booked_at = db.Column(db.DateTime, nullable=False)
+    duration_min = db.Column(db.Integer)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+    def __repr__(self):
+        return f"<SlotHold user={self.user_id} {self.booked_at} until {self.expires_at}>"
+
+class MaintenanceDue(db.Model):
+    """
+    每台車每項服務最近一次完工時間（orders 變動時增量更新）；
+    到期 = last_done_at + Service.recommend_days，每日排程依 (service_id, last_done_at) 索引範圍查詢。
+    """
+    __tablename__ = "maintenance_due"
+
+    vehicle_id = db.Column(db.Integer, db.ForeignKey("vehicles.id", ondelete="CASCADE"), primary_key=True)
+    service_id = db.Column(db.Integer, db.ForeignKey("services.id", ondelete="CASCADE"), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
+    last_done_at = db.Column(db.DateTime, nullable=False)
+    batch_key = db.Column(db.String(36), index=True)    # 已排進某一批推播（X-Line-Retry-Key）
+    notified_at = db.Column(db.DateTime)                # 這次 last_done_at 已提醒過；再次完工時清空
+
+    __table_args__ = (
+        db.Index("ix_maintenance_due_service_done", "service_id", "last_done_at"),
+    )
+
+    def __repr__(self):
+        return f"<MaintenanceDue vehicle={self.vehicle_id} service={self.service_id} last={self.last_done_at}>"
+
+class ReminderSent(db.Model):
+    """
+    預約提醒的送出紀錄：先寫入（sent_at 為空）再 multicast，送完補上 sent_at。
+    同一批共用 batch_key（即 X-Line-Retry-Key），程序中斷後重送同一批不會讓客人收到兩次。
+    """
+    __tablename__ = "reminder_sent"
+
+    order_id = db.Column(db.Integer, db.ForeignKey("orders.id", ondelete="CASCADE"), primary_key=True)
+    booked_at = db.Column(db.DateTime, primary_key=True)    # 改期後的新時間會再提醒一次
+    batch_key = db.Column(db.String(36), nullable=False, index=True)
+    sent_at = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return f"<ReminderSent order={self.order_id} {self.booked_at} batch={self.batch_key}>"
@@ -0,0 +1,268 @@
+# occupancy.py
+"""
+時段佔用計數表（slot_occupancy）：每個格子一列，booked = 目前 pending/confirmed 的訂單數。
+
+  - 容量檢查：主鍵查一列，不再 count orders
+  - 下單 / 改期：條件式加一
+        UPDATE slot_occupancy SET booked = booked + 1 WHERE cell_start = :c AND booked < :cap
+    影響 0 列代表已滿；同時確認同一格時由 DB 的 row lock 排隊，不會超賣
+  - 取消 / 改期的舊時段：booked - 1
+  - 批次（過期 hold、後台 bulk 動作）：release_many / force_reserve_many 依格子加總，一次 executemany
+  - 後台 ModelView（OrderAdmin / OrderItemAdmin）新增、修改、刪除：依改動前後訂單佔的格子
+    release_at / reserve_at(force=True)，與異動同一個 commit
+  - 其他直接改 Order / OrderItem 的程式要自己呼叫上面這些，否則計數會偏掉（只能靠 rebuild 修正）
+  - rebuild()：依 orders 重新計算整張表（部署初次或資料不一致時用 `flask --app app rebuild-occupancy`）
+
+訂單佔用的格子依服務時間（OrderItem → Service.duration_min 加總）計算：
+40 分鐘的「煞車皮更換」在 30 分鐘一格的時段會佔兩格，每一格都要 +1。
+沒有明細的訂單視為只佔開始時間那一格。
+服務時間不存在訂單上，釋放時依當下的 Service.duration_min 重算；
+後台改了服務時間後若要讓既有訂單一致，跑一次 rebuild。
+"""
+from collections import Counter
+from datetime import datetime
+
+from sqlalchemy import update, delete, func, case, bindparam
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from models import db, Order, OrderItem, Service, SlotOccupancy
+from availability import ACTIVE_STATUSES
+from schedule import current_schedule, CLOSED_DAY, CLOSED_TIME, OVERRUN
+from catalog import current_catalog, DEFAULT_DURATION_MIN
+
+
+def cell_for(when: datetime):
+    """
+    回傳 (cell_start, capacity, reason)；
+    不在營業日 / 營業時段時 cell_start 為 None，reason 為 CLOSED_DAY / CLOSED_TIME。
+    """
+    return current_schedule().cell_for(when)
+
+
+def cells_for(when: datetime, duration_min: int | None = None, strict: bool = True):
+    """回傳 ([(cell_start, capacity), ...], reason)，見 WeeklySchedule.cells_for_span。"""
+    return current_schedule().cells_for_span(when, duration_min, strict=strict)
+
+
+def _duration_expr():
+    return func.sum(func.coalesce(Service.duration_min, DEFAULT_DURATION_MIN))
+
+
+def service_duration(service_id) -> int | None:
+    if not service_id:
+        return None
+    s = current_catalog().by_id.get(int(service_id))
+    return s.duration_min if s else DEFAULT_DURATION_MIN
+
+
+def order_durations(order_ids) -> dict:
+    """{order_id: 服務總分鐘數}，一次 GROUP BY；沒有明細的訂單不在結果裡。"""
+    ids = list(order_ids)
+    if not ids:
+        return {}
+    rows = (db.session.query(OrderItem.order_id, _duration_expr())
+            .join(Service, Service.id == OrderItem.service_id)
+            .filter(OrderItem.order_id.in_(ids))
+            .group_by(OrderItem.order_id)
+            .all())
+    return {oid: int(m) for oid, m in rows}
+
+
+def order_duration(order) -> int | None:
+    if order is None or order.id is None:
+        return None
+    return order_durations([order.id]).get(order.id)
+
+
+def booked(cell_start: datetime) -> int:
+    v = (db.session.query(SlotOccupancy.booked)
+         .filter(SlotOccupancy.cell_start == cell_start)
+         .scalar())
+    return v or 0
+
+
+def booked_many(cell_starts) -> dict:
+    """{cell_start: booked}，一次主鍵 IN 查詢；沒有列的格子視為 0。"""
+    cells = list(cell_starts)
+    if len(cells) == 1:
+        return {cells[0]: booked(cells[0])}
+    rows = (db.session.query(SlotOccupancy.cell_start, SlotOccupancy.booked)
+            .filter(SlotOccupancy.cell_start.in_(cells))
+            .all())
+    found = dict(rows)
+    return {c: found.get(c, 0) or 0 for c in cells}
+
+
+def _ensure_rows(cell_starts):
+    values = [{"cell_start": c, "booked": 0} for c in cell_starts]
+    if not values:
+        return
+    dialect = db.session.get_bind().dialect.name
+    if dialect == "postgresql":
+        stmt = pg_insert(SlotOccupancy).values(values).on_conflict_do_nothing()
+    elif dialect == "sqlite":
+        stmt = sqlite_insert(SlotOccupancy).values(values).on_conflict_do_nothing()
+    else:
+        added = False
+        for v in values:
+            if db.session.get(SlotOccupancy, v["cell_start"]) is None:
+                db.session.add(SlotOccupancy(**v)); added = True
+        if added:
+            db.session.flush()
+        return
+    db.session.execute(stmt)
+
+
+def reserve(cell_start: datetime, capacity: int | None) -> bool:
+    """
+    條件式加一；capacity=None 表示不檢查容量（後台強制恢復訂單時用）。
+    回傳是否成功佔到名額。
+    """
+    _ensure_rows([cell_start])
+    return _increment(cell_start, capacity)
+
+
+def _increment(cell_start: datetime, capacity: int | None) -> bool:
+    stmt = (update(SlotOccupancy)
+            .where(SlotOccupancy.cell_start == cell_start)
+            .values(booked=SlotOccupancy.booked + 1))
+    if capacity is not None:
+        stmt = stmt.where(SlotOccupancy.booked < capacity)
+    return db.session.execute(stmt).rowcount == 1
+
+
+def release(cell_start: datetime):
+    db.session.execute(update(SlotOccupancy)
+                       .where(SlotOccupancy.cell_start == cell_start)
+                       .where(SlotOccupancy.booked > 0)
+                       .values(booked=SlotOccupancy.booked - 1))
+
+
+def reserve_cells(cells, force: bool = False) -> bool:
+    """
+    多格一起佔：依時間順序逐格條件式加一（固定順序，PG 上不會互相死結）；
+    任一格已滿就把前面加過的減回去，回傳 False。force=True 不檢查容量。
+    """
+    cells = sorted(cells)
+    _ensure_rows([c for c, _cap in cells])
+    done = []
+    for cell, cap in cells:
+        if not _increment(cell, None if force else cap):
+            for d in done:
+                release(d)
+            return False
+        done.append(cell)
+    return True
+
+
+def release_cells(cells):
+    for cell, _cap in cells:
+        release(cell)
+
+
+def _span_counts(spans) -> Counter:
+    counts = Counter()
+    for when, minutes in spans:
+        if when is None:
+            continue
+        for cell, _cap in cells_for(when, minutes, strict=False)[0] or []:
+            counts[cell] += 1
+    return counts
+
+
+def release_many(spans) -> int:
+    """
+    批次釋放：spans 為 (booked_at, 服務分鐘數)；依格子加總後一次 executemany 減回（不會減到負數）。
+    回傳影響的格子數。
+    """
+    counts = _span_counts(spans)
+    if counts:
+        occ = SlotOccupancy.__table__
+        n = bindparam("n")
+        db.session.execute(
+            update(occ)
+            .where(occ.c.cell_start == bindparam("c"))
+            .values(booked=case((occ.c.booked > n, occ.c.booked - n), else_=0)),
+            [{"c": c, "n": k} for c, k in counts.items()])
+    return len(counts)
+
+
+def force_reserve_many(spans) -> int:
+    """批次強制佔名額（後台恢復訂單，不檢查容量）；依格子加總後一次 executemany 加上去。"""
+    counts = _span_counts(spans)
+    if counts:
+        _ensure_rows(sorted(counts))
+        occ = SlotOccupancy.__table__
+        db.session.execute(
+            update(occ)
+            .where(occ.c.cell_start == bindparam("c"))
+            .values(booked=occ.c.booked + bindparam("n")),
+            [{"c": c, "n": k} for c, k in sorted(counts.items())])
+    return len(counts)
+
+
+def reserve_at(when: datetime, duration_min: int | None = None, force: bool = False):
+    """
+    依時間與服務時間找出所有格子並佔名額；回傳 (ok, reason)，
+    reason 為 CLOSED_DAY / CLOSED_TIME / OVERRUN / "full"。
+    force=True（後台強制恢復）不檢查容量，做到打烊後的部分不計。
+    """
+    cells, reason = cells_for(when, duration_min, strict=not force)
+    if cells is None:
+        return False, reason
+    if not reserve_cells(cells, force=force):
+        return False, "full"
+    return True, None
+
+
+def release_at(when: datetime | None, duration_min: int | None = None):
+    if when is None:
+        return
+    cells, _reason = cells_for(when, duration_min, strict=False)
+    if cells:
+        release_cells(cells)
+
+
+def move(old_when: datetime | None, new_when: datetime, duration_min: int | None = None):
+    """
+    有效訂單改期：只佔新時間多出來的格子、只放掉舊時間不再用的格子（重疊部分不動）。
+    回傳 (ok, reason)，同 reserve_at。
+    """
+    new_cells, reason = cells_for(new_when, duration_min)
+    if new_cells is None:
+        return False, reason
+    old_cells = []
+    if old_when is not None:
+        old_cells = cells_for(old_when, duration_min, strict=False)[0] or []
+    old_keys = {c for c, _cap in old_cells}
+    new_keys = {c for c, _cap in new_cells}
+    if not reserve_cells([x for x in new_cells if x[0] not in old_keys]):
+        return False, "full"
+    release_cells([x for x in old_cells if x[0] not in new_keys])
+    return True, None
+
+
+def rebuild(batch_size: int = 5000) -> int:
+    """依有效訂單重建整張表（串流讀 orders，不一次載入全部）；回傳格子數。"""
+    sched = current_schedule()
+    counts = {}
+    durations = (db.session.query(OrderItem.order_id.label("order_id"), _duration_expr().label("minutes"))
+                 .join(Service, Service.id == OrderItem.service_id)
+                 .group_by(OrderItem.order_id)
+                 .subquery())
+    q = (db.session.query(Order.booked_at, durations.c.minutes)
+         .outerjoin(durations, durations.c.order_id == Order.id)
+         .filter(Order.status.in_(ACTIVE_STATUSES))
+         .filter(Order.booked_at != None)
+         .execution_options(yield_per=batch_size))
+    for when, minutes in q:
+        cells = sched.cells_for_span(when, minutes, strict=False)[0] or []
+        for cell, _cap in cells:
+            counts[cell] = counts.get(cell, 0) + 1
+
+    db.session.execute(delete(SlotOccupancy))
+    items = [{"cell_start": c, "booked": n} for c, n in counts.items()]
+    for i in range(0, len(items), batch_size):
+        db.session.execute(SlotOccupancy.__table__.insert(), items[i:i + batch_size])
+    return len(items)
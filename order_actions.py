@@ -0,0 +1,164 @@
+# order_actions.py
+"""
+後台的批次狀態轉換（取消 / 確認 / 完工 / 整天完工）。
+
+transition(status, *where)：不逐筆 Order.query.get，改成最多兩條條件式 UPDATE
+    UPDATE orders SET status = :to WHERE <where> AND status IN ('pending','confirmed') AND status != :to RETURNING ...
+    UPDATE orders SET status = :to WHERE <where> AND (status NOT IN (...) AND status != :to OR status IS NULL) RETURNING ...
+依「原本是否佔名額」分兩條，RETURNING 的列就是真的有變動的訂單（已經是目標狀態的不算，
+同時有兩個管理員按同一批也只會算一次）。其他跟著的東西都是整批一次做：
+  - slot_occupancy：離開有效狀態的 release_many、恢復有效的 force_reserve_many（依格子加總一次 executemany）
+  - order_feed.notify（SSE）與 UPDATE 同一個 transaction；cache_versions.orders（日曆 ETag）commit 後 +1
+  - 與完工有關（改成完工，或從其他狀態改掉，原本可能是完工）：maintenance.refresh 受影響的車輛
+回傳 Transition；commit 之後可以 notify_customers(tr) 通知客人：
+同樣內容（狀態 + 預約時間）的客人合併成一次 multicast，在背景送，不卡後台的 request。
+  - X-Line-Retry-Key 由訊息內容 + 收件人算出（retry_key），同一批重送時 LINE 回 409、客人不會收到兩次
+  - outbound 重試完仍失敗的批次記在程序內（stats["failed"]、failed_recipients()），
+    下一次 notify_customers 用同一個 key 一起重送；後台動作會提示還有幾位沒送達
+"""
+import hashlib, json, threading, uuid
+from collections import defaultdict, namedtuple
+
+from sqlalchemy import select, update, and_, or_, inspect
+
+from models import db, Order, User
+from availability import ACTIVE_STATUSES, COMPLETED_STATUS
+import occupancy
+import versions
+import order_feed
+import maintenance
+import outbound
+import jobs
+
+Transition = namedtuple("Transition", "status rows")   # rows：[(order_id, booked_at, user_id)]
+
+stats = {"transitions": 0, "orders": 0, "notified": 0, "failed": 0, "resent": 0}
+
+_KEY_NS = uuid.uuid5(uuid.NAMESPACE_URL, "mcshop-bot/order_notify")
+_failed = []                 # [(messages, line_user_ids, retry_key)]：重試完仍失敗、等下次重送的批次
+_failed_lock = threading.Lock()
+
+_orders = Order.__table__
+_RETURNING = (_orders.c.id, _orders.c.booked_at, _orders.c.vehicle_id, _orders.c.user_id)
+
+
+def _update(where, status):
+    """條件式 UPDATE；回傳真的被改到的列。不支援 UPDATE ... RETURNING 的資料庫先鎖再改。"""
+    stmt = update(_orders).where(*where).values(status=status)
+    if db.session.get_bind().dialect.update_returning:
+        return db.session.execute(stmt.returning(*_RETURNING)).all()
+    rows = db.session.execute(select(*_RETURNING).where(*where).with_for_update()).all()
+    if rows:
+        db.session.execute(update(_orders).where(_orders.c.id.in_([r[0] for r in rows])).values(status=status))
+    return rows
+
+
+def transition(status: str, *where) -> Transition:
+    """把符合 where（Order 欄位的條件）且狀態不是 status 的訂單改成 status；不 commit。"""
+    db.session.flush()      # ORM 還沒送出的變動先寫入，UPDATE 才看得到
+    active = _orders.c.status.in_(ACTIVE_STATUSES)
+    left = _update((*where, active, _orders.c.status != status), status)
+    entered = _update((*where, or_(and_(~active, _orders.c.status != status), _orders.c.status == None)), status)
+    rows = left + entered
+    stats["transitions"] += 1
+    if not rows:
+        return Transition(status, [])
+
+    if status in ACTIVE_STATUSES:
+        moved, spans = entered, occupancy.force_reserve_many     # 後台恢復已取消的訂單：不擋容量
+    else:
+        moved, spans = left, occupancy.release_many
+    durations = occupancy.order_durations(r[0] for r in moved)
+    spans([(at, durations.get(oid)) for oid, at, _v, _u in moved])
+
+    ids = [r[0] for r in rows]
+    versions.bump_after_commit("orders")
+    order_feed.notify(ids)
+    refresh = rows if status == COMPLETED_STATUS else entered
+    maintenance.refresh(r[2] for r in refresh)
+
+    # 已經在 session 裡的 Order 物件狀態過期了，下次存取時重讀
+    changed = set(ids)
+    for obj in list(db.session.identity_map.values()):
+        if isinstance(obj, Order) and inspect(obj).identity[0] in changed:   # 讀 identity 不會觸發重載
+            db.session.expire(obj, ["status"])
+    stats["orders"] += len(rows)
+    return Transition(status, [(oid, at, uid) for oid, at, _v, uid in rows])
+
+
+# ---------- 通知客人 ----------
+def message_for(status: str, when) -> str | None:
+    if status == "confirmed":
+        text = f"✅ 您 {when:%m/%d %H:%M} 的預約已確認，期待您的光臨！"
+    elif status == "canceled":
+        text = f"⚠️ 您 {when:%m/%d %H:%M} 的預約已由店家取消。\n如需重新預約，請輸入「預約」。"
+    elif status == COMPLETED_STATUS:
+        text = f"🎉 {when:%m/%d} 的保養已完成，謝謝您的光臨！"
+    else:
+        return None
+    return json.dumps([{"type": "text", "text": text}], ensure_ascii=False)
+
+
+def retry_key(messages: str, line_user_ids) -> str:
+    """同樣內容送給同一批客人 → 同一個 X-Line-Retry-Key（LINE 在 24 小時內把重送視為同一則）。"""
+    digest = hashlib.sha256(",".join(sorted(line_user_ids)).encode()).hexdigest()
+    return str(uuid.uuid5(_KEY_NS, f"{messages}\n{digest}"))
+
+
+def _multicast(batches):
+    for messages, ids, key in batches:
+        try:
+            outbound.multicast(None, ids, messages, retry_key=key)
+            stats["notified"] += len(ids)
+        except Exception as e:
+            stats["failed"] += len(ids)
+            with _failed_lock:
+                _failed.append((messages, ids, key))
+            print(f"[order_actions] multicast to {len(ids)} failed: {e!r}, will resend with the same key")
+
+
+def failed_recipients() -> int:
+    """重試完仍沒送達、等下次重送的客人數。"""
+    with _failed_lock:
+        return sum(len(ids) for _m, ids, _k in _failed)
+
+
+def _take_failed() -> list:
+    with _failed_lock:
+        batches = list(_failed)
+        _failed.clear()
+    return batches
+
+
+def notify_customers(tr: Transition) -> int:
+    """
+    commit 之後呼叫：一次查出 LINE user id，同樣內容的合併成 multicast（每次最多 500 位），背景送出；
+    之前失敗的批次用原本的 key 一起重送。回傳這次新通知的人數（不含重送）。
+    """
+    resend = _take_failed()
+    stats["resent"] += sum(len(ids) for _m, ids, _k in resend)
+    user_ids = {uid for _oid, _at, uid in tr.rows if uid}
+    if not user_ids:
+        if resend:
+            jobs.submit("order_notify", _multicast, resend)
+        return 0
+    line_ids = dict(db.session.execute(
+        select(User.id, User.line_user_id).where(User.id.in_(user_ids))).all())
+    groups = defaultdict(dict)
+    for _oid, at, uid in tr.rows:
+        messages = message_for(tr.status, at) if at else None
+        if messages and line_ids.get(uid):
+            groups[messages][line_ids[uid]] = None      # 同一位客人同一則內容只送一次
+    batches = []
+    for messages, ids in groups.items():
+        ids = list(ids)
+        for i in range(0, len(ids), outbound.MULTICAST_MAX):
+            chunk = ids[i:i + outbound.MULTICAST_MAX]
+            batches.append((messages, chunk, retry_key(messages, chunk)))
+    if batches or resend:
+        jobs.submit("order_notify", _multicast, resend + batches)
+    return sum(len(ids) for _m, ids, _k in batches)
+
+
+def snapshot():
+    return dict(stats, pending_resend=failed_recipients())
@@ -0,0 +1,265 @@
+# order_feed.py
+"""
+後台日曆的訂單事件：/admin/api/events 的串流查詢，以及 SSE 即時更新的 pub/sub。
+
+變動來源：Order / OrderItem 經 ORM 新增、改狀態、改期、刪除時（after_flush 收集 id，
+與訂單同一個 transaction），所以 CONFIRM_SUBMIT、取消、改期、後台動作都不必各自通知。
+不經 ORM 的 bulk UPDATE 要自己呼叫 notify(order_ids)。
+
+發送：
+  - Postgres：before_commit 用 pg_notify 送到 ORDER_FEED_CHANNEL（交易 commit 時才送出、rollback 就不送）；
+    每個 worker 有一條 LISTEN 連線（第一個 SSE 連上時才開），收到後轉給本程序的訂閱者，
+    所以不管訂單在哪個 worker 改的，所有 worker 的日曆都會收到
+  - 其他資料庫：after_commit 直接發給本程序的訂閱者（單一程序部署）
+
+訊息：{"op": "upsert", "id": 12, "event": {...FullCalendar event...}}、{"op": "remove", "id": 12}、
+{"op": "resync"}（每條 SSE 連線一開始、LISTEN 重連後、訂閱者佇列滿時：前端重抓一次，ETag 沒變就是 304）。
+
+設定：
+  SSE_MAX_CLIENTS=20         每個 worker 同時的 SSE 連線上限（每條連線佔一個 thread）
+  SSE_KEEPALIVE_SEC=15
+  ORDER_FEED_CHANNEL=order_events
+"""
+import json, os, queue, threading, time
+from datetime import timedelta
+
+from sqlalchemy import event, func, inspect, text
+from sqlalchemy.orm import Session
+
+from models import db, Order, OrderItem, Service, Vehicle
+from availability import ACTIVE_STATUSES
+from catalog import DEFAULT_DURATION_MIN
+
+MAX_CLIENTS = int(os.getenv("SSE_MAX_CLIENTS", "20"))
+KEEPALIVE_SEC = float(os.getenv("SSE_KEEPALIVE_SEC", "15"))
+CHANNEL = os.getenv("ORDER_FEED_CHANNEL", "order_events")
+QUEUE_SIZE = 200
+
+stats = {"published": 0, "notified": 0, "dropped": 0, "listen_reconnects": 0}
+
+
+# ---------- 事件內容 ----------
+def _durations(session, *where):
+    return (session.query(OrderItem.order_id.label("order_id"),
+                             func.sum(func.coalesce(Service.duration_min, DEFAULT_DURATION_MIN)).label("minutes"))
+            .join(Service, Service.id == OrderItem.service_id)
+            .join(Order, Order.id == OrderItem.order_id)
+            .filter(*where)
+            .group_by(OrderItem.order_id)
+            .subquery())
+
+
+def _projection(session, *where):
+    """只取日曆需要的欄位：車牌 join、服務時間先在同樣條件下加總。"""
+    durations = _durations(session, *where)
+    return (session.query(Order.id, Order.status, Order.booked_at, Vehicle.plate, durations.c.minutes)
+            .outerjoin(Vehicle, Vehicle.id == Order.vehicle_id)
+            .outerjoin(durations, durations.c.order_id == Order.id)
+            .filter(Order.booked_at != None)
+            .filter(*where))
+
+
+def event_dict(oid, status, booked_at, plate, minutes) -> dict:
+    title = f"#{oid} {plate} {status}" if plate else f"#{oid} {status}"
+    return {
+        "id": oid,
+        "title": title,
+        "start": booked_at.isoformat(),
+        "end": (booked_at + timedelta(minutes=minutes or DEFAULT_DURATION_MIN)).isoformat(),
+        "color": "#2E86C1" if status in ACTIVE_STATUSES else "#999999",
+        "url": f"/admin/order/edit/?id={oid}"
+    }
+
+
+def iter_json(start, end, batch_size: int = 500):
+    """區間內的事件，yield_per 分批讀、逐筆輸出 JSON 陣列的片段。"""
+    q = (_projection(db.session, Order.booked_at >= start, Order.booked_at <= end)
+         .order_by(Order.booked_at.asc())
+         .execution_options(yield_per=batch_size))
+    yield "["
+    sep = ""
+    for row in q:
+        yield sep + json.dumps(event_dict(*row), ensure_ascii=False)
+        sep = ","
+    yield "]"
+
+
+def messages_for(order_ids, removed=(), session=None) -> list:
+    """
+    指定訂單目前的樣子：還在（且有時間）的 upsert，其餘 remove。
+    session：正在 commit 的那個 session（同一條連線才看得到還沒 commit 的變動），預設 db.session。
+    """
+    session = session or db.session
+    ids = sorted(set(order_ids) - set(removed))
+    found = {}
+    if ids:
+        for row in _projection(session, Order.id.in_(ids)):
+            found[row[0]] = event_dict(*row)
+    out = [{"op": "upsert", "id": oid, "event": found[oid]} for oid in ids if oid in found]
+    out += [{"op": "remove", "id": oid} for oid in sorted(set(order_ids) | set(removed)) if oid not in found]
+    return out
+
+
+# ---------- 程序內 pub/sub ----------
+class Broker:
+    def __init__(self):
+        self._subs = set()
+        self._lock = threading.Lock()
+
+    def subscribe(self):
+        with self._lock:
+            if len(self._subs) >= MAX_CLIENTS:
+                return None
+            q = queue.Queue(maxsize=QUEUE_SIZE)
+            self._subs.add(q)
+        q.put_nowait({"op": "resync"})
+        return q
+
+    def unsubscribe(self, q):
+        with self._lock:
+            self._subs.discard(q)
+
+    def publish(self, msg):
+        with self._lock:
+            subs = list(self._subs)
+        for q in subs:
+            try:
+                q.put_nowait(msg)
+            except queue.Full:
+                # 前端太慢：丟掉累積的訊息，改叫它整個重抓
+                stats["dropped"] += 1
+                with q.mutex:
+                    q.queue.clear()
+                q.put_nowait({"op": "resync"})
+        stats["published"] += 1
+
+    def __len__(self):
+        return len(self._subs)
+
+
+broker = Broker()
+
+
+# ---------- Postgres LISTEN ----------
+_listener = None
+_listener_lock = threading.Lock()
+
+
+def _listen(dsn: str):
+    import psycopg
+    while True:
+        try:
+            with psycopg.connect(dsn, autocommit=True) as conn:
+                conn.execute(f'LISTEN "{CHANNEL}"')
+                broker.publish({"op": "resync"})     # 重連期間可能漏掉的變動
+                for n in conn.notifies():
+                    broker.publish(json.loads(n.payload))
+        except Exception as e:
+            stats["listen_reconnects"] += 1
+            print(f"[order_feed] LISTEN failed: {e!r}, retry in 3s")
+            time.sleep(3)
+
+
+def _ensure_listener():
+    global _listener
+    if _listener is not None or db.engine.dialect.name != "postgresql":
+        return
+    with _listener_lock:
+        if _listener is None:
+            dsn = db.engine.url.set(drivername="postgresql").render_as_string(hide_password=False)
+            _listener = threading.Thread(target=_listen, args=(dsn,), name="order-feed-listen", daemon=True)
+            _listener.start()
+
+
+def subscribe():
+    """SSE 連線用；超過 SSE_MAX_CLIENTS 回 None。"""
+    _ensure_listener()
+    return broker.subscribe()
+
+
+def unsubscribe(q):
+    broker.unsubscribe(q)
+
+
+def sse_stream(q):
+    """SSE 內容；不碰 DB，不需要 request / app context。"""
+    try:
+        yield "retry: 3000\n\n"
+        while True:
+            try:
+                msg = q.get(timeout=KEEPALIVE_SEC)
+            except queue.Empty:
+                yield ": ping\n\n"
+                continue
+            yield f"event: order\ndata: {json.dumps(msg, ensure_ascii=False)}\n\n"
+    finally:
+        unsubscribe(q)
+
+
+# ---------- 收集變動 ----------
+def _send(session, msgs):
+    if not msgs:
+        return
+    if session.get_bind().dialect.name == "postgresql":
+        payloads = [json.dumps(m, ensure_ascii=False) for m in msgs]
+        session.execute(text("SELECT pg_notify(:ch, p) FROM unnest(CAST(:payloads AS text[])) AS p"),
+                        {"ch": CHANNEL, "payloads": payloads})
+        stats["notified"] += len(payloads)
+    else:
+        session.info.setdefault("order_feed_out", []).extend(msgs)
+
+
+def notify(order_ids, removed=()):
+    """不經 ORM 的變動（bulk UPDATE）用：在目前的 transaction 內排好通知，commit 後送出。"""
+    _send(db.session, messages_for(order_ids, removed))
+
+
+@event.listens_for(Session, "after_flush")
+def _collect(session, flush_context):
+    changed = session.info.setdefault("order_feed_ids", set())
+    removed = session.info.setdefault("order_feed_removed", set())
+    for obj in session.new:
+        if isinstance(obj, Order):
+            changed.add(obj.id)
+        elif isinstance(obj, OrderItem):
+            changed.add(obj.order_id)
+    for obj in session.dirty:
+        if isinstance(obj, Order):
+            attrs = inspect(obj).attrs
+            if any(attrs[a].history.has_changes() for a in ("status", "booked_at", "vehicle_id")):
+                changed.add(obj.id)
+        elif isinstance(obj, OrderItem) and session.is_modified(obj):
+            changed.add(obj.order_id)
+    for obj in session.deleted:
+        if isinstance(obj, Order):
+            removed.add(obj.id)
+        elif isinstance(obj, OrderItem):
+            changed.add(obj.order_id)
+    changed.discard(None)
+
+
+@event.listens_for(Session, "before_commit")
+def _before_commit(session):
+    if session.new or session.dirty or session.deleted:
+        session.flush()      # before_commit 在 commit 自己的 flush 之前，先 flush 才收得到這批變動
+    changed = session.info.pop("order_feed_ids", None)
+    removed = session.info.pop("order_feed_removed", None)
+    if not changed and not removed:
+        return
+    _send(session, messages_for(changed or (), removed or (), session))
+
+
+@event.listens_for(Session, "after_commit")
+def _after_commit(session):
+    for msg in session.info.pop("order_feed_out", ()):
+        broker.publish(msg)
+
+
+@event.listens_for(Session, "after_rollback")
+def _after_rollback(session):
+    for key in ("order_feed_ids", "order_feed_removed", "order_feed_out"):
+        session.info.pop(key, None)
+
+
+def snapshot():
+    return dict(stats, clients=len(broker), listening=_listener is not None)
@@ -0,0 +1,284 @@
+# outbound.py
+"""
+送出訊息的管線：重試、退避、斷路器、reply token 過期改 push。
+
+所有回覆（flex_helper.reply_text / reply_flex）最後都走 deliver()：
+  - 429、5xx、逾時 / 連線錯誤視為暫時性失敗，以 full jitter 指數退避重試
+    （第 n 次等 0 ~ min(OUTBOUND_BACKOFF_MAX, OUTBOUND_BACKOFF_BASE * 2^n) 秒）
+  - 其他 4xx（內容不合法、token 已用過…）不重試，直接丟出
+  - reply token 只在事件發生後一段時間內有效（REPLY_TOKEN_TTL，從 event.timestamp 起算）；
+    下一次重試會超過期限時改用 push 送給同一位使用者，push 帶 X-Line-Retry-Key，
+    重試時 LINE 回 409 代表前一次其實已送達，視為成功
+  - 斷路器：連續 OUTBOUND_BREAKER_FAILURES 次暫時性失敗就打開，OUTBOUND_BREAKER_COOLDOWN 秒內
+    直接丟 CircuitOpen、不連線（worker 不會卡在逾時）；冷卻後放一個請求試探，成功就關閉
+
+事件的 reply token / 使用者 / 期限由 bind(event) 放在 thread-local（on_text / on_postback 開頭呼叫）。
+在 unit of work（webhook 事件）內呼叫 deliver() 時只排入 uow.defer，commit 之後才送：
+重試、退避與每次最長 LINE_API_TIMEOUT 的等待都不會發生在 DB transaction 裡（不佔 row lock）。
+push() / multicast() 給排程用：同樣的重試與斷路器，固定帶 X-Line-Retry-Key；TokenBucket 控制送出速率。
+
+設定：
+  OUTBOUND_MAX_ATTEMPTS=3         每則訊息最多嘗試次數（含 push）
+  OUTBOUND_BACKOFF_BASE=0.2       退避基準秒數
+  OUTBOUND_BACKOFF_MAX=2          單次退避上限秒數
+  REPLY_TOKEN_TTL=50              reply token 視為有效的秒數（LINE 約 1 分鐘，留一點餘裕）
+  OUTBOUND_BREAKER_FAILURES=5
+  OUTBOUND_BREAKER_COOLDOWN=30
+"""
+import json, os, random, threading, time, uuid
+
+import urllib3
+from linebot.v3.messaging import ApiException
+from linebot.v3.messaging.rest import RESTResponse
+
+import line_client
+import uow
+
+MAX_ATTEMPTS = int(os.getenv("OUTBOUND_MAX_ATTEMPTS", "3"))
+BACKOFF_BASE = float(os.getenv("OUTBOUND_BACKOFF_BASE", "0.2"))
+BACKOFF_MAX = float(os.getenv("OUTBOUND_BACKOFF_MAX", "2"))
+REPLY_TOKEN_TTL = float(os.getenv("REPLY_TOKEN_TTL", "50"))
+BREAKER_FAILURES = int(os.getenv("OUTBOUND_BREAKER_FAILURES", "5"))
+BREAKER_COOLDOWN = float(os.getenv("OUTBOUND_BREAKER_COOLDOWN", "30"))
+
+REPLY_PATH = "/v2/bot/message/reply"
+PUSH_PATH = "/v2/bot/message/push"
+MULTICAST_PATH = "/v2/bot/message/multicast"
+MULTICAST_MAX = 500
+
+_local = threading.local()
+stats = {"sent": 0, "attempts": 0, "retries": 0, "failures": 0, "push_fallback": 0, "shed": 0}
+
+
+class CircuitOpen(Exception):
+    """LINE API 斷路器打開中，沒有送出。"""
+
+
+class CircuitBreaker:
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, failures: int, cooldown: float):
+        self.threshold = failures
+        self.cooldown = cooldown
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.opened = 0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.cooldown:
+                self.state = self.HALF_OPEN
+            if self.state == self.HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self._probing = False
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            self._probing = False
+            if self.state == self.HALF_OPEN or self.failures >= self.threshold:
+                if self.state != self.OPEN:
+                    self.opened += 1
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+    def snapshot(self):
+        return {"state": self.state, "failures": self.failures, "opened": self.opened}
+
+
+breaker = CircuitBreaker(BREAKER_FAILURES, BREAKER_COOLDOWN)
+
+
+def bind(event):
+    """記下目前事件的 reply token、使用者與 token 期限。"""
+    ts = getattr(event, "timestamp", None)
+    _local.reply_token = getattr(event, "reply_token", None)
+    _local.user_id = getattr(getattr(event, "source", None), "user_id", None)
+    _local.deadline = (ts / 1000 if ts else time.time()) + REPLY_TOKEN_TTL
+
+
+def _context(reply_token):
+    if reply_token and reply_token == getattr(_local, "reply_token", None):
+        return _local.user_id, _local.deadline
+    return None, time.time() + REPLY_TOKEN_TTL
+
+
+def _transient(e) -> bool:
+    if isinstance(e, ApiException):
+        return e.status == 429 or (e.status or 0) >= 500
+    return isinstance(e, urllib3.exceptions.HTTPError)
+
+
+def _post(api_client, path: str, body: str, headers=None):
+    """用 ApiClient 的連線池與預設 header 直接送已序列化的 JSON。"""
+    api_client = api_client or line_client.get_client()
+    h = dict(api_client.default_headers)
+    h["Content-Type"] = "application/json; charset=UTF-8"
+    if headers:
+        h.update(headers)
+    resp = api_client.rest_client.pool_manager.request(
+        "POST", api_client.configuration.host + path, body=body.encode("utf-8"), headers=h)
+    if not 200 <= resp.status <= 299:
+        raise ApiException(http_resp=RESTResponse(resp))
+    return resp
+
+
+def _backoff(attempt: int) -> float:
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * (2 ** attempt)))
+
+
+def _attempt(api_client, path, body, headers=None):
+    if not breaker.allow():
+        stats["shed"] += 1
+        raise CircuitOpen("LINE API circuit open")
+    stats["attempts"] += 1
+    try:
+        resp = _post(api_client, path, body, headers)
+    except Exception as e:
+        if _transient(e):
+            breaker.failure()
+        else:
+            breaker.success()   # 4xx 代表 API 有回應，不算 API 異常
+        raise
+    breaker.success()
+    return resp
+
+
+def deliver(api_client, reply_token: str, messages_json: str):
+    """
+    送出回覆；messages_json 為已序列化的訊息陣列（"[{...}, ...]"）。
+    unit of work 內呼叫時排到 commit 之後才送（回傳 None，送出失敗只記錄）。
+    token 有效時重試 reply，過期後改 push（需要 bind 過、知道使用者）；全部失敗時丟出最後的例外。
+    """
+    if uow.defer(_deliver, api_client, reply_token, messages_json, _context(reply_token)):
+        return
+    _deliver(api_client, reply_token, messages_json, _context(reply_token))
+
+
+def _deliver(api_client, reply_token: str, messages_json: str, context):
+    user_id, deadline = context
+    reply_body = '{"replyToken":%s,"messages":%s,"notificationDisabled":false}' % (
+        json.dumps(reply_token), messages_json)
+    push_body = push_headers = None
+    last = None
+    for attempt in range(MAX_ATTEMPTS):
+        if attempt:
+            wait = _backoff(attempt)
+            stats["retries"] += 1
+            if push_body is None and time.time() + wait >= deadline:
+                if not user_id:
+                    break
+                push_body = '{"to":%s,"messages":%s,"notificationDisabled":false}' % (
+                    json.dumps(user_id), messages_json)
+                push_headers = {"X-Line-Retry-Key": str(uuid.uuid4())}
+                stats["push_fallback"] += 1
+                print(f"[outbound] reply token expired, push to {user_id}")
+            time.sleep(wait)
+        try:
+            if push_body is None:
+                _attempt(api_client, REPLY_PATH, reply_body)
+            else:
+                try:
+                    _attempt(api_client, PUSH_PATH, push_body, push_headers)
+                except ApiException as e:
+                    if e.status != 409:   # 同一個 retry key 已被接受過
+                        raise
+            stats["sent"] += 1
+            return
+        except CircuitOpen:
+            raise
+        except Exception as e:
+            last = e
+            if not _transient(e):
+                break
+            print(f"[outbound] attempt {attempt + 1} failed: {e.__class__.__name__} {getattr(e, 'status', '')}")
+    stats["failures"] += 1
+    raise last
+
+
+def _send_keyed(api_client, path: str, body: str, retry_key: str | None):
+    """push / multicast：暫時性失敗依同樣的退避重試，每次都帶同一個 X-Line-Retry-Key（409 = 已送達）。"""
+    headers = {"X-Line-Retry-Key": retry_key or str(uuid.uuid4())}
+    last = None
+    for attempt in range(MAX_ATTEMPTS):
+        if attempt:
+            stats["retries"] += 1
+            time.sleep(_backoff(attempt))
+        try:
+            try:
+                _attempt(api_client, path, body, headers)
+            except ApiException as e:
+                if e.status != 409:
+                    raise
+            stats["sent"] += 1
+            return
+        except CircuitOpen:
+            raise
+        except Exception as e:
+            last = e
+            if not _transient(e):
+                break
+    stats["failures"] += 1
+    raise last
+
+
+def push(api_client, user_id: str, messages_json: str, retry_key: str | None = None):
+    body = '{"to":%s,"messages":%s,"notificationDisabled":false}' % (json.dumps(user_id), messages_json)
+    _send_keyed(api_client, PUSH_PATH, body, retry_key)
+
+
+def multicast(api_client, user_ids, messages_json: str, retry_key: str | None = None):
+    """一次送給最多 MULTICAST_MAX 位使用者；retry_key 固定時，程序重跑重送同一批也不會重複收到。"""
+    ids = list(user_ids)
+    if len(ids) > MULTICAST_MAX:
+        raise ValueError(f"multicast 最多 {MULTICAST_MAX} 位，收到 {len(ids)}")
+    body = '{"to":%s,"messages":%s,"notificationDisabled":false}' % (json.dumps(ids), messages_json)
+    _send_keyed(api_client, MULTICAST_PATH, body, retry_key)
+
+
+def remaining_quota():
+    """本月還能送幾則；沒有上限時回 None。"""
+    api = line_client.messaging_api()
+    quota = api.get_message_quota()
+    if quota.type != "limited":
+        return None
+    return quota.value - api.get_message_quota_consumption().total_usage
+
+
+class TokenBucket:
+    """每秒補 rate 個 token、最多存 burst 個；take() 不夠時睡到夠為止（多執行緒共用）。"""
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self, n: int = 1):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= n:
+                    self.tokens -= n
+                    return
+                wait = (n - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def snapshot():
+    return dict(stats, breaker=breaker.snapshot())
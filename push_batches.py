@@ -0,0 +1,79 @@
+# push_batches.py
+"""
+排程推播（預約提醒 reminders.py、保養提醒 maintenance.py）共用的「送一批 / 重送」。
+
+每一批的流程：
+  1. 呼叫端把這批的列寫入（或標上）batch_key = X-Line-Retry-Key 並 commit（claim，各模組自己做）
+  2. send()：有月額度限制時先確認剩餘量夠送這批 → TokenBucket 控速 → 帶 batch_key multicast
+     → 把這批還沒標記的列補上送出時間並 commit
+  3. 中斷（程序掛掉、LINE 失敗、額度不夠）的批次留著 batch_key、送出時間為空；
+     下一輪 resume() 用原本的 batch_key 重送，LINE 已收過的回 409，客人不會收到兩次
+
+quota 是一輪內共用的 dict：第一次真的要送時才查剩餘量，之後每批扣掉人數。
+"""
+from datetime import datetime
+
+from sqlalchemy import update
+
+from models import db
+import outbound
+
+
+class PushBatches:
+    """
+    table：記錄批次的資料表，需有 batch_key 欄位；sent_column：送出時間的欄位名稱。
+    message_for(subject)：一批的訊息內容（JSON 字串）；stats：呼叫端模組的 stats
+    （batches / recipients / resumed / quota_stop）。
+    """
+
+    def __init__(self, name: str, table, sent_column: str, message_for, bucket, stats: dict):
+        self.name = name
+        self.table = table
+        self.sent = table.c[sent_column]
+        self.message_for = message_for
+        self.bucket = bucket
+        self.stats = stats
+
+    def _quota_ok(self, quota: dict, n: int) -> bool:
+        if "left" not in quota:
+            quota["left"] = outbound.remaining_quota()   # 第一次真的要送時才查
+        if quota["left"] is None:
+            return True
+        if quota["left"] < n:
+            self.stats["quota_stop"] += 1
+            print(f"[{self.name}] monthly quota left {quota['left']} < {n}, stop")
+            return False
+        quota["left"] -= n
+        return True
+
+    def send(self, quota: dict, batch_key: str, subject, user_ids) -> bool:
+        """送一批並標記送出時間；額度不夠時回 False（這批保留 batch_key，下次重送）。"""
+        ids = list(dict.fromkeys(user_ids))
+        if not self._quota_ok(quota, len(ids)):
+            return False
+        self.bucket.take()
+        outbound.multicast(None, ids, self.message_for(subject), retry_key=batch_key)
+        self.mark_sent(batch_key)
+        db.session.commit()
+        self.stats["batches"] += 1
+        self.stats["recipients"] += len(ids)
+        return True
+
+    def mark_sent(self, batch_key: str, *where):
+        """把這批（where 可再縮小範圍）還沒標記的列補上送出時間；不 commit。"""
+        t = self.table
+        db.session.execute(update(t).where(t.c.batch_key == batch_key, self.sent == None, *where)
+                           .values({self.sent: datetime.utcnow()}))
+
+    def resume(self, quota: dict, pending) -> bool:
+        """
+        pending：[(batch_key, subject, line_user_ids)]，每個還沒送完的批次一筆（可以是 generator，
+        逐批查收件人）；subject 為 None 或沒有收件人的略過。額度不夠時回 False。
+        """
+        for key, subject, user_ids in pending:
+            if subject is None or not user_ids:
+                continue
+            self.stats["resumed"] += 1
+            if not self.send(quota, key, subject, user_ids):
+                return False
+        return True
@@ -0,0 +1,169 @@
+# reminders.py
+"""
+預約前一天的提醒（排程 jobs.py 從每天 REMINDER_HOUR 點起每 15 分鐘跑一次，直到當天結束）。
+
+  - 明天的有效訂單（pending / confirmed）用 orders.booked_at 索引做範圍查詢，
+    以 (booked_at, id) keyset 分批讀（每批 REMINDER_SCAN_BATCH 筆），不一次載入全部
+  - 已經提醒過的（reminder_sent 有同一筆 order + booked_at）直接在查詢裡排除
+  - 提醒內容只跟預約時間有關，同一時間的客人內容相同：依 booked_at 分組，
+    每組每 500 位用一次 multicast（同一組內同一位使用者只送一次）
+  - 送出前先寫 reminder_sent（sent_at 為空、batch_key = 這批的 X-Line-Retry-Key）並 commit，
+    送完補 sent_at；寫入用 ON CONFLICT DO NOTHING RETURNING，多個程序同時跑只有一方拿到
+  - 程序中途掛掉 / LINE 失敗：下一輪先把 sent_at 為空的批次用原本的 batch_key 重送，
+    LINE 已收過的回 409（視為成功），客人不會收到兩次；
+    這批裡不送的訂單（同一時間已提醒過）寫入時就標 sent_at，重送只會送原本的收件人
+  - 每一輪只會撈到還沒提醒過的訂單，所以重跑很便宜，傍晚之後才訂明天的也會補送
+  - 送出速率由 TokenBucket 控制；有月額度限制時先查剩餘量，不夠送下一批就停，下次再續
+    （送出 / 重送與額度檢查跟保養提醒共用 push_batches.py）
+
+設定：
+  REMINDER_ENABLED=1
+  REMINDER_HOUR=18            每天幾點開始送（程序所在時區）
+  REMINDER_RATE=10            每秒最多幾次 multicast（LINE 上限 200/s）
+  REMINDER_SCAN_BATCH=2000
+"""
+import json, os, uuid
+from datetime import datetime, date, timedelta
+
+from sqlalchemy import select, and_, tuple_, exists
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from models import db, Order, User, ReminderSent
+from availability import ACTIVE_STATUSES
+import outbound
+from push_batches import PushBatches
+
+REMINDER_HOUR = int(os.getenv("REMINDER_HOUR", "18"))
+RATE = float(os.getenv("REMINDER_RATE", "10"))
+SCAN_BATCH = int(os.getenv("REMINDER_SCAN_BATCH", "2000"))
+CHUNK = outbound.MULTICAST_MAX
+
+WEEKDAYS = "一二三四五六日"
+
+bucket = outbound.TokenBucket(RATE, burst=max(1, int(RATE)))
+stats = {"runs": 0, "batches": 0, "recipients": 0, "resumed": 0, "quota_stop": 0}
+
+_sent = ReminderSent.__table__
+
+
+def message_for(when: datetime) -> str:
+    """同一個預約時間的提醒內容都一樣（可以合併成同一次 multicast）。"""
+    text = (f"⏰ 預約提醒\n明天 {when:%m/%d}（{WEEKDAYS[when.weekday()]}）{when:%H:%M} 有保養預約，請準時到店。\n"
+            f"需要改期或取消，請輸入「我的預約」。")
+    return json.dumps([{"type": "text", "text": text}], ensure_ascii=False)
+
+
+pushes = PushBatches("reminders", _sent, "sent_at", message_for, bucket, stats)
+
+
+def _claim(batch_key: str, rows) -> set:
+    """寫入 reminder_sent；回傳這次真的搶到的 order_id（別的程序已寫入的不算）。"""
+    values = [{"order_id": oid, "booked_at": when, "batch_key": batch_key} for oid, when in rows]
+    dialect = db.session.get_bind().dialect.name
+    if dialect == "postgresql":
+        stmt = pg_insert(_sent).values(values).on_conflict_do_nothing()
+    elif dialect == "sqlite":
+        stmt = sqlite_insert(_sent).values(values).on_conflict_do_nothing()
+    else:
+        got = set()
+        for v in values:
+            if db.session.get(ReminderSent, (v["order_id"], v["booked_at"])) is None:
+                db.session.add(ReminderSent(**v)); got.add(v["order_id"])
+        db.session.flush()
+        return got
+    return {r[0] for r in db.session.execute(stmt.returning(_sent.c.order_id))}
+
+
+def _pending(day_start, day_end):
+    """上次中斷、還沒標記 sent_at 的批次：(batch_key, booked_at, 原本的收件人)。"""
+    keys = db.session.execute(
+        select(_sent.c.batch_key).where(_sent.c.sent_at == None)
+        .where(_sent.c.booked_at >= day_start, _sent.c.booked_at < day_end)
+        .distinct()).scalars().all()
+    for key in keys:
+        rows = db.session.execute(
+            select(_sent.c.booked_at, User.line_user_id)
+            .join(Order, Order.id == _sent.c.order_id)
+            .join(User, User.id == Order.user_id)
+            .where(_sent.c.batch_key == key, _sent.c.sent_at == None)).all()
+        if rows:
+            yield key, rows[0][0], [r[1] for r in rows]
+
+
+def _scan(day_start, day_end):
+    """
+    依 (booked_at, id) keyset 分批讀明天還沒提醒過的有效訂單：yield (order_id, booked_at, line_user_id, reminded)；
+    reminded = 同一位使用者同一個時間的其他訂單已經提醒過（例如之前的執行）。
+    """
+    other = Order.__table__.alias("other")
+    prev = _sent.alias("prev")
+    reminded = exists().where(prev.c.order_id == other.c.id,
+                              other.c.user_id == Order.user_id,
+                              prev.c.booked_at == Order.booked_at)
+    after = None
+    while True:
+        q = (select(Order.id, Order.booked_at, User.line_user_id, reminded)
+             .join(User, User.id == Order.user_id)
+             .outerjoin(_sent, and_(_sent.c.order_id == Order.id, _sent.c.booked_at == Order.booked_at))
+             .where(Order.booked_at >= day_start, Order.booked_at < day_end)
+             .where(Order.status.in_(ACTIVE_STATUSES))
+             .where(_sent.c.order_id == None)
+             .order_by(Order.booked_at, Order.id)
+             .limit(SCAN_BATCH))
+        if after is not None:
+            q = q.where(tuple_(Order.booked_at, Order.id) > after)
+        rows = db.session.execute(q).all()
+        if not rows:
+            return
+        yield from rows
+        after = (rows[-1][1], rows[-1][0])
+
+
+def _flush(quota: dict, when, group) -> bool:
+    """group：[(order_id, line_user_id | None)]，同一個 booked_at、最多 CHUNK 位使用者。"""
+    key = str(uuid.uuid4())
+    claimed = _claim(key, [(oid, when) for oid, _uid in group])
+    # 不送的（已提醒過 / 同一時間前面批次已送）跟 claim 同一個 commit 標 sent_at，中斷後重送不會送到他們
+    skipped = [oid for oid, uid in group if oid in claimed and not uid]
+    if skipped:
+        pushes.mark_sent(key, _sent.c.order_id.in_(skipped))
+    db.session.commit()
+    ids = [uid for oid, uid in group if oid in claimed and uid]
+    if not ids:
+        return True
+    return pushes.send(quota, key, when, ids)
+
+
+def run(today: date | None = None) -> int:
+    """送明天的提醒；回傳這次送出的人數。"""
+    today = today or date.today()
+    day_start = datetime.combine(today + timedelta(days=1), datetime.min.time())
+    day_end = day_start + timedelta(days=1)
+    stats["runs"] += 1
+    before = stats["recipients"]
+    quota = {}
+    if not pushes.resume(quota, _pending(day_start, day_end)):
+        return stats["recipients"] - before
+
+    when, group, users, seen = None, [], set(), set()
+    for oid, booked_at, uid, reminded in _scan(day_start, day_end):
+        new_time = booked_at != when
+        if new_time or (uid not in users and uid not in seen and len(users) >= CHUNK):
+            if group and not _flush(quota, when, group):
+                return stats["recipients"] - before
+            # seen：同一個時間已經排進前面批次的使用者；換時間就重新算（不同時間的提醒內容不同，都要送）
+            seen = set() if new_time else seen | users
+            when, group, users = booked_at, [], set()
+        if reminded or uid in seen:
+            uid = None        # 同一時間有兩筆訂單：一起標記已提醒，但只送一次
+        else:
+            users.add(uid)
+        group.append((oid, uid))
+    if group:
+        _flush(quota, when, group)
+    return stats["recipients"] - before
+
+
+def snapshot():
+    return dict(stats, hour=REMINDER_HOUR, rate=RATE)
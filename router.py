@@ -0,0 +1,170 @@
+# router.py
+"""
+on_text / on_postback 的指令路由表（import 時建好，之後只查表）。
+
+比對順序：
+  1. exact   完整字串 → dict 查找（CONFIRM_SUBMIT、SVC_PREV、「我的預約」…）
+  2. prefix  帶參數的 postback：取到第一個 ':' 或 '#'（含）當 key 查 dict，
+             剩下的部分再用預先編譯好的 regex 驗證（VEHICLE_PICK:3、CANCEL#12…）
+  3. pattern 少數文字指令（「取消預約 #12」）用預先編譯的 regex，依註冊順序比對
+  4. state   以 conv.state 為 key 的 fallback（ask_name、edit_phone…）
+  5. default
+
+每條 route 記錄命中次數與處理時間的直方圖（ms），/healthz 可看到哪些流程最熱。
+"""
+import re, threading, time
+
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+
+
+class RouteContext:
+    """傳給 route 的參數：原始事件、LINE api client、使用者、對話、指令字串、postback params、regex match。"""
+    __slots__ = ("event", "api", "user", "conv", "key", "params", "m")
+
+    def __init__(self, event, api, user, conv, key, params=None):
+        self.event = event
+        self.api = api
+        self.user = user
+        self.conv = conv
+        self.key = key
+        self.params = params or {}
+        self.m = None
+
+    @property
+    def reply_token(self):
+        return self.event.reply_token
+
+
+class RouteStats:
+    def __init__(self):
+        self.hits = 0
+        self.errors = 0
+        self.total_ms = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+
+    def observe(self, ms: float, failed: bool):
+        self.hits += 1
+        self.total_ms += ms
+        if failed:
+            self.errors += 1
+        for i, upper in enumerate(LATENCY_BUCKETS_MS):
+            if ms <= upper:
+                self.buckets[i] += 1
+                return
+        self.buckets[-1] += 1
+
+    def as_dict(self):
+        labels = [f"le_{b}" for b in LATENCY_BUCKETS_MS] + ["inf"]
+        return {"hits": self.hits, "errors": self.errors,
+                "avg_ms": round(self.total_ms / self.hits, 3) if self.hits else 0,
+                "histogram_ms": dict(zip(labels, self.buckets))}
+
+
+def _prefix_key(key: str):
+    for i, ch in enumerate(key):
+        if ch in ":#":
+            return key[:i + 1], key[i + 1:]
+    return None, None
+
+
+class Router:
+    def __init__(self, name: str):
+        self.name = name
+        self._exact = {}
+        self._prefix = {}       # "CANCEL#" → (compiled remainder regex, route name, func)
+        self._patterns = []     # [(compiled regex, route name, func)]
+        self._states = {}
+        self._default = None
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    # ---- 註冊 ----
+    def exact(self, *keys):
+        def deco(func):
+            for k in keys:
+                self._exact[k] = (k, func)
+            return func
+        return deco
+
+    def prefix(self, prefix: str, pattern: str = r".+"):
+        if prefix[-1] not in ":#":
+            raise ValueError(f"prefix 必須以 ':' 或 '#' 結尾：{prefix!r}")
+        rx = re.compile(pattern)
+
+        def deco(func):
+            self._prefix[prefix] = (rx, prefix, func)
+            return func
+        return deco
+
+    def pattern(self, regex: str):
+        rx = re.compile(regex)
+
+        def deco(func):
+            self._patterns.append((rx, regex, func))
+            return func
+        return deco
+
+    def state(self, *states):
+        def deco(func):
+            for s in states:
+                self._states[s] = (f"state:{s}", func)
+            return func
+        return deco
+
+    def default(self, func):
+        self._default = ("default", func)
+        return func
+
+    # ---- 查表 ----
+    def resolve(self, key: str, state: str | None = None):
+        """回傳 (route 名稱, func, match)；找不到回 (None, None, None)。"""
+        hit = self._exact.get(key)
+        if hit:
+            return hit[0], hit[1], None
+
+        head, rest = _prefix_key(key)
+        if head is not None:
+            hit = self._prefix.get(head)
+            if hit:
+                m = hit[0].fullmatch(rest)
+                if m:
+                    return hit[1], hit[2], m
+
+        for rx, name, func in self._patterns:
+            m = rx.match(key)
+            if m:
+                return name, func, m
+
+        if state is not None:
+            hit = self._states.get(state)
+            if hit:
+                return hit[0], hit[1], None
+
+        if self._default:
+            return self._default[0], self._default[1], None
+        return None, None, None
+
+    def dispatch(self, ctx: RouteContext):
+        name, func, m = self.resolve(ctx.key, getattr(ctx.conv, "state", None))
+        if func is None:
+            return None
+        ctx.m = m
+        t0 = time.perf_counter()
+        failed = True
+        try:
+            out = func(ctx)
+            failed = False
+            return out
+        finally:
+            self._observe(name, (time.perf_counter() - t0) * 1000, failed)
+
+    def _observe(self, name, ms, failed):
+        with self._lock:
+            st = self._stats.get(name)
+            if st is None:
+                st = self._stats[name] = RouteStats()
+            st.observe(ms, failed)
+
+    def snapshot(self):
+        with self._lock:
+            return {name: st.as_dict() for name, st in sorted(self._stats.items())}
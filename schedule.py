@@ -0,0 +1,116 @@
+# schedule.py
+"""
+ShopSlot 編譯成每週營業表，放在程序內快取（versions.VersionedCache，名稱 "shop_slots"）。
+
+每個星期幾：
+  windows  依 start_time 排序的 (start_time, end_time, interval_min, capacity)
+  bounds   所有 start/end 排序去重後的切點；每一段 [bounds[i], bounds[i+1]) 預先算好
+           「第一個包含它的時段」（與原本 check_capacity 逐一比對的結果相同，時段重疊也一樣）
+查某個時間屬於哪個時段 = 一次 bisect，O(log n)。
+
+ShopSlotAdmin 新增 / 修改 / 刪除 ShopSlot 時，versions 的 session 事件會讓版本 +1，快取自動重載。
+"""
+import os
+from bisect import bisect_right
+from datetime import datetime, timedelta, time as dtime
+
+from models import db, ShopSlot
+import versions
+
+CLOSED_DAY = "closed_day"
+CLOSED_TIME = "closed_time"
+OVERRUN = "overrun"        # 開始時間在營業中，但服務做不完就打烊了
+
+
+def block_of(when: datetime, interval_min: int):
+    """格子以整點對齊：回傳 (block_start, block_end)。"""
+    block_min = (when.minute // interval_min) * interval_min
+    block_start = when.replace(minute=block_min, second=0, microsecond=0)
+    return block_start, block_start + timedelta(minutes=interval_min)
+
+
+class WeeklySchedule:
+    def __init__(self, rows):
+        """rows：(weekday, start_time, end_time, interval_min, capacity)，需依 weekday、start_time 排序。"""
+        self.windows = {}
+        for wd, st, et, interval, cap in rows:
+            self.windows.setdefault(wd, []).append((st, et, interval or 30, cap or 0))
+        self._bounds = {}
+        self._segments = {}
+        for wd, wins in self.windows.items():
+            bounds = sorted({w[0] for w in wins} | {w[1] for w in wins})
+            segs = []
+            for b in bounds:
+                segs.append(next((w for w in wins if w[0] <= b < w[1]), None))
+            self._bounds[wd] = bounds
+            self._segments[wd] = segs
+
+    def is_open_day(self, weekday: int) -> bool:
+        return bool(self.windows.get(weekday))
+
+    def window_at(self, weekday: int, hm: dtime):
+        bounds = self._bounds.get(weekday)
+        if not bounds:
+            return None
+        i = bisect_right(bounds, hm) - 1
+        if i < 0:
+            return None
+        return self._segments[weekday][i]
+
+    def cell(self, when: datetime):
+        """回傳 (cell_start, cell_end, capacity, reason)；不在營業時間時前三項為 None。"""
+        wd = when.weekday()
+        if not self.is_open_day(wd):
+            return None, None, 0, CLOSED_DAY
+        w = self.window_at(wd, dtime(when.hour, when.minute))
+        if w is None:
+            return None, None, 0, CLOSED_TIME
+        start, end = block_of(when, w[2])
+        return start, end, w[3], None
+
+    def cell_for(self, when: datetime):
+        """
+        回傳 (cell_start, capacity, reason)；
+        不在營業日 / 營業時段時 cell_start 為 None，reason 為 CLOSED_DAY / CLOSED_TIME。
+        """
+        start, _end, cap, reason = self.cell(when)
+        return start, cap, reason
+
+    def cells_for_span(self, when: datetime, duration_min: int | None = None, strict: bool = True):
+        """
+        [when, when + duration_min) 會佔用的格子：回傳 ([(cell_start, capacity), ...], reason)。
+        duration_min 為空時只佔 when 所在的一格；中途遇到非營業時間：
+          strict=True   回 (None, OVERRUN)（新預約不能做到打烊後）
+          strict=False  回到打烊前為止的格子（釋放 / 重建既有訂單用，與當初佔的一致）
+        """
+        start, end, cap, reason = self.cell(when)
+        if start is None:
+            return None, reason
+        cells = [(start, cap)]
+        if not duration_min:
+            return cells, None
+        span_end = when + timedelta(minutes=duration_min)
+        while end < span_end:
+            nxt, nxt_end, cap, _reason = self.cell(end)
+            if nxt is None or nxt_end <= end:
+                return (None, OVERRUN) if strict else (cells, None)
+            cells.append((nxt, cap))
+            end = nxt_end
+        return cells, None
+
+
+def _load():
+    rows = (db.session.query(ShopSlot.weekday, ShopSlot.start_time, ShopSlot.end_time,
+                             ShopSlot.interval_min, ShopSlot.capacity)
+            .order_by(ShopSlot.weekday.asc(), ShopSlot.start_time.asc())
+            .all())
+    return WeeklySchedule(rows)
+
+
+versions.track("shop_slots", ShopSlot)
+schedule_cache = versions.VersionedCache(
+    "shop_slots", _load, check_interval=float(os.getenv("SCHEDULE_VERSION_CHECK_SEC", "5")))
+
+
+def current_schedule() -> WeeklySchedule:
+    return schedule_cache.get()
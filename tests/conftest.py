@@ -0,0 +1,54 @@
+# tests/conftest.py
+"""
+測試用 SQLite（暫存檔），每個測試重建資料表並放入預設的服務與營業時段。
+排程不啟動；LINE API 的送出由各測試 monkeypatch outbound。
+"""
+import base64, os, sys, tempfile
+from datetime import time as dtime
+
+_DB = os.path.join(tempfile.mkdtemp(prefix="mcshop-test-"), "test.db")
+os.environ["DATABASE_URL"] = f"sqlite:///{_DB}"
+os.environ["SCHEDULER_ENABLED"] = "0"
+os.environ.setdefault("LINE_CHANNEL_SECRET", "test-secret")
+os.environ.setdefault("LINE_CHANNEL_ACCESS_TOKEN", "test-token")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+from sqlalchemy.orm import configure_mappers
+
+import app as mcshop
+import versions
+from models import db, Service, ShopSlot
+
+configure_mappers()                # inline_models 需要已設定好的 relationship 方向（正式環境開機時已查過 DB）
+mcshop.setup_admin(mcshop.app)     # 正式環境在 __main__ 裡呼叫；app 處理第一個 request 前只能註冊一次
+
+
+@pytest.fixture
+def app():
+    with mcshop.app.app_context():
+        db.create_all()
+        db.session.add_all([
+            Service(name="更換機油", base_price=400, duration_min=20, recommend_days=90),
+            Service(name="煞車皮更換", base_price=600, duration_min=40, recommend_days=365),
+        ])
+        for wd in range(6):
+            db.session.add(ShopSlot(weekday=wd, start_time=dtime(8), end_time=dtime(21),
+                                    interval_min=30, capacity=2))
+        db.session.commit()
+        for caches in versions._caches.values():     # 上一個測試的服務 / 營業時段
+            for cache in caches:
+                cache._value = None
+        yield mcshop.app
+        db.session.rollback()
+        db.session.remove()
+        db.drop_all()
+
+
+@pytest.fixture
+def admin_client(app):
+    auth = base64.b64encode(b"%s:%s" % (app.config["BASIC_AUTH_USERNAME"].encode(),
+                                         app.config["BASIC_AUTH_PASSWORD"].encode())).decode()
+    client = app.test_client()
+    client.environ_base["HTTP_AUTHORIZATION"] = f"Basic {auth}"
+    return client
@@ -0,0 +1,104 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+import occupancy
+import outbound
+from models import db, User, Vehicle, Order, OrderItem, Service, SlotOccupancy
+
+
+def _booked():
+    return {r.cell_start: r.booked for r in SlotOccupancy.query.all() if r.booked}
+
+
+def _weekday_at(days, hour):
+    d = datetime.now().replace(hour=hour, minute=0, second=0, microsecond=0) + timedelta(days=days)
+    while d.weekday() == 6:
+        d += timedelta(days=1)
+    return d
+
+
+@pytest.fixture
+def orders(app):
+    oil = Service.query.filter_by(name="更換機油").one()
+    user = User(line_user_id="U1")
+    db.session.add(user); db.session.flush()
+    vehicle = Vehicle(user_id=user.id, plate="ABC-1234")
+    db.session.add(vehicle); db.session.flush()
+    day1, day2 = _weekday_at(1, 10), _weekday_at(3, 10)
+    out = []
+    for when in (day1, day1 + timedelta(hours=1), day1 + timedelta(hours=2), day2):
+        o = Order(user_id=user.id, vehicle_id=vehicle.id, status="pending", booked_at=when)
+        o.items.append(OrderItem(service_id=oil.id))
+        out.append(o)
+    db.session.add_all(out); db.session.commit()
+    occupancy.rebuild(); db.session.commit()
+    return [o.id for o in out]
+
+
+def _post(client, name, ids):
+    return client.post("/admin/order/action/", data={"action": name, "rowid": [str(i) for i in ids]})
+
+
+def _statuses(ids):
+    db.session.expire_all()
+    return [db.session.get(Order, i).status for i in ids]
+
+
+def test_cancel_and_confirm_through_admin(admin_client, orders):
+    assert sum(_booked().values()) == 4
+    resp = _post(admin_client, "cancel", orders[:2])
+    assert resp.status_code == 302
+    assert _statuses(orders) == ["canceled", "canceled", "pending", "pending"]
+    assert sum(_booked().values()) == 2
+
+    _post(admin_client, "confirm", orders[:3])
+    assert _statuses(orders) == ["confirmed", "confirmed", "confirmed", "pending"]
+    assert sum(_booked().values()) == 4
+    before = _booked()
+    occupancy.rebuild(); db.session.commit()
+    assert _booked() == before
+
+
+def test_notify_action_multicasts_once_per_message(admin_client, orders, monkeypatch):
+    import jobs
+    sent = []
+    monkeypatch.setattr(outbound, "multicast", lambda api, ids, messages, retry_key=None: sent.append(ids))
+    monkeypatch.setattr(jobs, "submit", lambda name, func, *args: func(*args))
+    _post(admin_client, "cancel_notify", orders[:2])
+    assert sent == [["U1"], ["U1"]]     # 兩個不同時間，各一則
+
+
+def test_complete_day_through_admin(admin_client, orders):
+    _post(admin_client, "cancel", orders[1:2])
+    _post(admin_client, "complete_day", orders[:1])
+    assert _statuses(orders) == ["completed", "canceled", "completed", "pending"]
+    assert sum(_booked().values()) == 1
+
+
+def test_failed_notify_is_reported_and_resent_with_same_key(admin_client, orders, monkeypatch):
+    import jobs
+    import order_actions
+    calls = []
+    def multicast(api, ids, messages, retry_key=None):
+        calls.append((list(ids), retry_key))
+        if len(calls) == 1:
+            raise RuntimeError("LINE down after retries")
+    monkeypatch.setattr(outbound, "multicast", multicast)
+    monkeypatch.setattr(jobs, "submit", lambda name, func, *args: func(*args))
+    monkeypatch.setattr(order_actions, "_failed", [])
+
+    _post(admin_client, "cancel_notify", orders[:1])
+    assert order_actions.failed_recipients() == 1
+    failed_key = calls[0][1]
+    assert failed_key == order_actions.retry_key(order_actions._failed[0][0], ["U1"])
+    assert order_actions.retry_key("m", ["U2", "U1"]) == order_actions.retry_key("m", ["U1", "U2"])
+
+    resp = admin_client.post("/admin/order/action/", data={"action": "confirm", "rowid": [str(orders[3])]},
+                             follow_redirects=True)
+    assert "1 位客人的通知重試後仍未送達" in resp.get_data(as_text=True)
+
+    _post(admin_client, "cancel_notify", orders[1:2])
+    assert calls[1] == (["U1"], failed_key)          # 先用原本的 key 重送
+    assert calls[2][1] not in (None, failed_key)
+    assert order_actions.failed_recipients() == 0
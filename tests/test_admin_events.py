@@ -0,0 +1,36 @@
+import json
+from datetime import datetime
+
+from models import db, User, Order
+
+RANGE = {"start": "2030-01-01T00:00:00", "end": "2030-02-01T00:00:00"}
+
+
+def _fetch(client, etag=None):
+    headers = {"If-None-Match": etag} if etag else {}
+    return client.get("/admin/api/events", query_string=RANGE, headers=headers)
+
+
+def test_unchanged_range_returns_304(admin_client):
+    first = _fetch(admin_client)
+    assert first.status_code == 200 and first.headers["ETag"]
+    again = _fetch(admin_client, first.headers["ETag"])
+    assert again.status_code == 304
+    assert again.headers["ETag"] == first.headers["ETag"]
+    assert again.data == b""
+
+
+def test_order_change_returns_new_etag(admin_client):
+    user = User(line_user_id="U1")
+    db.session.add(user); db.session.commit()
+    first = _fetch(admin_client)
+    assert json.loads(first.data) == []
+
+    order = Order(user_id=user.id, status="pending", booked_at=datetime(2030, 1, 10, 9, 0))
+    db.session.add(order); db.session.commit()        # commit 後才 bump orders 版本
+
+    changed = _fetch(admin_client, first.headers["ETag"])
+    assert changed.status_code == 200
+    assert changed.headers["ETag"] != first.headers["ETag"]
+    assert [e["id"] for e in json.loads(changed.data)] == [order.id]
+    assert _fetch(admin_client, changed.headers["ETag"]).status_code == 304
@@ -0,0 +1,107 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+import occupancy
+from models import db, User, Vehicle, Order, OrderItem, Service, SlotOccupancy
+
+
+def _booked():
+    db.session.expire_all()
+    return {r.cell_start: r.booked for r in SlotOccupancy.query.all() if r.booked}
+
+
+def _assert_matches_rebuild():
+    before = _booked()
+    occupancy.rebuild(); db.session.commit()
+    assert _booked() == before
+    return before
+
+
+@pytest.fixture
+def setup(app):
+    user = User(line_user_id="U1")
+    db.session.add(user); db.session.flush()
+    vehicle = Vehicle(user_id=user.id, plate="ABC-1234")
+    db.session.add(vehicle); db.session.commit()
+    d = datetime.now().replace(hour=10, minute=0, second=0, microsecond=0) + timedelta(days=2)
+    while d.weekday() == 6:
+        d += timedelta(days=1)
+    services = {s.name: s.id for s in Service.query.all()}
+    return user.id, vehicle.id, services, d
+
+
+def _order_form(user_id, vehicle_id, when, status="pending", **extra):
+    data = {"user": str(user_id), "vehicle": str(vehicle_id), "status": status,
+            "booked_at": when.strftime("%Y-%m-%dT%H:%M"), "note": ""}
+    data.update(extra)
+    return data
+
+
+def test_admin_create_edit_delete_keeps_occupancy(admin_client, setup):
+    user_id, vehicle_id, services, when = setup
+    resp = admin_client.post("/admin/order/new/", data=_order_form(
+        user_id, vehicle_id, when, **{"items-0-service": str(services["煞車皮更換"]), "items-0-qty": "1",
+                                      "items-0-unit_price": "0", "items-0-subtotal": "0"}))
+    assert resp.status_code == 302
+    order = Order.query.one()
+    assert len(order.items) == 1
+    assert sum(_assert_matches_rebuild().values()) == 2      # 40 分鐘佔兩格
+
+    # 改時間
+    later = when + timedelta(hours=3)
+    resp = admin_client.post(f"/admin/order/edit/?id={order.id}", data=_order_form(
+        user_id, vehicle_id, later, **{"items-0-id": str(order.items[0].id),
+                                       "items-0-service": str(services["煞車皮更換"]), "items-0-qty": "1",
+                                       "items-0-unit_price": "0", "items-0-subtotal": "0"}))
+    assert resp.status_code == 302
+    assert set(_assert_matches_rebuild()) == {later, later + timedelta(minutes=30)}
+
+    # 明細換成 20 分鐘的服務（OrderItem 後台）
+    item_id = OrderItem.query.one().id
+    resp = admin_client.post(f"/admin/orderitem/edit/?id={item_id}", data={
+        "order": str(order.id), "service": str(services["更換機油"]), "qty": "1", "unit_price": "0", "subtotal": "0"})
+    assert resp.status_code == 302
+    assert _assert_matches_rebuild() == {later: 1}
+
+    # 取消（改狀態）
+    resp = admin_client.post(f"/admin/order/edit/?id={order.id}", data=_order_form(
+        user_id, vehicle_id, later, status="canceled"))
+    assert resp.status_code == 302
+    assert _assert_matches_rebuild() == {}
+
+
+def test_admin_delete_releases(admin_client, setup):
+    user_id, vehicle_id, services, when = setup
+    o = Order(user_id=user_id, vehicle_id=vehicle_id, status="confirmed", booked_at=when)
+    o.items.append(OrderItem(service_id=services["更換機油"]))
+    db.session.add(o); db.session.commit()
+    occupancy.rebuild(); db.session.commit()
+    assert _booked() == {when: 1}
+    resp = admin_client.post("/admin/order/delete/", data={"id": str(o.id)})
+    assert resp.status_code == 302
+    assert Order.query.count() == 0
+    assert _assert_matches_rebuild() == {}
+
+
+def test_admin_delete_item_shrinks_order(admin_client, setup):
+    user_id, vehicle_id, services, when = setup
+    o = Order(user_id=user_id, vehicle_id=vehicle_id, status="pending", booked_at=when)
+    o.items.append(OrderItem(service_id=services["更換機油"]))
+    o.items.append(OrderItem(service_id=services["煞車皮更換"]))
+    db.session.add(o); db.session.commit()
+    occupancy.rebuild(); db.session.commit()
+    assert len(_booked()) == 2                       # 60 分鐘
+    brake = next(it.id for it in o.items if it.service_id == services["煞車皮更換"])
+    resp = admin_client.post("/admin/orderitem/delete/", data={"id": str(brake)})
+    assert resp.status_code == 302
+    assert _assert_matches_rebuild() == {when: 1}
+
+
+def test_tracking_view_requires_hooks():
+    import app as mcshop
+    class Incomplete(mcshop.OccupancyTrackingView):
+        def _order_ids(self, model):
+            return []
+    with pytest.raises(TypeError, match="_span_after_delete"):
+        Incomplete(Order, db.session, endpoint="incomplete")
@@ -0,0 +1,19 @@
+import json
+
+import flex_engine
+from flex_engine import Slot
+
+
+def test_slot_truncates_and_logs(capsys):
+    before = flex_engine.stats["truncated"]
+    assert json.loads(Slot("name", max_len=5).fill("王小明先生您好")) == "王小明先生"
+    assert flex_engine.stats["truncated"] == before + 1
+    assert "slot 'name' truncated: 7 > 5" in capsys.readouterr().out
+
+
+def test_slot_within_limit_untouched(capsys):
+    before = flex_engine.stats["truncated"]
+    assert json.loads(Slot("name", max_len=5).fill("王小明")) == "王小明"
+    assert json.loads(Slot("name", max_len=5).fill("  ")) == "-"
+    assert flex_engine.stats["truncated"] == before
+    assert capsys.readouterr().out == ""
@@ -0,0 +1,37 @@
+import pytest
+from pydantic.v1 import ValidationError
+
+from flex_helper import shape_of, prepare, _ENUM_KEYS
+
+
+@pytest.mark.parametrize("key, a, b", [
+    ("justifyContent", "center", "bogus"),
+    ("alignItems", "flex-start", "bogus"),
+    ("adjustMode", "shrink-to-fit", "bogus"),
+    ("mode", "datetime", "bogus"),            # datetimepicker action
+    ("inputOption", "openKeyboard", "bogus"),  # postback action
+])
+def test_enum_values_are_part_of_shape(key, a, b):
+    # 列舉值不同就是不同形狀，不合法的值不會沿用已驗證過的快取
+    assert shape_of({"type": "box", key: a}) != shape_of({"type": "box", key: b})
+
+
+def test_content_strings_share_shape():
+    assert shape_of({"type": "text", "text": "a"}) == shape_of({"type": "text", "text": "b"})
+
+
+def test_enum_keys_include_sdk_validated_fields():
+    assert {"mode", "inputOption", "justifyContent", "alignItems", "adjustMode"} <= _ENUM_KEYS
+    assert not {"text", "label", "data", "uri"} & _ENUM_KEYS
+
+
+def _picker(mode):
+    return {"type": "bubble", "body": {"type": "box", "layout": "vertical", "contents": [
+        {"type": "button", "action": {"type": "datetimepicker", "label": "選時間", "data": "PICK", "mode": mode}},
+    ]}}
+
+
+def test_cached_shape_does_not_pass_bogus_enum():
+    prepare(_picker("datetime"))
+    with pytest.raises(ValidationError):
+        prepare(_picker("bogus"))
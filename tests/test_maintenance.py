@@ -0,0 +1,46 @@
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import event
+
+from models import db, User, Vehicle, Order, OrderItem, Service, MaintenanceDue
+
+
+@pytest.fixture
+def count_queries(app):
+    statements = []
+    def on_execute(conn, cursor, statement, params, context, executemany):
+        statements.append(statement)
+    event.listen(db.engine, "before_cursor_execute", on_execute)
+    yield statements
+    event.remove(db.engine, "before_cursor_execute", on_execute)
+
+
+def _order(status):
+    user = User(line_user_id=f"U-{status}")
+    db.session.add(user); db.session.flush()
+    vehicle = Vehicle(user_id=user.id, plate=f"{status}-1")
+    db.session.add(vehicle); db.session.flush()
+    order = Order(user_id=user.id, vehicle_id=vehicle.id, status=status,
+                  booked_at=datetime.now() - timedelta(days=1))
+    db.session.add(order); db.session.flush()
+    return order
+
+
+def test_booking_item_flush_skips_order_lookup(count_queries):
+    # 跟 CONFIRM_SUBMIT 一樣：訂單先 flush，明細只給 order_id
+    order = _order("pending")
+    service_id = Service.query.first().id
+    count_queries.clear()
+    db.session.add(OrderItem(order_id=order.id, service_id=service_id, qty=1, unit_price=0, subtotal=0))
+    db.session.flush()
+    assert len(count_queries) == 1 and count_queries[0].startswith("INSERT INTO order_items")
+
+
+def test_item_of_completed_order_refreshes_due(app):
+    order = _order("completed")
+    service = Service.query.first()
+    db.session.add(OrderItem(order_id=order.id, service_id=service.id, qty=1, unit_price=0, subtotal=0))
+    db.session.flush()
+    due = MaintenanceDue.query.filter_by(vehicle_id=order.vehicle_id, service_id=service.id).one()
+    assert due.last_done_at == order.booked_at
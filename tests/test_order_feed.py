@@ -0,0 +1,80 @@
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy.orm import Session
+
+import order_feed
+from models import db, User, Vehicle, Order, OrderItem, Service
+
+
+@pytest.fixture
+def feed(app):
+    q = order_feed.subscribe()
+    assert q.get_nowait() == {"op": "resync"}
+    def drain():
+        out = []
+        while not q.empty():
+            out.append(q.get_nowait())
+        return out
+    yield drain
+    order_feed.unsubscribe(q)
+
+
+def _book(session, plate="ABC-123"):
+    user = User(line_user_id=f"U-{plate}")
+    session.add(user); session.flush()
+    vehicle = Vehicle(user_id=user.id, plate=plate)
+    session.add(vehicle); session.flush()
+    order = Order(user_id=user.id, vehicle_id=vehicle.id, status="pending",
+                  booked_at=datetime.now().replace(microsecond=0) + timedelta(days=1))
+    session.add(order); session.flush()
+    session.add(OrderItem(order_id=order.id, service_id=session.query(Service).first().id,
+                          qty=1, unit_price=0, subtotal=0))
+    return order
+
+
+def test_booking_upserts_event(feed):
+    order = _book(db.session)
+    db.session.commit()
+    [msg] = feed()
+    assert msg["op"] == "upsert" and msg["id"] == order.id
+    assert msg["event"]["title"] == f"#{order.id} ABC-123 pending"
+    assert msg["event"]["end"] == (order.booked_at + timedelta(minutes=20)).isoformat()
+
+
+def test_cancel_upserts_inactive_event(feed):
+    order = _book(db.session)
+    db.session.commit()
+    feed()
+    order.status = "canceled"
+    db.session.commit()
+    [msg] = feed()
+    assert msg["op"] == "upsert" and msg["event"]["color"] == "#999999"
+
+
+def test_delete_removes_event(feed):
+    order = _book(db.session)
+    db.session.commit()
+    feed()
+    oid = order.id
+    db.session.delete(order)
+    db.session.commit()
+    assert feed() == [{"op": "remove", "id": oid}]
+
+
+def test_rollback_sends_nothing(feed):
+    _book(db.session)
+    db.session.flush()
+    db.session.rollback()
+    assert feed() == []
+
+
+def test_other_session_sees_its_own_uncommitted_rows(feed):
+    # 不是 db.session 的 session commit 時，也要用那個 session 的連線查（否則看不到新訂單，變成 remove）
+    with Session(db.engine) as session:
+        order = _book(session, plate="XYZ-789")
+        session.commit()
+        oid = order.id
+    [msg] = feed()
+    assert msg["op"] == "upsert" and msg["id"] == oid
+    assert msg["event"]["title"] == f"#{oid} XYZ-789 pending"
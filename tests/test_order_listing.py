@@ -0,0 +1,65 @@
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy import event
+
+import app as mcshop
+from catalog import current_catalog
+from models import db, User, Vehicle, Order, OrderItem, Service
+
+
+@pytest.fixture
+def count_queries(app):
+    statements = []
+    def on_execute(conn, cursor, statement, params, context, executemany):
+        statements.append(statement)
+    event.listen(db.engine, "before_cursor_execute", on_execute)
+    yield statements
+    event.remove(db.engine, "before_cursor_execute", on_execute)
+
+
+def _user_with_orders(line_user_id, n):
+    services = Service.query.all()
+    user = User(line_user_id=line_user_id)
+    db.session.add(user); db.session.flush()
+    vehicle = Vehicle(user_id=user.id, plate=f"{line_user_id}-1")
+    db.session.add(vehicle); db.session.flush()
+    start = datetime.now() + timedelta(days=1)
+    for i in range(n):
+        o = Order(user_id=user.id, vehicle_id=vehicle.id, status="pending", booked_at=start + timedelta(hours=i))
+        o.items.extend(OrderItem(service_id=s.id) for s in services)
+        db.session.add(o)
+    db.session.commit()
+    return user.id
+
+
+def _listing_queries(statements, user_id):
+    db.session.expire_all()
+    current_catalog()                     # 服務目錄在程序內快取，先載入
+    statements.clear()
+    rows = mcshop.make_order_rows(mcshop.order_listing().filter(Order.user_id == user_id).all())
+    assert all(r["services"] != "-" and r["plate"] != "-" for r in rows)
+    return len(statements), len(rows)
+
+
+def test_make_order_rows_constant_queries(count_queries):
+    one = _user_with_orders("U1", 1)
+    fifty = _user_with_orders("U50", 50)
+    assert _listing_queries(count_queries, one) == (2, 1)
+    assert _listing_queries(count_queries, fifty) == (2, 50)
+
+
+def test_reply_my_orders_constant_queries(count_queries, monkeypatch):
+    replies = []
+    monkeypatch.setattr(mcshop, "reply_flex", lambda api, token, alt, contents: replies.append(alt))
+    counts = []
+    for uid, n in (("U1", 1), ("U50", 50)):
+        user_id = _user_with_orders(uid, n)
+        db.session.expire_all()
+        current_catalog()
+        count_queries.clear()
+        mcshop._reply_my_orders(SimpleNamespace(api=None, reply_token="tok", user=SimpleNamespace(id=user_id)))
+        counts.append(len(count_queries))
+    assert counts == [2, 2]
+    assert replies == ["我的預約列表"] * 2
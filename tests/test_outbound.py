@@ -0,0 +1,23 @@
+from linebot.v3.messaging import ApiException
+
+import outbound
+import uow
+from models import db, User
+
+
+def test_retries_run_after_commit(app, monkeypatch):
+    attempts = []
+
+    def post(api_client, path, body, headers=None):
+        attempts.append((path, db.session().in_transaction()))
+        if len(attempts) < 3:
+            raise ApiException(status=500, reason="busy")
+
+    monkeypatch.setattr(outbound, "_post", post)
+    monkeypatch.setattr(outbound, "BACKOFF_BASE", 0)
+    with uow.unit_of_work("test"):
+        db.session.add(User(line_user_id="U1"))
+        db.session.flush()
+        outbound.deliver(None, "tok", '[{"type":"text","text":"hi"}]')
+        assert attempts == []
+    assert attempts == [(outbound.REPLY_PATH, False)] * 3
@@ -0,0 +1,57 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+import maintenance
+import outbound
+from models import db, User, Vehicle, Order, OrderItem, Service, MaintenanceDue
+
+
+def _completed(line_user_id, days_ago):
+    user = User(line_user_id=line_user_id)
+    db.session.add(user); db.session.flush()
+    vehicle = Vehicle(user_id=user.id, plate=f"{line_user_id}-1")
+    db.session.add(vehicle); db.session.flush()
+    order = Order(user_id=user.id, vehicle_id=vehicle.id, status="completed",
+                  booked_at=datetime.now() - timedelta(days=days_ago))
+    order.items.append(OrderItem(service_id=Service.query.filter_by(name="更換機油").one().id))
+    db.session.add(order)
+
+
+@pytest.fixture
+def due(app, monkeypatch):
+    monkeypatch.setattr(outbound, "remaining_quota", lambda: None)
+    _completed("UA", 95)
+    _completed("UB", 100)
+    db.session.commit()
+
+
+def test_maintenance_resume_reuses_batch_key(due, monkeypatch):
+    def crash(api, ids, messages, retry_key=None):
+        raise RuntimeError("process died after claim")
+    monkeypatch.setattr(outbound, "multicast", crash)
+    with pytest.raises(RuntimeError):
+        maintenance.run()
+    db.session.rollback()
+    [key] = {r.batch_key for r in MaintenanceDue.query.filter(MaintenanceDue.notified_at == None)}
+
+    sent = []
+    monkeypatch.setattr(outbound, "multicast",
+                        lambda api, ids, messages, retry_key=None: sent.append((sorted(ids), retry_key)))
+    assert maintenance.run() == 2
+    assert sent == [(["UA", "UB"], key)]
+    assert MaintenanceDue.query.filter(MaintenanceDue.notified_at == None).count() == 0
+
+
+def test_quota_stop_keeps_batch_for_next_run(due, monkeypatch):
+    sent = []
+    monkeypatch.setattr(outbound, "multicast",
+                        lambda api, ids, messages, retry_key=None: sent.append(sorted(ids)))
+    monkeypatch.setattr(outbound, "remaining_quota", lambda: 1)
+    assert maintenance.run() == 0
+    assert sent == []
+    assert MaintenanceDue.query.filter(MaintenanceDue.batch_key != None).count() == 2
+
+    monkeypatch.setattr(outbound, "remaining_quota", lambda: None)
+    assert maintenance.run() == 2
+    assert sent == [["UA", "UB"]]
@@ -0,0 +1,57 @@
+from datetime import date, datetime, timedelta
+
+import pytest
+
+import outbound
+import reminders
+from models import db, User, Order, ReminderSent
+
+
+def test_same_user_two_times_gets_both_reminders(app, monkeypatch):
+    sent = []
+    monkeypatch.setattr(outbound, "remaining_quota", lambda: None)
+    monkeypatch.setattr(outbound, "multicast",
+                        lambda api, ids, messages, retry_key=None: sent.append((list(ids), messages)))
+    today = date.today()
+    tomorrow = datetime.combine(today + timedelta(days=1), datetime.min.time())
+    user = User(line_user_id="UX")
+    db.session.add(user); db.session.flush()
+    orders = [Order(user_id=user.id, status="pending", booked_at=tomorrow.replace(hour=h)) for h in (10, 14)]
+    db.session.add_all(orders); db.session.commit()
+
+    assert reminders.run(today) == 2
+    assert [ids for ids, _m in sent] == [["UX"], ["UX"]]
+    assert "10:00" in sent[0][1] and "14:00" in sent[1][1]
+    assert all(r.sent_at is not None for r in ReminderSent.query.all())
+    assert ReminderSent.query.count() == 2
+
+
+def test_resume_after_crash_sends_only_original_recipients(app, monkeypatch):
+    sent = []
+    monkeypatch.setattr(outbound, "remaining_quota", lambda: None)
+    today = date.today()
+    at = datetime.combine(today + timedelta(days=1), datetime.min.time()).replace(hour=10)
+    ux, uy = User(line_user_id="UX"), User(line_user_id="UY")
+    db.session.add_all([ux, uy]); db.session.flush()
+    first = Order(user_id=ux.id, status="pending", booked_at=at)
+    db.session.add(first); db.session.flush()
+    db.session.add(ReminderSent(order_id=first.id, booked_at=at, batch_key="old", sent_at=datetime.utcnow()))
+    # UX 同一時間又訂一筆（已提醒過，不送）、UY 要送
+    db.session.add_all([Order(user_id=ux.id, status="pending", booked_at=at),
+                        Order(user_id=uy.id, status="pending", booked_at=at)])
+    db.session.commit()
+
+    def crash(api, ids, messages, retry_key=None):
+        raise RuntimeError("process died after claim")
+    monkeypatch.setattr(outbound, "multicast", crash)
+    with pytest.raises(RuntimeError):
+        reminders.run(today)
+    db.session.rollback()
+    keys = {r.batch_key for r in ReminderSent.query.filter(ReminderSent.sent_at == None)}
+    assert len(keys) == 1
+
+    monkeypatch.setattr(outbound, "multicast",
+                        lambda api, ids, messages, retry_key=None: sent.append((list(ids), retry_key)))
+    assert reminders.run(today) == 1
+    assert sent == [(["UY"], keys.pop())]
+    assert ReminderSent.query.filter(ReminderSent.sent_at == None).count() == 0
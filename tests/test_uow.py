@@ -0,0 +1,40 @@
+import pytest
+from sqlalchemy.exc import IntegrityError
+
+import outbound
+import uow
+from flex_helper import reply_text
+from models import db, User
+
+
+@pytest.fixture
+def sent(monkeypatch):
+    out = []
+    monkeypatch.setattr(outbound, "_deliver", lambda api, token, messages, context: out.append((token, messages)))
+    return out
+
+
+def test_reply_is_sent_after_commit(app, sent):
+    with uow.unit_of_work("test"):
+        db.session.add(User(line_user_id="U1"))
+        reply_text(None, "tok", "預約成功")
+        assert sent == []
+    assert [t for t, _m in sent] == ["tok"]
+    assert User.query.filter_by(line_user_id="U1").count() == 1
+
+
+def test_reply_is_dropped_when_commit_fails(app, sent):
+    db.session.add(User(line_user_id="U1")); db.session.commit()
+    with pytest.raises(IntegrityError):
+        with uow.unit_of_work("test"):
+            db.session.add(User(line_user_id="U1"))
+            reply_text(None, "tok", "預約成功")
+    assert sent == []
+
+
+def test_rollback_drops_queued_replies(app, sent):
+    with uow.unit_of_work("test"):
+        reply_text(None, "tok", "預約成功")
+        uow.rollback()
+        reply_text(None, "tok", "系統忙線")
+    assert len(sent) == 1 and "系統忙線" in sent[0][1]
@@ -0,0 +1,29 @@
+from sqlalchemy import event
+
+import versions
+from models import db, User, Order, OrderItem, Service
+
+
+def test_booking_bumps_orders_once_after_commit(app):
+    user = User(line_user_id="U1")
+    db.session.add(user); db.session.commit()
+    versions.bump("orders"); db.session.commit()
+    before = versions.current("orders")
+    db.session.commit()
+
+    bumps = []
+    def on_execute(conn, cursor, statement, params, context, executemany):
+        if "cache_versions" in statement and not statement.startswith("SELECT"):
+            bumps.append(statement)
+    event.listen(db.engine, "before_cursor_execute", on_execute)
+    try:
+        order = Order(user_id=user.id, status="pending")
+        db.session.add(order); db.session.flush()
+        db.session.add(OrderItem(order_id=order.id, service_id=Service.query.first().id))
+        db.session.flush()
+        assert bumps == []           # 下單的 transaction 裡不動 cache_versions
+        db.session.commit()
+    finally:
+        event.remove(db.engine, "before_cursor_execute", on_execute)
+    assert len(bumps) == 1
+    assert versions.current("orders") == before + 1
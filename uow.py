@@ -0,0 +1,133 @@
+# uow.py
+"""
+每個 webhook 事件一個 unit of work：handler 與 helper 只改 session 內的物件，
+事件處理完 commit 一次；途中出錯則 rollback。
+
+commit 次數透過 SQLAlchemy 的 after_commit 事件計數（thread-local），
+每個事件超過 1 次會印出警告，統計值放在 /healthz 方便觀察是否退化。
+
+需要在 commit 前後做事的物件（例如 conv_cache 的 write-behind）可用 enlist() 加入，
+需實作 before_commit() / after_commit() / after_rollback()。
+
+defer(fn, *args)：commit 成功之後才執行（回覆訊息用）。回覆不會在 transaction 裡等 LINE API
+（不佔 slot_occupancy / cache_versions 的 row lock），commit 失敗時客人也不會先收到「預約成功」；
+rollback 時丟掉。commit 後才失敗的只記錄，不影響已 commit 的資料。
+"""
+import threading, traceback
+from contextlib import contextmanager
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from models import db
+
+_local = threading.local()
+_lock = threading.Lock()
+
+stats = {"events": 0, "commits": 0, "rollbacks": 0, "over_budget": 0, "max_commits_per_event": 0,
+         "deferred": 0, "deferred_failures": 0}
+
+
+@event.listens_for(Session, "after_commit")
+def _count_commit(session):
+    if getattr(_local, "commits", None) is not None:
+        _local.commits += 1
+
+
+def current_commit_count():
+    return getattr(_local, "commits", None) or 0
+
+
+def enlist(participant) -> bool:
+    """加入目前的 unit of work；不在 unit of work 內時回 False。"""
+    parts = getattr(_local, "participants", None)
+    if parts is None:
+        return False
+    if participant not in parts:
+        parts.append(participant)
+    return True
+
+
+def defer(fn, *args) -> bool:
+    """commit 成功後才執行 fn(*args)；不在 unit of work 內時回 False（呼叫端自己直接執行）。"""
+    pending = getattr(_local, "deferred", None)
+    if pending is None:
+        return False
+    pending.append((fn, args))
+    return True
+
+
+def rollback():
+    """handler 自行攔下例外時使用：rollback session，並讓已加入的物件放棄這次的變更。"""
+    db.session.rollback()
+    parts = getattr(_local, "participants", None) or []
+    for p in parts:
+        p.after_rollback()
+    parts.clear()
+    pending = getattr(_local, "deferred", None)
+    if pending:
+        pending.clear()      # 這次的回覆一起丟掉，handler 可以改回錯誤訊息
+
+
+def _run_deferred(pending):
+    for fn, args in pending:
+        try:
+            fn(*args)
+        except Exception:
+            with _lock:
+                stats["deferred_failures"] += 1
+            print(f"[uow] deferred {getattr(fn, '__name__', fn)} failed after commit")
+            traceback.print_exc()
+    with _lock:
+        stats["deferred"] += len(pending)
+
+
+def in_unit_of_work() -> bool:
+    return getattr(_local, "participants", None) is not None
+
+
+@contextmanager
+def unit_of_work(label: str = "", budget: int = 1):
+    """
+    with unit_of_work("PostbackEvent"):
+        handler(event)
+    正常結束 → commit 一次，再執行 defer() 排入的工作；例外 → rollback（丟掉排入的工作）後往外丟。
+    """
+    _local.commits = 0
+    _local.participants = parts = []
+    _local.deferred = pending = []
+    try:
+        yield
+        for p in parts:
+            p.before_commit()
+        db.session.commit()
+        for p in parts:
+            p.after_commit()
+    except Exception:
+        db.session.rollback()
+        for p in parts:
+            p.after_rollback()
+        with _lock:
+            stats["rollbacks"] += 1
+        raise
+    finally:
+        n = _local.commits
+        _local.commits = None
+        _local.participants = None
+        _local.deferred = None
+        with _lock:
+            stats["events"] += 1
+            stats["commits"] += n
+            stats["max_commits_per_event"] = max(stats["max_commits_per_event"], n)
+            if n > budget:
+                stats["over_budget"] += 1
+        if n > budget:
+            print(f"[uow] {label} committed {n} times (budget {budget})")
+    _run_deferred(pending)
+
+
+def snapshot():
+    with _lock:
+        out = dict(stats)
+    out["avg_commits_per_event"] = round(out["commits"] / out["events"], 3) if out["events"] else 0
+    return out
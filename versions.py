@@ -0,0 +1,142 @@
+# versions.py
+"""
+程序內快取的版本控制。
+
+  - track(name, Model)：該 Model 透過 ORM 新增/修改/刪除時，在同一個 transaction 內
+    把 cache_versions.<name> +1（後台 ModelView 的 save / delete 都會觸發）
+  - track(name, Model, after_commit=True)：客人每次下單都會動到的表（orders）用這個。
+    不在事件的 transaction 裡更新（否則所有客人的寫入都排隊等同一列的 row lock），
+    改成 commit 之後另開一個很短的 transaction +1，一次 commit 最多一次。
+    commit 與 +1 之間讀到的是舊版本 + 新資料，之後版本變了會再重抓；
+    程序剛好在中間掛掉時版本少加一次，到下一次變動前可能回舊的 304（只影響後台日曆）
+  - VersionedCache：持有 loader 產生的值；最多每 check_interval 秒查一次 cache_versions（主鍵查詢），
+    版本不同就重載。本程序 commit 了變更會立刻失效，其他 worker 最晚 check_interval 秒內跟上。
+"""
+import threading, time
+from datetime import datetime
+
+from sqlalchemy import event, update
+from sqlalchemy.orm import Session
+
+from models import db, CacheVersion
+
+_tracked = {}          # Model class → version name
+_deferred = set()      # commit 後才 +1 的 version name
+_caches = {}           # version name → [VersionedCache]
+
+
+def track(name: str, *models, after_commit: bool = False):
+    for m in models:
+        _tracked[m] = name
+    if after_commit:
+        _deferred.add(name)
+
+
+def current(name: str) -> int:
+    v = (db.session.query(CacheVersion.version)
+         .filter(CacheVersion.name == name)
+         .scalar())
+    return v or 0
+
+
+def bump(name: str, conn=None):
+    """版本 +1；conn 未給時用 db.session（與呼叫端同一個 transaction）。"""
+    execute = conn.execute if conn is not None else db.session.execute
+    res = execute(update(CacheVersion.__table__)
+                  .where(CacheVersion.__table__.c.name == name)
+                  .values(version=CacheVersion.__table__.c.version + 1, updated_at=datetime.utcnow()))
+    if res.rowcount == 0:
+        execute(CacheVersion.__table__.insert().values(name=name, version=1, updated_at=datetime.utcnow()))
+
+
+def bump_after_commit(name: str, session=None):
+    """不經 ORM 的變動（bulk UPDATE）用：目前的 transaction commit 之後 +1。"""
+    (session or db.session()).info.setdefault("deferred_bumps", set()).add(name)
+
+
+def invalidate_local(name: str):
+    for cache in _caches.get(name, []):
+        cache.invalidate()
+
+
+@event.listens_for(Session, "after_flush")
+def _bump_on_change(session, flush_context):
+    names = set()
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        name = _tracked.get(type(obj))
+        if name and (obj in session.new or obj in session.deleted or session.is_modified(obj)):
+            names.add(name)
+    if not names:
+        return
+    later = names & _deferred
+    if later:
+        session.info.setdefault("deferred_bumps", set()).update(later)
+        names -= later
+    if not names:
+        return
+    conn = session.connection()
+    for name in sorted(names):
+        bump(name, conn)
+    session.info.setdefault("bumped_versions", set()).update(names)
+
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_after_commit(session):
+    for name in session.info.pop("bumped_versions", ()):
+        invalidate_local(name)
+    later = session.info.pop("deferred_bumps", None)
+    if later:
+        try:
+            with session.get_bind().begin() as conn:     # 獨立的短 transaction，只鎖這一列一下
+                for name in sorted(later):
+                    bump(name, conn)
+        except Exception as e:
+            print(f"[versions] bump {sorted(later)} after commit failed: {e!r}")
+        for name in later:
+            invalidate_local(name)
+
+
+@event.listens_for(Session, "after_rollback")
+def _forget_after_rollback(session):
+    session.info.pop("bumped_versions", None)
+    session.info.pop("deferred_bumps", None)
+
+
+class VersionedCache:
+    def __init__(self, name: str, loader, check_interval: float = 5.0):
+        self.name = name
+        self.loader = loader
+        self.check_interval = check_interval
+        self._value = None
+        self._version = None
+        self._next_check = 0.0
+        self._lock = threading.Lock()
+        self.stats = {"loads": 0, "version_checks": 0}
+        _caches.setdefault(name, []).append(self)
+
+    def get(self):
+        now = time.monotonic()
+        if self._value is not None and now < self._next_check:
+            return self._value
+        with self._lock:
+            if self._value is not None and now < self._next_check:
+                return self._value
+            ver = current(self.name)
+            self.stats["version_checks"] += 1
+            if self._value is None or ver != self._version:
+                self._value = self.loader()
+                self._version = ver
+                self.stats["loads"] += 1
+            self._next_check = now + self.check_interval
+            return self._value
+
+    @property
+    def version(self):
+        return self._version
+
+    def invalidate(self):
+        # 下次 get() 會重新比對版本（版本已在 commit 時 +1，因此會重載）
+        self._next_check = 0.0
+
+    def snapshot(self):
+        return dict(self.stats, version=self._version)
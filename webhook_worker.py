@@ -0,0 +1,191 @@
+# webhook_worker.py
+"""
+/callback 事件分派。
+
+同一使用者的事件必須依序處理（Conversation.state 依賴順序），不同使用者可以平行。
+做法：依 source 的 user_id 雜湊到固定的 lane，每條 lane 一個佇列 + 一個 worker，
+同一使用者永遠落在同一條 lane 上，因此保序；不同 lane 之間平行。
+
+設定（環境變數）：
+  WEBHOOK_ASYNC=1            開啟非同步模式（預設關閉，request 內處理完才回 200）
+  WEBHOOK_WORKERS=4          lane（worker 執行緒）數；同步模式下為平行處理的執行緒數
+  WEBHOOK_QUEUE_SIZE=1000    佇列總上限（平均分給各 lane）
+  WEBHOOK_QUEUE_FULL=block   lane 滿時的行為：
+                               block  → 最多等 WEBHOOK_QUEUE_TIMEOUT 秒，仍滿則回 503 讓 LINE 重送
+                               inline → 直接在 request 內同步處理（不保證同一使用者的順序）
+                               drop   → 丟棄事件（只記錄）
+                               reject → 立即回 503
+  WEBHOOK_QUEUE_TIMEOUT=0.5
+"""
+import os, queue, threading, traceback, zlib
+from concurrent.futures import ThreadPoolExecutor
+
+FULL_POLICIES = ("block", "inline", "drop", "reject")
+
+
+class QueueFull(Exception):
+    """lane 已滿且策略為 block（逾時）或 reject。"""
+
+
+def event_user_key(event):
+    """事件的排序鍵：user_id 優先，其次 group/room；都沒有則回 None（不需保序）。"""
+    src = getattr(event, "source", None)
+    for attr in ("user_id", "group_id", "room_id"):
+        v = getattr(src, attr, None)
+        if v:
+            return v
+    return None
+
+
+def group_by_user(events):
+    """依使用者分組，組內維持原本順序。"""
+    groups = {}
+    for i, ev in enumerate(events):
+        key = event_user_key(ev)
+        groups.setdefault(key if key is not None else f"#{i}", []).append(ev)
+    return list(groups.values())
+
+
+class WebhookWorkerPool:
+    def __init__(self, run_event, workers: int = 4, maxsize: int = 1000,
+                 on_full: str = "block", put_timeout: float = 0.5):
+        if on_full not in FULL_POLICIES:
+            raise ValueError(f"WEBHOOK_QUEUE_FULL 必須是 {FULL_POLICIES} 之一：{on_full!r}")
+        self.run_event = run_event          # callable(event)，已包好 app context
+        self.workers = max(1, int(workers))
+        self.on_full = on_full
+        self.put_timeout = put_timeout
+        lane_size = max(1, -(-int(maxsize) // self.workers))
+        self.lanes = [queue.Queue(maxsize=lane_size) for _ in range(self.workers)]
+        self._threads = []
+        self._rr = 0
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self.stats = {"enqueued": 0, "processed": 0, "failed": 0,
+                      "inline": 0, "dropped": 0, "rejected": 0}
+
+    # 第一次 submit 時才起 thread（gunicorn fork 之後才會有 worker）
+    def _ensure_started(self):
+        if self._threads:
+            return
+        with self._lock:
+            if self._threads:
+                return
+            for i, q in enumerate(self.lanes):
+                t = threading.Thread(target=self._loop, args=(q,), name=f"webhook-lane-{i}", daemon=True)
+                t.start()
+                self._threads.append(t)
+
+    def _bump(self, key):
+        with self._stats_lock:
+            self.stats[key] += 1
+
+    def _loop(self, q):
+        while True:
+            event = q.get()
+            try:
+                self.run_event(event)
+                self._bump("processed")
+            except Exception:
+                self._bump("failed")
+                print("!! webhook worker exception !!")
+                traceback.print_exc()
+            finally:
+                q.task_done()
+
+    def lane_for(self, event):
+        key = event_user_key(event)
+        if key is None:
+            # 沒有使用者的事件不需保序，輪流分配
+            with self._lock:
+                self._rr = (self._rr + 1) % self.workers
+                return self.lanes[self._rr]
+        return self.lanes[zlib.crc32(key.encode("utf-8")) % self.workers]
+
+    def submit(self, event):
+        """
+        把單一事件放進所屬使用者的 lane；lane 滿時依 on_full 處理。
+        block（逾時）/ reject 會丟出 QueueFull，由 /callback 轉成 503。
+        """
+        self._ensure_started()
+        q = self.lane_for(event)
+        try:
+            if self.on_full == "block":
+                q.put(event, timeout=self.put_timeout)
+            else:
+                q.put_nowait(event)
+            self._bump("enqueued")
+            return
+        except queue.Full:
+            pass
+
+        if self.on_full == "inline":
+            self._bump("inline")
+            self.run_event(event)
+        elif self.on_full == "drop":
+            self._bump("dropped")
+            print(f"!! webhook queue full, drop event {getattr(event, 'webhook_event_id', '')}")
+        else:
+            self._bump("rejected")
+            raise QueueFull()
+
+    def snapshot(self):
+        return dict(self.stats, depth=sum(q.qsize() for q in self.lanes),
+                    lane_depths=[q.qsize() for q in self.lanes],
+                    maxsize=sum(q.maxsize for q in self.lanes),
+                    workers=self.workers, on_full=self.on_full)
+
+
+class ParallelDispatcher:
+    """
+    同步模式用：一個 webhook body 內的事件依使用者分組，
+    不同使用者的組平行執行、組內依序執行，全部完成後才返回。
+    """
+    def __init__(self, run_event, workers: int = 4):
+        self.run_event = run_event
+        self.workers = max(1, int(workers))
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self.workers,
+                                                        thread_name_prefix="webhook-sync")
+        return self._executor
+
+    def _run_group(self, events):
+        for ev in events:
+            try:
+                self.run_event(ev)
+            except Exception:
+                print("!! webhook dispatch exception !!")
+                traceback.print_exc()
+
+    def dispatch(self, events):
+        groups = group_by_user(events)
+        if len(groups) <= 1:
+            # 單一使用者（最常見）不必切 thread
+            for g in groups:
+                self._run_group(g)
+            return
+        futures = [self._get_executor().submit(self._run_group, g) for g in groups]
+        for f in futures:
+            f.result()
+
+
+def pool_from_env(run_event):
+    if os.getenv("WEBHOOK_ASYNC", "0") != "1":
+        return None
+    return WebhookWorkerPool(
+        run_event,
+        workers=int(os.getenv("WEBHOOK_WORKERS", "4")),
+        maxsize=int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000")),
+        on_full=os.getenv("WEBHOOK_QUEUE_FULL", "block"),
+        put_timeout=float(os.getenv("WEBHOOK_QUEUE_TIMEOUT", "0.5")),
+    )
+
+
+def dispatcher_from_env(run_event):
+    return ParallelDispatcher(run_event, workers=int(os.getenv("WEBHOOK_WORKERS", "4")))